@@ -17,6 +17,7 @@ FFMPEG2THEORA_PATH = u'/usr/bin/ffmpeg2theora'
 UNRAR_PATH = u'/usr/bin/unrar'
 
 DOWNLOAD_DIR = u'/var/www/downloads/'
+SCRATCH_DIR = None # Fast local disk for the active downloads, moved to DOWNLOAD_DIR once completed - None to download to DOWNLOAD_DIR. Episodes are then only packaged once their whole torrent is moved, not file by file.
 
 TEST_DOWNLOAD_DIR = spath(u'tests/')
 TEST_VIDEO_PATH = ppath(u'eben_moglen-freedom_in_the_cloud.avi')
@@ -24,6 +25,8 @@ TEST_SHORT_VIDEO_PATH = ppath(u'creative_commons.webm')
 TEST_SERIES_LIST = ['Pioneer One']
 TEST_DB_DUMP_PATH = u'/tmp/plebia_test_db.json'
 CACHE_DIR = spath(u'cache/')
+RESUME_DATA_DIR = spath(u'cache/resume/')
+CHECKPOINT_DIR = spath(u'cache/checkpoint/')
 LOCK_PATH = ppath(u'plebia/')
 BIN_DIR = ppath(u'bin/')
 STATIC_DIR = ppath(u'static/')
@@ -39,12 +42,63 @@ BITTORRENT_PORTS=(6881, 6891)
 BITTORRENT_MAX_METADATA_DOWNLOADS=50
 BITTORRENT_METADATA_TIMEOUT=1200
 BITTORRENT_MAX_DOWNLOADS=10
+BITTORRENT_MAX_METADATA_DOWNLOADS_PER_WORKER=50 # BITTORRENT_MAX_* limits apply to all the download workers together
+BITTORRENT_MAX_DOWNLOADS_PER_WORKER=10
+BITTORRENT_WORKER_ID=None # Name of the download workers of this host, defaults to the host name
+BITTORRENT_LEASE_DURATION=60 # seconds after which the torrents of a stopped download worker are taken over
 BITTORRENT_DOWNLOAD_NOSEED_TIMEOUT=3600
+BITTORRENT_STALL_WINDOW=3600 # seconds of progress used to project the completion time of downloads
+BITTORRENT_STALL_MAX_ETA=24*3600 # downloads projected to end after this many seconds are cancelled & searched again
 BITTORRENT_MAX_SEEDS=5
+BITTORRENT_SEED_RATIO=1.0 # upload/size ratio after which a completed torrent stops seeding
+BITTORRENT_SEED_TIME=24*3600 # seconds after which a completed torrent stops seeding
+BITTORRENT_DELETE_AFTER_TRANSCODING=False # Delete the downloaded files when a torrent stops seeding, once its episodes are transcoded
+BITTORRENT_USE_ALERTS=True # False to poll the status of each torrent on every iteration instead
+BITTORRENT_STATS_INTERVAL=30 # seconds between refreshes of the torrents statistics, when using alerts
+BITTORRENT_PRIORITY_INTERVAL=60 # seconds between updates of the torrents download priority
+BITTORRENT_PRIORITY_WEIGHTS={'posts': 10, 'air_date': 10, 'watched': 10, 'swarm': 1, 'streaming': 100}
+BITTORRENT_PREEMPTION=True # Pause low priority downloads to start high priority ones
+BITTORRENT_PREEMPTION_MARGIN=5 # Minimum priority difference to pause a download
+BITTORRENT_CHECKPOINT_INTERVAL=300 # seconds between saves of the session state (DHT, stats, resume data)
+BITTORRENT_CHECKPOINT_MIN_INTERVAL=30 # minimum seconds between saves of the session state, when it changes
+BITTORRENT_CHECKPOINT_DHT_CHANGE=0.5 # change ratio of the number of DHT nodes which triggers a save
+BITTORRENT_CHECKPOINT_GENERATIONS=3 # versions of the session state kept on disk
+BITTORRENT_SESSION_PROFILE='balanced' # libtorrent settings: 'low-memory', 'balanced' or 'high-throughput'
+BITTORRENT_AUTO_TUNING=False # Switch between the profiles from the measured throughput & memory use
+BITTORRENT_AUTO_TUNING_INTERVAL=900 # seconds of measures before each profile change
+BITTORRENT_AUTO_TUNING_MAX_MEMORY=1024*1024*1024 # memory use (bytes) above which the tuner uses a lower profile
+BITTORRENT_MAX_CHECKING=2 # Maximum number of torrents checking their files at once
+BITTORRENT_STREAMING_WINDOW=10 # pieces to download with a deadline after the readable part of a streamed file
+BITTORRENT_STREAMING_DEADLINE=2000 # milliseconds between the deadlines of consecutive pieces of a streamed file
+BITTORRENT_STREAMING_TIMEOUT=3*3600 # seconds after the last request to stream a file before it is considered abandoned
+STREAMING_CHUNK_SIZE=4*1024*1024 # maximum bytes returned by each request to a streamed file
+STORAGE_MIN_FREE_SPACE=5*1024*1024*1024 # bytes to always keep free on the DOWNLOAD_DIR volume
+METRICS_MINUTE_RETENTION=2 # days during which the transfer rates per minute are kept
+METRICS_HOUR_RETENTION=90 # days during which the transfer rates per hour are kept
 
 PROXIES = None
 
-HTTP_REQUESTS_DELAY=3
+PLUGIN_REGISTRY_TTL=60 # seconds before reloading the active plugins, to see the changes made by other processes
+
+HTTP_REQUESTS_DELAY=3 # seconds between requests to a same host, on average
+HTTP_HOST_REQUESTS_DELAY = {} # per-host HTTP_REQUESTS_DELAY, ie {'bitsnoop.com': 1}
+HTTP_REQUESTS_BURST=1 # requests which can be made at once to a host after it was idle
+TORRENT_SEARCH_WORKERS=1 # threads searching torrents at once - keep 1 with sqlite
+TORRENT_SEARCH_CACHE_TTL=3600 # seconds during which the results of a search are reused - 0 to disable
+TORRENT_SEARCH_CACHE_NEGATIVE_TTL=600 # same, for searches without results
+TORRENT_SEARCH_CACHE_SIZE=1000 # searches kept in the cache, the least recently used ones are dropped
+TORRENT_SEARCH_MAX_PAGES=5 # pages of results retrieved at most from a search engine, when the first ones are not enough
+TORRENT_SCRAPE_CANDIDATES=5 # best search results whose trackers are scraped to re-rank them - 0 to disable
+TORRENT_SCRAPE_TIMEOUT=10 # seconds to wait for the answer of a tracker
+TORRENT_SEARCH_MAX_CANDIDATES=10 # search results kept for each episode/season, to fall back on when a torrent fails
+TORRENT_PREFETCH_CANDIDATES=0 # best search results whose metadata is retrieved, to download the one with the best files - 0 to disable
+TORRENT_FEDERATED_TIMEOUT=30 # seconds the federated searcher waits for each of the other searchers
+TORRENT_FEDERATED_TIMEOUTS = {} # per-searcher TORRENT_FEDERATED_TIMEOUT, ie {'torrentz-searcher': 60}
+TORRENT_FEDERATED_ENOUGH_SEEDS=100 # the federated searcher stops waiting once a result has this many seeds - 0 to wait for all
+TORRENT_RESEARCH_DELAY=3600 # seconds before searching again for an episode without torrent, doubled after each failure
+TORRENT_RESEARCH_MAX_DELAY=7*24*3600 # longest delay between two searches for an episode
+TORRENT_RESEARCH_JITTER=0.2 # random variation of the delays between searches, as a fraction of them
+TORRENT_RESEARCH_PER_HOUR=30 # searches again for episodes without torrent, at most, for all of them
 
 DEBUG = False
 TEMPLATE_DEBUG = DEBUG
@@ -53,6 +53,7 @@ class EpisodeAdmin(admin.ModelAdmin):
         ('Date information',  {'fields': ['date_added'], 'classes': ['collapse']}),
         ('TVDB information',  {'fields': ['tvdb_id', 'name', 'overview', 'director', 'guest_stars', 'language', 'rating', 'writer', 'first_aired', 'image_url', 'imdb_id', 'tvdb_last_updated']}),
         ('Files',             {'fields': ['torrent','video']}),
+        ('Torrent search',    {'fields': ['search_attempts', 'next_search', 'last_retry'], 'classes': ['collapse']}),
     ]
     list_display = ('season', 'number', 'name')
 
@@ -100,16 +101,25 @@ class TorrentInline(admin.TabularInline):
 class TorrentAdmin(admin.ModelAdmin):
     readonly_fields = ("date_added","last_status_change")
     fieldsets = [
-        (None,                {'fields': ['name','hash','tracker_url_list','file_list']}),
+        (None,                {'fields': ['name','hash','tracker_url_list','file_list','completed_files']}),
         ('Date information',  {'fields': ['date_added','last_status_change'], 'classes': ['collapse']}),
-        ('State information', {'fields': ['status','progress','seeds','peers','type','active_time','has_metadata']}),
+        ('State information', {'fields': ['status','progress','seeds','peers','type','active_time','has_metadata','priority','streaming_file','streaming_bytes','lease_owner','lease_expires']}),
     ]
     inlines = [SeasonInline, EpisodeInline]
-    list_display = ('name', 'status', 'progress', 'seeds', 'peers')
+    list_display = ('name', 'status', 'progress', 'seeds', 'peers', 'priority')
 
 admin.site.register(Torrent, TorrentAdmin)
 
 
+# TorrentCandidate ##
+
+class TorrentCandidateAdmin(admin.ModelAdmin):
+    readonly_fields = ("date_added",)
+    list_display = ('name', 'rank', 'episode', 'season', 'seeds', 'peers')
+
+admin.site.register(TorrentCandidate, TorrentCandidateAdmin)
+
+
 # Video ##
 
 class VideoInline(admin.TabularInline):
@@ -121,6 +131,7 @@ class VideoAdmin(admin.ModelAdmin):
         (None,                {'fields': ['original_path']}),
         ('Date information',  {'fields': ['date_added'], 'classes': ['collapse']}),
         ('Transcoding',       {'fields': ['status','image_path','webm_path','mp4_path','ogv_path']}),
+        ('Storage',           {'fields': ['original_evicted','last_watched']}),
     ]
     inlines = [EpisodeInline]
 
@@ -31,12 +31,23 @@ from datetime import datetime
 class VideoResource(ModelResource):
     class Meta:
         queryset = Video.objects.all().order_by('-date_added')
-        fields = ['date_added','id','status','image_path','mp4_path','ogv_path','original_path','webm_path']
+        fields = ['date_added','id','status','image_path','mp4_path','ogv_path','original_path','webm_path','original_evicted','last_watched']
 
 class TorrentResource(ModelResource):
     class Meta:
         queryset = Torrent.objects.all().order_by('-date_added')
-        fields = ['date_added','hash','id','name','peers','progress','seeds','status','type','download_speed','upload_speed','eta','active_time','details_url','tracker_url_list','file_list','has_metadata','last_status_change']
+        fields = ['date_added','hash','id','name','peers','progress','seeds','status','type','download_speed','upload_speed','eta','active_time','details_url','tracker_url_list','file_list','has_metadata','last_status_change','priority','completed_files','streaming_file','streaming_bytes','download_rate','upload_rate','lease_owner']
+
+class TransferSampleResource(ModelResource):
+    torrent = fields.ForeignKey(TorrentResource, 'torrent', null=True)
+    class Meta:
+        queryset = TransferSample.objects.all().order_by('-date')
+        fields = ['id','date','resolution','torrent','download_rate','upload_rate','max_download_rate','nb_samples','profile']
+        filtering = {
+            'date': ['gte', 'lt'],
+            'resolution': ['exact'],
+            'torrent': ['exact', 'isnull'],
+        }
 
 class SeriesResource(ModelResource):
     season_list = fields.ToManyField('wall.api.SeasonResource', 'season_set')
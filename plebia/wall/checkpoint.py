@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+from wall.helpers import mkdir_p, write_file_atomic
+
+import pickle
+import time
+import os
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Models ############################################################
+
+class SessionCheckpointer:
+    '''Owns the persistent state of the bittorrent session (DHT routing table, session stats,
+    resume data of the torrents), and saves it to disk on an interval, or sooner when it 
+    changes significantly. Each state is written atomically, and the last 
+    BITTORRENT_CHECKPOINT_GENERATIONS versions are kept, in case the latest can't be read.'''
+
+    def __init__(self, name=''):
+        # Each download worker has its own session
+        self.path = os.path.join(settings.CHECKPOINT_DIR, name)
+        self.next_checkpoint = 0
+        self.last_checkpoint = 0
+        self.last_dht_nodes = None
+        self.last_nb_torrents = None
+
+    def do(self, bt):
+        '''Save the state of the session if it is time to'''
+
+        now = time.time()
+        if now < self.next_checkpoint and not self.has_significant_change(bt):
+            return False
+
+        log.debug('Saving session state')
+        self.save('dht', bt.get_dht_state())
+        session_stats = bt.get_session_stats()
+        self.save('session_stats', session_stats)
+        bt.save_resume_data() # Saved by the resume data alerts, as they arrive
+
+        self.last_checkpoint = now
+        self.next_checkpoint = now + settings.BITTORRENT_CHECKPOINT_INTERVAL
+        self.last_dht_nodes = session_stats['dht_nodes']
+        self.last_nb_torrents = session_stats['nb_torrents']
+
+        return True
+
+    def has_significant_change(self, bt):
+        '''Check if the session changed enough since the last checkpoint to save it before
+        the end of the interval - torrents added or removed, or a large change in the number
+        of DHT nodes. Changes are coalesced for BITTORRENT_CHECKPOINT_MIN_INTERVAL seconds.'''
+
+        if time.time() < self.last_checkpoint + settings.BITTORRENT_CHECKPOINT_MIN_INTERVAL:
+            return False
+
+        session_stats = bt.get_session_stats()
+        if session_stats['nb_torrents'] != self.last_nb_torrents:
+            return True
+
+        dht_change = abs(session_stats['dht_nodes'] - self.last_dht_nodes)
+        return dht_change > settings.BITTORRENT_CHECKPOINT_DHT_CHANGE * max(self.last_dht_nodes, 1)
+
+    def get_file_path(self, name, generation):
+        return os.path.join(self.path, '%s.%d' % (name, generation))
+
+    def save(self, name, content):
+        '''Write a new generation of a state, rotating the older ones'''
+
+        mkdir_p(self.path)
+
+        for generation in reversed(xrange(settings.BITTORRENT_CHECKPOINT_GENERATIONS - 1)):
+            file_path = self.get_file_path(name, generation)
+            if os.path.exists(file_path):
+                os.rename(file_path, self.get_file_path(name, generation + 1))
+
+        write_file_atomic(self.get_file_path(name, 0), pickle.dumps(content, pickle.HIGHEST_PROTOCOL))
+
+    def load(self, name):
+        '''Read the most recent generation of a state which can be read, None if there is none'''
+
+        for generation in xrange(settings.BITTORRENT_CHECKPOINT_GENERATIONS):
+            file_path = self.get_file_path(name, generation)
+            if not os.path.isfile(file_path):
+                continue
+
+            try:
+                with open(file_path, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                log.warn('Could not read checkpoint %s, trying the previous one', file_path)
+
+        return None
+
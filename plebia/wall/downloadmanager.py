@@ -31,10 +31,10 @@ from wall.contentdbupdater import ContentDBUpdateManager
 class DownloadManager:
     '''Controls the different actions that can be performed on a content during its download/life'''
 
-    def __init__(self):
+    def __init__(self, worker_name=None):
         self.actions = {
                 'torrent_search': TorrentSearchManager(),
-                'torrent_download': TorrentDownloadManager(),
+                'torrent_download': TorrentDownloadManager(worker_name=worker_name),
                 'package_management': PackageManager(),
                 'video_transcoding': VideoTranscodingManager(),
                 'contentdb_update': ContentDBUpdateManager()
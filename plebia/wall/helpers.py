@@ -22,7 +22,7 @@
 
 from django.conf import settings
 
-import time
+from wall.ratelimit import wait_for_host
 
 # Logging ###########################################################
 
@@ -115,16 +115,16 @@ def get_url_rss(url):
 
     return res.entries
 
-def get_url(url):
+def get_url(url, timeout=None):
     '''Returns the content at the provided URL, None if error'''
 
     import requests
 
     # Pause before making the request, to avoid spamming websites
-    time.sleep(settings.HTTP_REQUESTS_DELAY)
+    wait_for_host(url)
 
     headers = {'User-Agent': settings.SOFTWARE_USER_AGENT}
-    r = requests.get(url, headers=headers, proxies=settings.PROXIES)
+    r = requests.get(url, headers=headers, proxies=settings.PROXIES, timeout=timeout)
 
     if r.status_code == requests.codes.ok:
         log.debug("Retreived URL %s => %s", url, r.content)
@@ -158,4 +158,41 @@ def mkdir_p(path):
             pass
         else: raise
 
+def write_file_atomic(path, content):
+    '''Write content to a file, replacing the previous version atomically - a crash 
+    during the write can't leave a partially written file behind'''
+
+    import os, tempfile
+
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def parse_range_header(header, size):
+    '''Parses the value of a HTTP Range header ("bytes=<start>-<end>") for a file of <size> bytes
+    Returns a (start, end) tuple of the first range, both included, None if there is no valid range'''
+
+    import re
+
+    m = re.match(r"^bytes=([0-9]*)-([0-9]*)", header or '')
+    if m is None or (not m.group(1) and not m.group(2)):
+        return None
+
+    if not m.group(1):
+        # Suffix range: last <end> bytes
+        start = max(0, size - int(m.group(2)))
+        end = size - 1
+    else:
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+
+    return (start, min(end, size - 1))
 
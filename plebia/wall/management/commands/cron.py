@@ -53,6 +53,9 @@ class Command(BaseCommand):
         ) + (
         make_option('-f', '--forever', action="store_true", dest='forever', default=False,
             help='Keep iterating infinitely (and keep objects running, like the bittorrent client)'),
+        ) + (
+        make_option('-w', '--worker', action="store", dest='worker', default=None,
+            help='Name of the worker, to run several processes of the same command (torrent_download only)'),
         )
 
     def __init__(self):
@@ -69,9 +72,14 @@ class Command(BaseCommand):
         command = args[0]
         repeat = options.get('repeat')
         forever = options.get('forever')
+        worker = options.get('worker')
 
-        # Only allow one cron process per command to run at a single time
-        lock_path = os.path.join(settings.LOCK_PATH, '.%s.pid' % command)
+        # Only allow one cron process per command (and per worker) to run at a single time
+        if worker:
+            self.dl_manager = DownloadManager(worker_name=worker)
+            lock_path = os.path.join(settings.LOCK_PATH, '.%s.%s.pid' % (command, worker))
+        else:
+            lock_path = os.path.join(settings.LOCK_PATH, '.%s.pid' % command)
         try:
             l = lock.lock(lock_path, timeout=MAX_RUN_TIME) # wait at most 50s
             self.do(command, repeat, forever)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.db import transaction
+from django.db.models import Avg, Max, Min, Sum
+from django.conf import settings
+
+from wall.models import Torrent, TransferSample
+
+from datetime import datetime, timedelta
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Models ############################################################
+
+class TransferMetrics:
+    '''Samples the transfer rates of the session and of each torrent at every tick. Samples 
+    are kept in memory and stored as one average per minute, then downsampled to one 
+    average per hour. Old averages are purged after METRICS_*_RETENTION days.'''
+
+    def __init__(self):
+        self.is_downsampled = False # Hours left over by a previous run
+        self.bucket_start = None
+        self.bucket_profile = ''
+        # {hash: [download rates sum, upload rates sum, max download rate, nb samples]}
+        # The session-wide rates use the None hash
+        self.bucket_dict = dict()
+
+    def add_sample(self, session_rates, torrent_rate_dict, now=None, profile=''):
+        '''Add the current rates, as (download_rate, upload_rate) tuples in bytes/s, of the 
+        session and of each torrent ({hash: (download_rate, upload_rate)}), and the name of
+        the session profile in use'''
+
+        if now is None:
+            now = datetime.now()
+        minute = now.replace(second=0, microsecond=0)
+
+        if self.bucket_start is not None and minute != self.bucket_start:
+            self.flush(minute)
+        self.bucket_start = minute
+        self.bucket_profile = profile
+
+        rate_list = torrent_rate_dict.items() + [(None, session_rates)]
+        for (hash, (download_rate, upload_rate)) in rate_list:
+            bucket = self.bucket_dict.setdefault(hash, [0.0, 0.0, 0.0, 0])
+            bucket[0] += download_rate
+            bucket[1] += upload_rate
+            bucket[2] = max(bucket[2], download_rate)
+            bucket[3] += 1
+
+    def flush(self, next_minute):
+        '''Store the averages of the current minute, and downsample the last hour 
+        once it is over - as well as, on the first flush, the hours which couldn't be
+        downsampled before the worker stopped'''
+
+        bucket_start = self.bucket_start
+        bucket_profile = self.bucket_profile
+        bucket_dict = self.bucket_dict
+        self.bucket_dict = dict()
+
+        torrent_id_dict = dict(Torrent.objects.filter(hash__in=[hash for hash in bucket_dict if hash is not None])\
+                .values_list('hash', 'id'))
+
+        @transaction.commit_on_success
+        def write_samples():
+            for (hash, (download_sum, upload_sum, max_download_rate, nb_samples)) in bucket_dict.items():
+                if hash is not None and hash not in torrent_id_dict:
+                    continue
+                TransferSample(date=bucket_start, resolution='minute', \
+                        torrent_id=torrent_id_dict.get(hash), \
+                        profile=bucket_profile, \
+                        download_rate=download_sum/nb_samples, \
+                        upload_rate=upload_sum/nb_samples, \
+                        max_download_rate=max_download_rate, \
+                        nb_samples=nb_samples).save()
+
+        write_samples()
+
+        hour_start = bucket_start.replace(minute=0)
+        if next_minute.replace(minute=0) != hour_start:
+            self.downsample_pending(next_minute, since=hour_start)
+            self.purge(next_minute)
+        elif not self.is_downsampled:
+            self.downsample_pending(next_minute)
+        self.is_downsampled = True
+
+    def downsample_pending(self, now, since=None):
+        '''Downsample the complete hours which have minute averages more recent than the 
+        last hour downsampled - and the hours since a given date again, to include the minute
+        averages stored by the other download workers in the meantime'''
+
+        current_hour = now.replace(minute=0, second=0, microsecond=0)
+
+        pending_list = TransferSample.objects.filter(resolution='minute', date__lt=current_hour)
+        last_hour = TransferSample.objects.filter(resolution='hour').aggregate(Max('date'))['date__max']
+        if last_hour is not None:
+            pending_list = pending_list.filter(date__gte=last_hour + timedelta(hours=1))
+        first_minute = pending_list.aggregate(Min('date'))['date__min']
+
+        hour_start = current_hour
+        if first_minute is not None:
+            hour_start = first_minute.replace(minute=0)
+        if since is not None:
+            hour_start = min(hour_start, since)
+
+        while hour_start < current_hour:
+            self.downsample(hour_start)
+            hour_start += timedelta(hours=1)
+
+    def downsample(self, hour_start):
+        '''Store the averages of an hour, from the averages of its minutes - separately for
+        each session profile used during the hour, replacing the ones stored previously. The
+        session rates are added up over the download workers for each minute first.'''
+
+        hour_end = hour_start + timedelta(hours=1)
+        minute_sample_list = TransferSample.objects.filter(resolution='minute', \
+                date__gte=hour_start, date__lt=hour_end)\
+                .exclude(torrent=None)\
+                .values('torrent', 'profile')\
+                .annotate(avg_download_rate=Avg('download_rate'), \
+                        avg_upload_rate=Avg('upload_rate'), \
+                        max_max_download_rate=Max('max_download_rate'), \
+                        sum_nb_samples=Sum('nb_samples'))
+
+        session_dict = dict()
+        for minute in TransferSample.objects.get_session_minutes(hour_start, hour_end):
+            session_dict.setdefault(minute['profile'], list()).append(minute)
+
+        @transaction.commit_on_success
+        def write_samples():
+            TransferSample.objects.filter(resolution='hour', date=hour_start).delete()
+
+            for (profile, minute_list) in session_dict.items():
+                TransferSample(date=hour_start, resolution='hour', \
+                        profile=profile, \
+                        download_rate=sum([minute['download_rate'] for minute in minute_list])/len(minute_list), \
+                        upload_rate=sum([minute['upload_rate'] for minute in minute_list])/len(minute_list), \
+                        max_download_rate=max([minute['max_download_rate'] for minute in minute_list]), \
+                        nb_samples=sum([minute['nb_samples'] for minute in minute_list])).save()
+
+            for sample in minute_sample_list:
+                TransferSample(date=hour_start, resolution='hour', \
+                        torrent_id=sample['torrent'], \
+                        profile=sample['profile'], \
+                        download_rate=sample['avg_download_rate'], \
+                        upload_rate=sample['avg_upload_rate'], \
+                        max_download_rate=sample['max_max_download_rate'], \
+                        nb_samples=sample['sum_nb_samples']).save()
+
+        log.debug("Downsampling transfer rates of %s", hour_start)
+        write_samples()
+
+    def purge(self, now):
+        '''Delete the averages older than their retention period'''
+
+        TransferSample.objects.filter(resolution='minute', \
+                date__lt=now - timedelta(days=settings.METRICS_MINUTE_RETENTION)).delete()
+        TransferSample.objects.filter(resolution='hour', \
+                date__lt=now - timedelta(days=settings.METRICS_HOUR_RETENTION)).delete()
+
@@ -51,6 +51,7 @@ TORRENT_STATUSES = (
     ('Downloading metadata', 'Downloading metadata'),
     ('Queued', 'Queued'),
     ('Downloading', 'Downloading'),
+    ('Moving', 'Moving to the library'),
     ('Completed', 'Completed'),
     ('Error', 'Error'),
 )
@@ -61,7 +62,8 @@ class ProcessingTorrentManager(models.Manager):
                 Q(status='New') | \
                 Q(status='Downloading metadata') | \
                 Q(status='Queued') | \
-                Q(status='Downloading'))
+                Q(status='Downloading') | \
+                Q(status='Moving'))
 
 class CompletedTorrentManager(models.Manager):
     def get_query_set(self):
@@ -73,6 +75,133 @@ class ErrorTorrentManager(models.Manager):
         return super(ErrorTorrentManager, self).get_query_set().filter(\
                 Q(status='Error'))
 
+class TorrentManager(models.Manager):
+    def bulk_update_from_torrents(self, torrent_list, torrent_dict):
+        '''Update each torrent of torrent_list from the torrent with the same hash in 
+        torrent_dict ({hash: Torrent}), like update_from_torrent() does.
+        Only the changed fields of the changed torrents are written, in a single transaction.'''
+
+        changed_dict = dict()
+        for torrent in torrent_list:
+            if torrent.hash in torrent_dict:
+                changed_field_dict = torrent.copy_from_torrent(torrent_dict[torrent.hash])
+                if changed_field_dict:
+                    changed_dict[torrent.id] = changed_field_dict
+
+        return self.bulk_update_fields(changed_dict)
+
+    def bulk_set_priority(self, torrent_list, priority_dict):
+        '''Set the priority of each torrent of torrent_list from priority_dict ({torrent_id: priority}),
+        writing only the priorities which changed'''
+
+        changed_dict = dict()
+        for torrent in torrent_list:
+            priority = priority_dict.get(torrent.id)
+            if priority is not None and priority != torrent.priority:
+                torrent.priority = priority
+                changed_dict[torrent.id] = {'priority': priority}
+
+        return self.bulk_update_fields(changed_dict)
+
+    def bulk_update_fields(self, changed_dict):
+        '''Write the changed fields of several torrents in a single transaction
+        changed_dict = {torrent_id: {field_name: new_value, ...}, ...}'''
+
+        from django.db import transaction
+
+        @transaction.commit_on_success
+        def write_changes():
+            for (torrent_id, changed_field_dict) in changed_dict.items():
+                self.filter(id=torrent_id).update(**changed_field_dict)
+
+        if changed_dict:
+            log.debug("Writing changes to %d torrents", len(changed_dict))
+            write_changes()
+
+        return len(changed_dict)
+
+    def claim(self, torrent, worker_id, status):
+        '''Take the lease of a torrent in the given status for a download worker, if no other
+        worker holds a valid lease on it. Returns True if the lease was taken.'''
+
+        from datetime import datetime, timedelta
+
+        now = datetime.now()
+        nb_claimed = self.filter(id=torrent.id, status=status)\
+                .filter(Q(lease_owner='') | Q(lease_owner=worker_id) | Q(lease_expires__lt=now))\
+                .update(lease_owner=worker_id, lease_expires=now + timedelta(seconds=settings.BITTORRENT_LEASE_DURATION))
+
+        if nb_claimed > 0:
+            torrent.lease_owner = worker_id
+            torrent.lease_expires = now + timedelta(seconds=settings.BITTORRENT_LEASE_DURATION)
+            return True
+        else:
+            return False
+
+    def release(self, torrent):
+        '''Release the lease of a torrent'''
+
+        self.filter(id=torrent.id).update(lease_owner='', lease_expires=None)
+        torrent.lease_owner = ''
+        torrent.lease_expires = None
+
+    def renew_leases(self, worker_id):
+        '''Extend the leases of all the torrents held by a download worker'''
+
+        from datetime import datetime, timedelta
+
+        return self.filter(lease_owner=worker_id)\
+                .update(lease_expires=datetime.now() + timedelta(seconds=settings.BITTORRENT_LEASE_DURATION))
+
+    def reclaim_expired_leases(self):
+        '''Put back in the queue the torrents of the download workers which didn't renew their 
+        leases in time (stopped or crashed), for other workers to take them over. The torrents 
+        which were being moved to the library stay in 'Moving', for another worker to finish 
+        the move - or are completed, when all their files are already in DOWNLOAD_DIR.
+        Returns the number of torrents reclaimed'''
+
+        from datetime import datetime
+
+        now = datetime.now()
+        nb_reclaimed = 0
+        for (status, new_status) in [('Downloading metadata', 'New'), ('Downloading', 'Queued')]:
+            nb_reclaimed += self.filter(status=status)\
+                    .exclude(lease_owner='')\
+                    .filter(Q(lease_expires__lt=now) | Q(lease_expires=None))\
+                    .update(status=new_status, last_status_change=now, lease_owner='', lease_expires=None)
+
+        moving_list = self.filter(status='Moving')\
+                .exclude(lease_owner='')\
+                .filter(Q(lease_expires__lt=now) | Q(lease_expires=None))
+        for torrent in moving_list:
+            if settings.SCRATCH_DIR and os.path.exists(os.path.join(settings.SCRATCH_DIR, torrent.name)):
+                new_status = 'Moving'
+            elif os.path.exists(os.path.join(settings.DOWNLOAD_DIR, torrent.name)):
+                new_status = 'Completed'
+            else:
+                log.warn("Files of torrent %s not found, downloading it again", torrent)
+                new_status = 'Queued'
+            nb_reclaimed += self.filter(id=torrent.id, status='Moving', lease_owner=torrent.lease_owner)\
+                    .update(status=new_status, last_status_change=now, lease_owner='', lease_expires=None)
+
+        return nb_reclaimed
+
+    def bulk_set_status(self, torrent_list, new_status):
+        '''Change the status of a list of torrents with a single query, like set_status()'''
+
+        from datetime import datetime
+
+        if not torrent_list:
+            return
+
+        now = datetime.now()
+        self.filter(id__in=[torrent.id for torrent in torrent_list])\
+                .update(status=new_status, last_status_change=now)
+
+        for torrent in torrent_list:
+            torrent.status = new_status
+            torrent.last_status_change = now
+
 class Torrent(models.Model):
     date_added = models.DateTimeField('date added', auto_now_add=True)
     hash = models.CharField('torrent hash/magnet', max_length=200, blank=True, unique=True)
@@ -86,13 +215,22 @@ class Torrent(models.Model):
     peers = models.IntegerField('peers', null=True)
     download_speed = models.CharField('download speed', max_length=20, blank=True)
     upload_speed = models.CharField('upload speed', max_length=20, blank=True)
+    download_rate = models.IntegerField('download rate (bytes/s)', default=0)
+    upload_rate = models.IntegerField('upload rate (bytes/s)', default=0)
     eta = models.IntegerField('remaining download time (seconds)', null=True)
     active_time = models.CharField('active time', max_length=20, blank=True)
     details_url = models.CharField('url of detailled info', max_length=500, blank=True)
     tracker_url_list = models.TextField('urls of trackers (JSON)', blank=True)
     file_list = models.TextField('files in torrent (JSON)', blank=True)
-
-    objects = models.Manager()
+    completed_files = models.TextField('indexes of the completed files (JSON)', blank=True)
+    streaming_file = models.IntegerField('index of the file being streamed', null=True, blank=True)
+    streaming_bytes = models.BigIntegerField('readable bytes from the start of the streamed file', default=0)
+    streaming_requested = models.DateTimeField('last request to stream a file', null=True, blank=True)
+    lease_owner = models.CharField('download worker processing the torrent', max_length=100, blank=True, db_index=True)
+    lease_expires = models.DateTimeField('expiration of the download worker lease', null=True, blank=True)
+    priority = models.FloatField('download priority', default=0)
+
+    objects = TorrentManager()
     processing_objects = ProcessingTorrentManager()
     completed_objects = CompletedTorrentManager()
     error_objects = ErrorTorrentManager()
@@ -139,19 +277,138 @@ class Torrent(models.Model):
 
         log.debug("Updating torrent %s from torrent %s", self, torrent)
 
-        self.has_metadata = torrent.has_metadata
-        self.name = sane_text(torrent.name, length=200)
-        self.progress = torrent.progress
-        self.download_speed = sane_text(torrent.download_speed, length=20)
-        self.upload_speed = sane_text(torrent.upload_speed, length=20)
-        self.eta = torrent.eta
-        self.active_time = sane_text(torrent.active_time, length=20)
-        self.seeds = torrent.seeds
-        self.peers = torrent.peers
-        self.file_list = sane_text(torrent.file_list)
-
+        self.copy_from_torrent(torrent)
         self.save()
 
+    def copy_from_torrent(self, torrent):
+        '''Copy attributes from another torrent, without saving. 
+        Returns a dict of the fields whose value changed {field_name: new_value}'''
+
+        value_dict = {
+            'has_metadata': torrent.has_metadata,
+            'name': sane_text(torrent.name, length=200),
+            'progress': torrent.progress,
+            'download_speed': sane_text(torrent.download_speed, length=20),
+            'upload_speed': sane_text(torrent.upload_speed, length=20),
+            'download_rate': torrent.download_rate,
+            'upload_rate': torrent.upload_rate,
+            'eta': torrent.eta,
+            'active_time': sane_text(torrent.active_time, length=20),
+            'seeds': torrent.seeds,
+            'peers': torrent.peers,
+        }
+
+        # The files list doesn't change once known, avoid converting it again
+        if torrent.file_list != self.file_list:
+            value_dict['file_list'] = sane_text(torrent.file_list)
+        if torrent.completed_files != self.completed_files:
+            value_dict['completed_files'] = torrent.completed_files
+
+        changed_dict = dict()
+        for (field_name, value) in value_dict.items():
+            if getattr(self, field_name) != value:
+                setattr(self, field_name, value)
+                changed_dict[field_name] = value
+
+        return changed_dict
+
+    def is_episode_completed(self, episode):
+        '''Check if the files of an episode have all been downloaded (and verified by libtorrent),
+        even if the rest of the torrent is still downloading. With SCRATCH_DIR, only once the 
+        torrent is completed: the videos and their transcodes are stored relative to DOWNLOAD_DIR, 
+        and the files are only moved there once the whole torrent is downloaded.'''
+
+        from wall.torrentmagic import TorrentFileMagic
+        import json
+
+        if self.status == 'Completed':
+            return True
+        elif self.status != 'Downloading' or not self.completed_files:
+            return False
+        elif settings.SCRATCH_DIR:
+            # Not in the library yet
+            return False
+
+        completed_file_set = set(json.loads(self.completed_files))
+        file_index_list = TorrentFileMagic(self).get_episode_file_index_list(episode)
+
+        return len(file_index_list) > 0 and completed_file_set.issuperset(file_index_list)
+
+    def get_storage_dir(self):
+        '''Directory containing the files of the torrent - SCRATCH_DIR until the torrent
+        has been moved to the library (DOWNLOAD_DIR) once completed'''
+
+        if settings.SCRATCH_DIR and self.status in ('Downloading', 'Moving'):
+            return settings.SCRATCH_DIR
+        else:
+            return settings.DOWNLOAD_DIR
+
+    def is_transcoded(self):
+        '''Check if the videos of all the episodes of the torrent have been transcoded - the 
+        downloaded files are not needed anymore then'''
+
+        episode_list = list(self.episode_set.select_related('video'))
+        if not episode_list:
+            return False
+
+        for episode in episode_list:
+            if episode.video is None or episode.video.status != 'Completed':
+                return False
+
+        return True
+
+    def release_episodes(self):
+        '''Detach the episodes which don't have a video yet from the torrent, for them to be
+        searched again. Returns the number of episodes released.'''
+
+        for episode in self.episode_set.filter(video=None):
+            TorrentCandidate.objects.prune_candidates(episode)
+
+        return self.episode_set.filter(video=None).update(torrent=None)
+
+    def promote_candidates(self):
+        '''Move the episodes which don't have a video yet to the next result of their search, 
+        when this torrent failed. The episodes which ran out of results are searched again 
+        right away, from the next page of results. Returns the number of episodes moved.'''
+
+        nb_episodes = 0
+        for episode in self.episode_set.filter(video=None):
+            next_torrent = TorrentCandidate.objects.get_next_torrent(episode)
+            if next_torrent is not None:
+                log.info("Falling back to torrent %s for episode %s", next_torrent, episode)
+                episode.torrent = next_torrent
+                episode.save()
+                nb_episodes += 1
+            else:
+                log.info("No search result left for episode %s, searching again", episode)
+                TorrentCandidate.objects.prune_candidates(episode)
+                episode.next_search = None
+                episode.save()
+
+        return nb_episodes
+
+    def get_download_size(self):
+        '''Estimate of the bytes the torrent downloads, from its files list - for season 
+        torrents, only the files of the episodes which don't have a video yet'''
+
+        from wall.torrentmagic import TorrentFileMagic
+
+        file_magic = TorrentFileMagic(self)
+        size_list = [torrent_file['size'] for torrent_file in file_magic.file_list]
+
+        if self.type == 'season':
+            priority_list = file_magic.get_file_priority_list(list(self.episode_set.filter(video=None)))
+            if priority_list is not None:
+                size_list = [size for (size, priority) in zip(size_list, priority_list) if priority > 0]
+
+        return sum(size_list)
+
+    def get_remaining_size(self):
+        '''Estimate of the bytes left to download'''
+
+        progress = min(max(self.progress, 0.0), 1.0)
+        return int(self.get_download_size() * (1.0 - progress))
+
     def get_episode_video(self, episode):
         '''Locate a specific episode in a completed torrent'''
 
@@ -169,6 +426,95 @@ class Torrent(models.Model):
         return video
 
 
+# TransferSample ######################
+
+SAMPLE_RESOLUTIONS = (
+    ('minute', 'Minute'),
+    ('hour', 'Hour'),
+)
+
+class TransferSampleManager(models.Manager):
+    def get_session_stats(self, resolution, since):
+        '''Average & peak transfer rates of the whole session since a given date,
+        from the samples of the given resolution - the rates of all the download workers
+        are added up for each period, then averaged over time. Returns a dict of rates in bytes/s.'''
+
+        if resolution == 'minute':
+            period_list = self.get_session_minutes(since)
+        else:
+            period_list = self.get_session_hours(since)
+
+        stats = {'avg_download_rate': 0.0, 'avg_upload_rate': 0.0, 'max_download_rate': 0.0}
+        if period_list:
+            stats['avg_download_rate'] = sum([period['download_rate'] for period in period_list]) / len(period_list)
+            stats['avg_upload_rate'] = sum([period['upload_rate'] for period in period_list]) / len(period_list)
+            stats['max_download_rate'] = max([period['max_download_rate'] for period in period_list])
+
+        return stats
+
+    def get_session_minutes(self, since, until=None):
+        '''Transfer rates of the whole session for each minute since a given date (until another
+        one), summed over the download workers - each of them stores its own samples. Returns a list 
+        of dicts of rates in bytes/s, with the date, number of samples & session profile of each
+        minute - the profile is empty when the workers didn't use the same one.'''
+
+        sample_list = self.filter(torrent=None, resolution='minute', date__gte=since)
+        if until is not None:
+            sample_list = sample_list.filter(date__lt=until)
+
+        minute_dict = dict()
+        for sample in sample_list.values('date', 'profile', 'download_rate', 'upload_rate', 'max_download_rate', 'nb_samples'):
+            minute = minute_dict.get(sample['date'])
+            if minute is None:
+                minute_dict[sample['date']] = dict(sample)
+                continue
+
+            for key in ['download_rate', 'upload_rate', 'max_download_rate', 'nb_samples']:
+                minute[key] += sample[key]
+            if minute['profile'] != sample['profile']:
+                minute['profile'] = ''
+
+        return sorted(minute_dict.values(), key=lambda minute: minute['date'])
+
+    def get_session_hours(self, since):
+        '''Transfer rates of the whole session for each hour since a given date. The hours
+        during which the session profile changed have one sample per profile, which are averaged
+        by their number of samples. Returns a list of dicts of rates in bytes/s, with the date.'''
+
+        sample_dict = dict()
+        for sample in self.filter(torrent=None, resolution='hour', date__gte=since)\
+                .values('date', 'download_rate', 'upload_rate', 'max_download_rate', 'nb_samples'):
+            sample_dict.setdefault(sample['date'], list()).append(sample)
+
+        hour_list = list()
+        for (date, sample_list) in sorted(sample_dict.items()):
+            weight_list = [max(sample['nb_samples'], 1) for sample in sample_list]
+            hour = {'date': date, 'max_download_rate': max([sample['max_download_rate'] for sample in sample_list])}
+            for key in ['download_rate', 'upload_rate']:
+                hour[key] = sum([sample[key]*weight for (sample, weight) in zip(sample_list, weight_list)]) / sum(weight_list)
+            hour_list.append(hour)
+
+        return hour_list
+
+class TransferSample(models.Model):
+    '''Average transfer rates of a torrent - or of the whole session when torrent is None - 
+    over one minute or one hour'''
+
+    date = models.DateTimeField('start of the period', db_index=True)
+    resolution = models.CharField('length of the period', max_length=10, choices=SAMPLE_RESOLUTIONS)
+    torrent = models.ForeignKey(Torrent, null=True)
+    download_rate = models.FloatField('average download rate (bytes/s)', default=0)
+    upload_rate = models.FloatField('average upload rate (bytes/s)', default=0)
+    max_download_rate = models.FloatField('peak download rate (bytes/s)', default=0)
+    nb_samples = models.IntegerField('number of samples', default=0)
+    profile = models.CharField('session profile', max_length=20, blank=True)
+
+    objects = TransferSampleManager()
+
+    def __unicode__(self):
+        return ("%s %s %s" % (self.date, self.resolution, self.torrent_id))
+
+
 # Video ###############################
 
 VIDEO_STATUSES = (
@@ -178,6 +524,7 @@ VIDEO_STATUSES = (
     ('Completed', 'Completed'),
     ('Error', 'Error'),
     ('Not found', 'Not found'),
+    ('Evicted', 'Evicted'),
 )
 
 class ProcessingVideoManager(models.Manager):
@@ -198,6 +545,11 @@ class ErrorVideoManager(models.Manager):
                 Q(status='Not found') | \
                 Q(status='Error'))
 
+class EvictedVideoManager(models.Manager):
+    def get_query_set(self):
+        return super(EvictedVideoManager, self).get_query_set().filter(\
+                Q(status='Evicted'))
+
 class VideoManager(models.Manager):
     def get_not_found_video(self):
         '''Returns a "Not found" Video object'''
@@ -215,11 +567,14 @@ class Video(models.Model):
     mp4_path = models.CharField('file path (MP4)', max_length=500, blank=True)
     ogv_path = models.CharField('file path (OGV)', max_length=500, blank=True)
     image_path = models.CharField('file path (image)', max_length=500, blank=True)
+    original_evicted = models.BooleanField('original file deleted to free space', default=False)
+    last_watched = models.DateTimeField('last time watched', null=True, blank=True)
 
     objects = VideoManager()
     processing_objects = ProcessingVideoManager()
     completed_objects = CompletedVideoManager()
     error_objects = ErrorVideoManager()
+    evicted_objects = EvictedVideoManager()
 
     def __unicode__(self):
         return ("%s %s" % (self.original_path, self.status))
@@ -482,6 +837,7 @@ class ProcessingEpisodeManager(models.Manager):
                 Q(torrent__status='New') | \
                 Q(torrent__status='Queued') | \
                 Q(torrent__status='Downloading') | \
+                Q(torrent__status='Moving') | \
                 Q(video__status='New') | \
                 Q(video__status='Queued') | \
                 Q(video__status='Transcoding'))
@@ -499,6 +855,20 @@ class ErrorEpisodeManager(models.Manager):
                 Q(video__status='Not found') | \
                 Q(video__status='Error'))
 
+class EvictedEpisodeManager(models.Manager):
+    def get_query_set(self):
+        return super(EvictedEpisodeManager, self).get_query_set().filter(\
+                Q(video__status='Evicted'))
+
+    def requeue_series(self, series):
+        '''Download again the evicted videos of a series'''
+
+        episode_list = self.filter(season__series=series).select_related('torrent')
+        for episode in episode_list:
+            episode.requeue()
+
+        return len(episode_list)
+
 class Episode(models.Model):
     date_added = models.DateTimeField('date added', auto_now_add=True)
     number = models.IntegerField('number')
@@ -518,11 +888,15 @@ class Episode(models.Model):
     imdb_id = models.CharField('imdb id', max_length=50, blank=True)
     tvdb_last_updated = models.DateTimeField('last updated on tvdb', null=True) 
     watched = models.BooleanField('watched', default=False)
+    search_attempts = models.IntegerField('failed torrent searches in a row', default=0)
+    next_search = models.DateTimeField('next torrent search', null=True, blank=True)
+    last_retry = models.DateTimeField('last torrent search retry', null=True, blank=True)
 
     objects = models.Manager()
     processing_objects = ProcessingEpisodeManager()
     completed_objects = CompletedEpisodeManager()
     error_objects = ErrorEpisodeManager()
+    evicted_objects = EvictedEpisodeManager()
 
     def __unicode__(self):
         return ("%s (number %d)" % (self.season, self.number))
@@ -566,15 +940,46 @@ class Episode(models.Model):
             log.exception("Error while searching for torrent for episode %s", self)
             self.torrent = Torrent(status='Error')
             self.torrent.save()
-        self.save()
 
         if self.torrent.status == 'Error':
             log.warn('Could not find torrent for episode %s', self)
+            self.schedule_search()
         else:
             log.info("Torrent search for episode %s returned %s", self, self.torrent)
+            self.search_attempts = 0
+            self.next_search = None
+        self.save()
 
         return self.torrent
 
+    def search_again(self):
+        '''Search for a new torrent, when the previous one couldn't be found or downloaded'''
+
+        from datetime import datetime
+
+        log.info("Searching again for the torrent of episode %s (%d failed searches)", self, self.search_attempts)
+        self.last_retry = datetime.now()
+        self.torrent = None
+        return self.find_torrent()
+
+    def schedule_search(self, now=None):
+        '''Set the time of the next search for a torrent after a failed one, with an exponential
+        backoff - TORRENT_RESEARCH_DELAY, doubled after each failed search in a row, up to 
+        TORRENT_RESEARCH_MAX_DELAY. The random jitter spreads the searches of episodes
+        which failed together.'''
+
+        from datetime import datetime, timedelta
+        import random
+
+        if now is None:
+            now = datetime.now()
+
+        self.search_attempts += 1
+        delay = min(settings.TORRENT_RESEARCH_MAX_DELAY, \
+                settings.TORRENT_RESEARCH_DELAY * 2**min(self.search_attempts-1, 32))
+        delay *= random.uniform(1 - settings.TORRENT_RESEARCH_JITTER, 1 + settings.TORRENT_RESEARCH_JITTER)
+        self.next_search = now + timedelta(seconds=delay)
+
     def get_or_create_video(self):
         '''Get the video for this episode, if there is a completed torrent'''
 
@@ -583,15 +988,18 @@ class Episode(models.Model):
             log.info("Video already found %s", self.video)
             return self.video
 
-        # Otherwise try to get it from the torrent file
-        if self.torrent is not None and self.torrent.status == 'Completed':
-            try:
-                self.video = self.torrent.get_episode_video(self)
-            except:
-                log.exception("Error while searching for video for episode %s in torrent %s", self, self.torrent)
-                self.video = Video(status='Error')
-                self.video.save()
-            self.save()
+        # Otherwise try to get it from the torrent file, as soon as the episode files are downloaded
+        if self.torrent is None or not self.torrent.is_episode_completed(self):
+            return None
+
+        try:
+            self.video = self.torrent.get_episode_video(self)
+        except:
+            log.exception("Error while searching for video for episode %s in torrent %s", self, self.torrent)
+            self.video = Video(status='Error')
+            self.video.save()
+        self.save()
+        TorrentCandidate.objects.prune_candidates(self)
 
         if self.video.status == 'Error' or self.video.status == 'Not found':
             log.warn('Could not find video for episode %s in torrent %s', self, self.torrent)
@@ -600,6 +1008,60 @@ class Episode(models.Model):
 
         return self.video
 
+    def get_streaming_file_index(self):
+        '''Returns the index of the video file of this episode in its torrent, None if it can't 
+        be streamed. Doesn't start the streaming, see request_streaming().'''
+
+        from wall.torrentmagic import TorrentFileMagic
+
+        torrent = self.torrent
+        if torrent is None or not torrent.file_list or \
+                torrent.status not in ('Queued', 'Downloading', 'Completed'):
+            return None
+
+        return TorrentFileMagic(torrent).get_episode_video_file_index(self)
+
+    def requeue(self):
+        '''Download the video of this episode again, once its files were evicted to free space.
+        Its torrent is downloaded again when it is completed, searched again otherwise.'''
+
+        log.info("Downloading evicted episode %s again", self)
+
+        if self.torrent is not None and self.torrent.status == 'Completed':
+            self.torrent.progress = 0.0
+            self.torrent.set_status('New')
+        else:
+            self.torrent = None
+            self.search_attempts = 0
+            self.next_search = None
+
+        self.video = None
+        self.save()
+
+    def request_streaming(self):
+        '''Ask the download manager to download the video of this episode first, in order, 
+        to be able to watch it while the rest of the torrent downloads
+        Returns the index of the video file in the torrent, None if it can't be streamed'''
+
+        from datetime import datetime
+
+        file_index = self.get_streaming_file_index()
+        if file_index is None:
+            return None
+
+        torrent = self.torrent
+        if torrent.status != 'Completed':
+            if torrent.streaming_file != file_index:
+                log.info("Streaming requested for episode %s in torrent %s", self, torrent)
+                torrent.streaming_bytes = 0
+            torrent.streaming_file = file_index
+            torrent.streaming_requested = datetime.now()
+            # Don't overwrite the fields updated concurrently by the download manager
+            Torrent.objects.filter(id=torrent.id).update(streaming_file=torrent.streaming_file, \
+                    streaming_bytes=torrent.streaming_bytes, streaming_requested=torrent.streaming_requested)
+
+        return file_index
+
     def next_episode(self):
         pass
 
@@ -607,6 +1069,127 @@ class Episode(models.Model):
         pass
 
 
+# TorrentCandidate ####################
+
+class TorrentCandidateManager(models.Manager):
+    def save_candidates(self, torrent_list, episode=None, season=None):
+        '''Store the ranked search results for an episode or a season, replacing the previous ones'''
+
+        self.filter(episode=episode, season=season).delete()
+        for (rank, torrent) in enumerate(torrent_list[:settings.TORRENT_SEARCH_MAX_CANDIDATES]):
+            self.create(episode=episode, season=season, rank=rank, hash=torrent.hash, name=torrent.name, \
+                    type=torrent.type, seeds=torrent.seeds, peers=torrent.peers)
+
+    def prune_candidates(self, episode):
+        '''Delete the search results for an episode, once it got its video or needs to be searched
+        again - and the ones for its season, once none of the season episodes need them'''
+
+        self.filter(episode=episode).delete()
+        if not Episode.objects.filter(season=episode.season_id, video=None).exists():
+            self.filter(season=episode.season_id).delete()
+
+    def get_next_torrent(self, episode):
+        '''Returns the torrent of the best search result for an episode (or its season) which
+        didn't fail to download yet, or None if all of them did'''
+
+        candidate_list = list(self.filter(Q(episode=episode) | Q(season=episode.season_id)).order_by('rank', 'id'))
+        failed_hash_set = set(Torrent.objects.filter(status='Error', \
+                hash__in=[candidate.hash for candidate in candidate_list]).values_list('hash', flat=True))
+
+        for candidate in candidate_list:
+            if candidate.hash not in failed_hash_set:
+                return candidate.get_torrent()
+
+        return None
+
+    def get_episode_candidates(self, episode_list):
+        '''Search results for the episodes of episode_list, or for their seasons'''
+
+        return self.filter(Q(episode__in=[episode.id for episode in episode_list]) | \
+                Q(season__in=[episode.season_id for episode in episode_list]))
+
+    def get_prefetch_hash_list(self, torrent):
+        '''Returns the hashes of the TORRENT_PREFETCH_CANDIDATES best search results for the
+        episodes of a torrent, other than it, whose metadata hasn't been retreived yet'''
+
+        episode_list = list(torrent.episode_set.filter(video=None))
+        if not episode_list:
+            return list()
+
+        candidate_list = list(self.get_episode_candidates(episode_list)\
+                .filter(rank__lt=settings.TORRENT_PREFETCH_CANDIDATES, file_list='')\
+                .exclude(hash=torrent.hash)\
+                .order_by('rank', 'id'))
+
+        # Torrents already known are being downloaded, or failed
+        known_hash_set = set(Torrent.objects.filter(hash__in=[candidate.hash for candidate in candidate_list])\
+                .values_list('hash', flat=True))
+
+        hash_list = list()
+        for candidate in candidate_list:
+            if candidate.hash not in known_hash_set and candidate.hash not in hash_list:
+                hash_list.append(candidate.hash)
+
+        return hash_list
+
+    def get_best_prefetched(self, torrent, episode_list):
+        '''Returns the prefetched search result with the best files for the episodes of
+        episode_list (see TorrentFileMagic.get_score()), as a (candidate, score) tuple -
+        (None, None) when none of them has been prefetched'''
+
+        from wall.torrentmagic import TorrentFileMagic
+
+        candidate_list = list(self.get_episode_candidates(episode_list)\
+                .exclude(file_list='')\
+                .exclude(hash=torrent.hash)\
+                .order_by('rank', 'id'))
+        failed_hash_set = set(Torrent.objects.filter(status='Error', \
+                hash__in=[candidate.hash for candidate in candidate_list]).values_list('hash', flat=True))
+
+        best_candidate = None
+        best_score = None
+        for candidate in candidate_list:
+            if candidate.hash in failed_hash_set:
+                continue
+
+            score = TorrentFileMagic(candidate).get_score(episode_list)
+            if best_score is None or score > best_score:
+                (best_candidate, best_score) = (candidate, score)
+
+        return (best_candidate, best_score)
+
+class TorrentCandidate(models.Model):
+    '''Result of a torrent search for an episode or a season, kept to fall back on
+    the next result without searching again when the download of a torrent fails'''
+
+    date_added = models.DateTimeField('date added', auto_now_add=True)
+    episode = models.ForeignKey(Episode, null=True, blank=True)
+    season = models.ForeignKey(Season, null=True, blank=True)
+    rank = models.IntegerField('rank in the search results')
+    hash = models.CharField('torrent hash/magnet', max_length=200)
+    name = models.CharField('name', max_length=200, blank=True)
+    type = models.CharField('type', max_length=20, choices=TORRENT_TYPES, blank=True)
+    seeds = models.IntegerField('seeds', null=True)
+    peers = models.IntegerField('peers', null=True)
+    file_list = models.TextField('list of files', blank=True) # Once its metadata has been prefetched
+
+    objects = TorrentCandidateManager()
+
+    def __unicode__(self):
+        return ("%s (rank %d for %s)" % (self.name, self.rank, self.episode or self.season))
+
+    def get_torrent(self):
+        '''Returns the torrent of this search result, creating it if needed'''
+
+        try:
+            return Torrent.objects.get(hash=self.hash)
+        except Torrent.DoesNotExist:
+            torrent = Torrent(hash=self.hash, name=self.name, type=self.type, \
+                    seeds=self.seeds, peers=self.peers, file_list=self.file_list)
+            torrent.save()
+            return torrent
+
+
 # Post ################################
 
 class Post(models.Model):
@@ -25,6 +25,7 @@ from django.conf import settings
 
 from wall.models import Torrent, Episode, Video
 from wall.helpers import sane_text
+from wall.torrentmagic import clean_name, match_episode_number
 
 import re
 import subprocess
@@ -50,9 +51,12 @@ class PackageManager:
         '''Perform the maintenance'''
 
         # Get episodes for which we have a completed torrent but no video
+        # Torrents still downloading can already have the files of some episodes completed
         episode_list = Episode.objects.filter(\
                 Q(video=None))\
-                .filter(torrent__status__exact='Completed')\
+                .filter(Q(torrent__status__exact='Completed') | \
+                        (Q(torrent__status__exact='Downloading') & ~Q(torrent__completed_files='') & \
+                         ~Q(torrent__completed_files='[]')))\
                 .order_by('date_added')
 
         for episode in episode_list:
@@ -78,7 +82,7 @@ class Package:
     def get_torrent_path(self):
         '''Full system path of the torrent files root'''
 
-        return os.path.join(settings.DOWNLOAD_DIR, self.torrent.name)
+        return os.path.join(self.torrent.get_storage_dir(), self.torrent.name)
 
 
 class MultiSeasonPackage(Package):
@@ -146,7 +150,7 @@ class SeasonPackage(Package):
     def clean_name(self, name):
         '''Replace separators by a single space'''
 
-        return re.sub(r'[_\W]+', ' ', name).strip()
+        return clean_name(name)
 
     def find_episode_package(self, episode, sub_path=''):
         '''Locates the package of a specific episode within the current package'''
@@ -167,9 +171,7 @@ class SeasonPackage(Package):
 
             # Try to match the file/dirs against the episode number
             if re.search(clean_episode_name, clean_filename, re.IGNORECASE) \
-                or re.search(r"\bs* *0*%d *[xe]* *0*%d\b" % (season.number, episode.number), clean_filename, re.IGNORECASE) \
-                or re.search(r"\bseason *0*%d *episode *0*%d\b" % (season.number, episode.number), clean_filename, re.IGNORECASE) \
-                or re.search(r"(^|[^0-9 ] +)0*%d +[^0-9 ]" % episode.number, clean_filename, re.IGNORECASE):
+                or match_episode_number(season.number, episode.number, clean_filename):
                 # Check that this is a video or a folder
                 (file_type, file_encoding) = mimetypes.guess_type(os.path.join(self.full_path, sub_path, filename))
                 if (file_type is not None and file_type.startswith('video')) \
@@ -21,12 +21,22 @@
 # Includes ##########################################################
 
 from djangoplugins.point import PluginPoint
+from djangoplugins.models import Plugin, PluginPoint as PluginPointModel
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
 
-from wall.models import Torrent, Series
+from wall.models import Torrent, TorrentCandidate, Series
 from wall.torrentmagic import TorrentMagic
+from wall.trackerscraper import TrackerScraper
+from wall.searchcache import search_cache
 import wall.helpers
 
 import urllib
+import threading
+import itertools
+import Queue
+import time
+import copy
 
 
 # Logging ###########################################################
@@ -35,6 +45,13 @@ from plebia.log import get_logger
 log = get_logger(__name__)
 
 
+# Globals ###########################################################
+
+# Active plugins of each plugin point, by order - {plugin_point: (expiration time, [plugin, ...])}
+plugin_registry = dict()
+plugin_registry_lock = threading.Lock()
+
+
 # Exceptions ########################################################
 
 class NoActivePlugin(Exception):
@@ -51,28 +68,81 @@ def get_active_plugin(plugin_point):
     '''For a given PluginPoint, return the active plugin with the
     lowest order. NoActivePlugin exception is raised if no plugin is found'''
 
-    active_plugins = plugin_point.get_plugins_qs()
-    if len(active_plugins) < 1:
+    plugin_list = get_active_plugin_list(plugin_point)
+    if len(plugin_list) < 1:
         raise NoActivePlugin(plugin_point)
     
-    plugin = active_plugins[0].get_plugin()
+    plugin = plugin_list[0]
     log.debug("Selecting plugin %s for plugin point %s", plugin, plugin_point)
 
     return plugin
 
+def get_active_plugin_list(plugin_point):
+    '''For a given PluginPoint, return all the active plugins, by order
+    The plugins are only loaded once per process, until the plugins tables change - or 
+    after PLUGIN_REGISTRY_TTL seconds, for the changes made by other processes'''
+
+    with plugin_registry_lock:
+        entry = plugin_registry.get(plugin_point)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+
+    plugin_list = [active_plugin.get_plugin() for active_plugin in plugin_point.get_plugins_qs()]
+    log.debug("Loaded plugins %s for plugin point %s", plugin_list, plugin_point)
+
+    with plugin_registry_lock:
+        plugin_registry[plugin_point] = (time.time() + settings.PLUGIN_REGISTRY_TTL, plugin_list)
+
+    return plugin_list
+
+def clear_plugin_registry(sender=None, **kwargs):
+    '''Forget the loaded plugins, when the plugins tables change'''
+
+    with plugin_registry_lock:
+        plugin_registry.clear()
+
+post_save.connect(clear_plugin_registry, sender=Plugin)
+post_delete.connect(clear_plugin_registry, sender=Plugin)
+post_save.connect(clear_plugin_registry, sender=PluginPointModel)
+post_delete.connect(clear_plugin_registry, sender=PluginPointModel)
+
+def get_int(value):
+    '''Number of seeds or peers of a search result - the engines don't always give one'''
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
 # TorrentSearcher ###################################################
 
 class TorrentSearcher(PluginPoint):
     """
     Finds and builds the Torrent object for a given episode or season
 
-    Must expose the following method:
+    Must expose one of the following methods:
+
+        def iter_torrent_by_string(self, name, episode_search_string=None):
+            '''Search engine results matching "<name>" AND "<episode_search_string>", yielded
+            page by page - the next page is only retrieved if the consumer asks for more'''
+
+            yield Torrent
 
         def search_torrent_by_string(self, name, episode_search_string):
-            '''Search engine for a list of results matching "<name>" AND "<episode_search_string>"'''
+            '''Search engine for a list of results matching "<name>" AND "<episode_search_string>"
+            Plugins which only expose this method are used through iter_torrent_by_string()'''
 
             return (Torrent, Torrent, ...) or None
 
+    Can also expose the following method, to resume a search from a given page of results
+    when more results than the ones cached are needed:
+
+        def iter_result_pages(self, name, episode_search_string=None, start_page=0):
+            '''Search engine results matching "<name>" AND "<episode_search_string>", yielded
+            as a list per page, from start_page (the first one is 0)'''
+
+            yield [Torrent, Torrent, ...]
+
     Can override the following method:
 
         def get_tracker_list_for_torrent(self, torrent):
@@ -82,6 +152,75 @@ class TorrentSearcher(PluginPoint):
             return ('http://...', 'http://...', ...)
     """
     
+    def is_failed_torrent(self, torrent):
+        '''Check if a search result is a torrent which already failed to download'''
+
+        return torrent.hash is not None and Torrent.objects.filter(hash=torrent.hash, status='Error').exists()
+
+    def get_search_results(self, name, episode_search_string=None):
+        '''Generator of the search results, from get_search_result_pages()'''
+
+        page_iter = self.get_search_result_pages(name, episode_search_string)
+        try:
+            for page_list in page_iter:
+                for torrent in page_list:
+                    yield torrent
+        finally:
+            page_iter.close()
+
+    def get_search_result_pages(self, name, episode_search_string=None):
+        '''Generator of the pages of results of iter_result_pages(), from the search cache when 
+        the same search was made recently on the same engine - the results already cached are
+        returned as the first page. Only the pages of results consumed are retrieved & cached - 
+        the engine is queried from the next page when more results are needed.'''
+
+        key = search_cache.get_key(self.__class__.__name__, name, episode_search_string)
+        (cached_list, is_complete, next_page) = search_cache.get_partial(key)
+        if cached_list is None:
+            (cached_list, is_complete, next_page) = (list(), False, 0)
+        else:
+            log.info("Reusing %d results of the search for %s", len(cached_list), key)
+
+        if is_complete:
+            yield cached_list
+            return
+
+        # The results are modified & saved by the searches
+        result_list = copy.deepcopy(cached_list)
+        if cached_list:
+            yield cached_list
+
+        try:
+            for page_list in self.iter_result_pages(name, episode_search_string, start_page=next_page):
+                result_list += copy.deepcopy(page_list)
+                next_page += 1
+                yield page_list
+            is_complete = True
+        finally:
+            # Also when the consumer stops early
+            search_cache.set(key, result_list, is_complete=is_complete, next_page=next_page)
+
+    def iter_result_pages(self, name, episode_search_string=None, start_page=0):
+        '''Generator of the pages of search results, as lists, from start_page (the first one 
+        is 0) - compatibility with the plugins which don't retrieve their results by page'''
+
+        if start_page > 0:
+            return
+
+        yield list(self.iter_torrent_by_string(name, episode_search_string))
+
+    def iter_torrent_by_string(self, name, episode_search_string=None):
+        '''Generator of the search results - compatibility with the plugins which only
+        expose search_torrent_by_string(), returning all their results at once'''
+
+        if episode_search_string is None:
+            torrent_list = self.search_torrent_by_string(name)
+        else:
+            torrent_list = self.search_torrent_by_string(name, episode_search_string)
+
+        for torrent in torrent_list or list():
+            yield torrent
+
     def search_torrent_by_string(self, name, episode_search_string):
         '''Returns search results as a list of Torrent() objects,
         by decreasing number of seeds.
@@ -92,14 +231,23 @@ class TorrentSearcher(PluginPoint):
     def search_season_torrent_dict(self, series):
         '''For a given series, try to find season torrents for each of its seasons
         returns: {1: torrent_object, 2: torrent_object, etc.}
-        Season number not found are not included in the returned dict'''
+        Season number not found are not included in the returned dict
+        The other matching results are kept as candidates for each season, by rank'''
 
-        # Run search engine query
-        torrent_list = self.search_torrent_by_string(wall.helpers.normalize_text(series.name))
+        # Run search engine query - the results are retrieved as they are processed, 
+        # and only the usable ones are ranked
+        torrent_list = self.get_search_results(wall.helpers.normalize_text(series.name))
+        torrent_list = itertools.ifilter(lambda torrent: self.is_usable_season_result(torrent, series), torrent_list)
+        torrent_list = self.rank_by_swarm_health(torrent_list)
 
         nb_seasons = series.season_set.count()
         season_torrent_dict = dict()
+        season_candidate_dict = dict()
         for torrent in torrent_list:
+            # No need to retrieve more results once all the seasons were found
+            if len(season_torrent_dict) >= nb_seasons:
+                break
+
             torrent.type = 'season'
 
             # Stop processing the list when we reach low seeds torrent results
@@ -111,31 +259,25 @@ class TorrentSearcher(PluginPoint):
             # the information we have gathered about it so far
             torrent_details = TorrentMagic(torrent, series_name=series.name)
 
-            # Filter out unrelated or unusable results, and partial seasons
-            if torrent_details.similar_series or \
-                    torrent_details.iso or \
-                    torrent_details.other_language or \
-                    torrent_details.partial_season or \
-                    torrent_details.unrelated_series:
-                log.info('Bad result "%s", continuing', torrent)
-                continue
-
             # Torrents that contain all seasons
             if torrent_details.complete_series:
-                log.info('All seasons found in torrent "%s", stopping', torrent)
+                log.info('All seasons found in torrent "%s"', torrent)
+                nb_season_used = 0
                 for season in series.season_set.all():
+                    season_candidate_dict.setdefault(season.number, list()).append(torrent)
                     # Check the season hasn't been added yet
                     if season.number not in season_torrent_dict:
                         season_torrent_dict[season.number] = torrent
+                        nb_season_used += 1
                     else:
                         log.info('Season %d already found for torrent "%s"', season.number, torrent)
                 
-                # Keep this torrent
-                torrent = self.update_torrent_with_tracker_list(torrent)
-                torrent.save()
+                # Keep this torrent only if we need it - the next results are only candidates
+                if nb_season_used >= 1:
+                    torrent = self.update_torrent_with_tracker_list(torrent)
+                    torrent.save()
 
-                # No need for more seasons
-                break
+                continue
 
             # Torrents that contain one or several seasons
             if len(torrent_details.season_number_list) >= 1:
@@ -143,7 +285,10 @@ class TorrentSearcher(PluginPoint):
                 nb_season_used = 0
                 for season_number in torrent_details.season_number_list:
                     # Make sure the season numbers exist & hasn't been found yet
-                    if series.season_set.filter(number=season_number).count() == 1 and season_number not in season_torrent_dict:
+                    if series.season_set.filter(number=season_number).count() != 1:
+                        continue
+                    season_candidate_dict.setdefault(season_number, list()).append(torrent)
+                    if season_number not in season_torrent_dict:
                         season_torrent_dict[season_number] = torrent
                         nb_season_used += 1
                     else:
@@ -156,13 +301,32 @@ class TorrentSearcher(PluginPoint):
 
                 continue
 
-            # Stop processing when we have all the seasons
-            if len(season_torrent_dict) >= nb_seasons:
-                log.info('Found all seasons for series "%s", stopping', series)
-                break
+        # Keep the results to fall back on if the download of a torrent fails
+        for (season_number, candidate_list) in season_candidate_dict.items():
+            TorrentCandidate.objects.save_candidates(candidate_list, season=series.season_set.get(number=season_number))
 
         return season_torrent_dict
 
+    def is_usable_season_result(self, torrent, series):
+        '''Check if a result of the search for the seasons of series could be used - unrelated 
+        or unusable results, partial seasons and failed downloads are not'''
+
+        # Don't retry torrents which couldn't be downloaded
+        if self.is_failed_torrent(torrent):
+            log.info('Failed download "%s", continuing', torrent)
+            return False
+
+        torrent_details = TorrentMagic(torrent, series_name=series.name)
+        if torrent_details.similar_series or \
+                torrent_details.iso or \
+                torrent_details.other_language or \
+                torrent_details.partial_season or \
+                torrent_details.unrelated_series:
+            log.info('Bad result "%s", continuing', torrent)
+            return False
+
+        return True
+
     def search_episode_torrent(self, episode):
         '''Find a torrent for the provided episode, returns the Torrent object'''
 
@@ -171,16 +335,34 @@ class TorrentSearcher(PluginPoint):
 
         # Run search engine query
         search_string = "s%02de%02d" % (season.number, episode.number)
-        torrent_list = self.search_torrent_by_string(wall.helpers.normalize_text(series.name), search_string)
+        page_iter = self.get_search_result_pages(wall.helpers.normalize_text(series.name), search_string)
         
-        # Isolate the right torrent
-        torrent = None
-        for torrent_result in torrent_list:
-            if torrent_result.hash is None or torrent_result.seeds is None or torrent_result.seeds <= 0:
-                log.info("Discarded result for lack of seeds or hash: %s", torrent_result)
-            else:
-                torrent = torrent_result
+        # Isolate the right torrent - the other results of the same page are kept as candidates.
+        # The next pages are only retrieved once all of these failed (see Torrent.promote_candidates())
+        candidate_list = list()
+        for page_list in page_iter:
+            for torrent_result in page_list:
+                if torrent_result.hash is None or torrent_result.seeds is None or torrent_result.seeds <= 0:
+                    log.info("Discarded result for lack of seeds or hash: %s", torrent_result)
+                elif self.is_failed_torrent(torrent_result):
+                    log.info("Discarded result which failed to download previously: %s", torrent_result)
+                else:
+                    candidate_list.append(torrent_result)
+
+                # Don't keep more results than can be stored
+                if len(candidate_list) >= settings.TORRENT_SEARCH_MAX_CANDIDATES:
+                    break
+
+            candidate_list = list(self.rank_by_swarm_health(candidate_list))
+            if candidate_list:
                 break
+        page_iter.close()
+
+        if candidate_list:
+            torrent = candidate_list[0]
+            TorrentCandidate.objects.save_candidates(candidate_list, episode=episode)
+        else:
+            torrent = None
 
         log.info("Episode lookup for '%s' gave torrent %s", search_string, torrent)
         
@@ -198,11 +380,56 @@ class TorrentSearcher(PluginPoint):
         torrent.save()
         return torrent
 
+    def rank_by_swarm_health(self, torrent_list):
+        '''Re-rank the first TORRENT_SCRAPE_CANDIDATES results from the live number of seeds 
+        & peers reported by their trackers, which is more reliable than the one from the
+        search engine. The results without any seed left are removed.
+        The results whose trackers are already known are scraped at once. The trackers of the 
+        others are looked up one by one (a rate-limited request), by decreasing number of seeds, 
+        until one of the results scraped has more live seeds than any of the remaining ones.
+        Returns an iterator - the results after the first ones are only retrieved when consumed.'''
+
+        torrent_iter = iter(torrent_list)
+        nb_candidates = settings.TORRENT_SCRAPE_CANDIDATES
+        if nb_candidates <= 0:
+            return torrent_iter
+
+        first_list = list(itertools.islice(torrent_iter, nb_candidates))
+        scraper = TrackerScraper()
+        health_dict = scraper.scrape_torrent_list([torrent for torrent in first_list if torrent.tracker_url_list])
+
+        lookup_list = [torrent for torrent in first_list if torrent.hash and not torrent.tracker_url_list]
+        lookup_list.sort(key=lambda torrent: int(torrent.seeds or 0), reverse=True)
+        for (i, torrent) in enumerate(lookup_list):
+            best_seeds = max([seeds for (seeds, peers) in health_dict.values()] or [0])
+            if best_seeds > int(torrent.seeds or 0):
+                log.info('%d live seeds found, not looking up the trackers of %d other results', \
+                        best_seeds, len(lookup_list) - i)
+                break
+            self.update_torrent_with_tracker_list(torrent)
+            health_dict.update(scraper.scrape_torrent_list([torrent]))
+
+        ranked_list = list()
+        for torrent in first_list:
+            health = torrent.hash and health_dict.get(torrent.hash.lower())
+            if health:
+                (torrent.seeds, torrent.peers) = health
+                if torrent.seeds <= 0:
+                    log.info('No seed left for "%s" according to its trackers, discarding', torrent)
+                    continue
+            ranked_list.append(torrent)
+        ranked_list.sort(key=lambda torrent: (int(torrent.seeds or 0), int(torrent.peers or 0)), reverse=True)
+
+        return itertools.chain(ranked_list, torrent_iter)
+
     def update_torrent_with_tracker_list(self, torrent):
         '''Get the tracker list for torrent, add it, and save torrent'''
 
         import json
         
+        if torrent.tracker_url_list:
+            return torrent
+
         log.info("Retreiving list of trackers for torrent '%s'", torrent)
         tracker_url_list = self.get_tracker_list_for_torrent(torrent)
         if tracker_url_list:
@@ -237,25 +464,52 @@ class TorrentzSearcher(TorrentSearcher):
     title = 'Torrentz Torrent Searcher'
 
     def search_torrent_by_string(self, name, episode_search_string=None):
-        # Retreive data from torrentz Atom feed
+        # First page of results only - see iter_torrent_by_string()
+        return list(self.get_result_page(self.get_search_string(name, episode_search_string), 0))
+
+    def iter_torrent_by_string(self, name, episode_search_string=None):
+        '''Yields the results page by page, up to TORRENT_SEARCH_MAX_PAGES - a page is only
+        retrieved once all the results of the previous one have been consumed'''
+
+        for page_list in self.iter_result_pages(name, episode_search_string):
+            for torrent in page_list:
+                yield torrent
+
+    def iter_result_pages(self, name, episode_search_string=None, start_page=0):
+        '''Yields the pages of results from start_page, up to TORRENT_SEARCH_MAX_PAGES'''
+
+        search_string = self.get_search_string(name, episode_search_string)
+        for page in xrange(start_page, settings.TORRENT_SEARCH_MAX_PAGES):
+            page_list = list(self.get_result_page(search_string, page))
+
+            # Last page
+            if not page_list:
+                return
+
+            yield page_list
+
+    def get_search_string(self, name, episode_search_string=None):
         search_string = u'(tv|television) "%s"' % name
         if episode_search_string is not None:
             search_string += u' "%s"' % episode_search_string
 
-        log.info("Torrentz search for '%s'", search_string)
+        return search_string
+
+    def get_result_page(self, search_string, page):
+        '''Generator of the results of a page of the torrentz Atom feed (the first one is 0)'''
+
+        log.info("Torrentz search for '%s' (page %d)", search_string, page)
         url = "http://torrentz.eu/feed?q=%s" % urllib.quote_plus(search_string)
+        if page > 0:
+            url += "&p=%d" % page
         entries = wall.helpers.get_url_rss(url)
 
         if entries is None:
-            return list()
-        
-        # Build the torrent objects list
-        torrent_list = list()
-        for element in entries:
-            torrent = self.get_torrent_from_result(element)
-            torrent_list.append(torrent)
+            return
 
-        return torrent_list
+        # Build the torrent objects as they are consumed
+        for element in entries:
+            yield self.get_torrent_from_result(element)
 
     def get_torrent_from_result(self, result):
         '''Converts a result from the current engine to a Torrent object'''
@@ -342,3 +596,105 @@ class TorrentzSearcher(TorrentSearcher):
 #         return None
 
 
+class FederatedSearcher(TorrentSearcher):
+    name = 'federated-searcher'
+    title = 'Federated Torrent Searcher (queries all the other active searchers at once)'
+
+    def get_searcher_list(self):
+        '''Active searchers queried by this one'''
+
+        return [searcher for searcher in get_active_plugin_list(TorrentSearcher) \
+                if not isinstance(searcher, FederatedSearcher)]
+
+    def get_searcher_timeout(self, searcher):
+        '''Seconds to wait for the results of a searcher'''
+
+        return settings.TORRENT_FEDERATED_TIMEOUTS.get(searcher.name, settings.TORRENT_FEDERATED_TIMEOUT)
+
+    def get_search_result_pages(self, name, episode_search_string=None):
+        # Not cached here - each searcher caches its own results, and the merged
+        # results depend on which searchers answered in time
+        yield self.search_torrent_by_string(name, episode_search_string)
+
+    def search_torrent_by_string(self, name, episode_search_string=None):
+        '''Query all the active searchers concurrently, and merge their results - the same
+        torrent found by several searchers is only returned once. Searchers which don't answer
+        in time are ignored, and the results are returned as soon as one of them has at
+        least TORRENT_FEDERATED_ENOUGH_SEEDS seeds.'''
+
+        searcher_list = self.get_searcher_list()
+        result_queue = Queue.Queue()
+        deadline_dict = dict()
+        for searcher in searcher_list:
+            deadline_dict[searcher.name] = time.time() + self.get_searcher_timeout(searcher)
+            thread = threading.Thread(target=self.run_searcher, \
+                    args=(searcher, name, episode_search_string, result_queue))
+            thread.daemon = True # Searchers still running after their timeout are left behind
+            thread.start()
+
+        torrent_dict = dict()
+        while deadline_dict:
+            try:
+                (searcher_name, torrent_list) = result_queue.get(timeout=max(0, min(deadline_dict.values()) - time.time()))
+                deadline = deadline_dict.pop(searcher_name, None)
+                if deadline is not None and deadline >= time.time():
+                    log.info("Searcher %s returned %d results", searcher_name, len(torrent_list))
+                    self.merge_results(torrent_dict, torrent_list)
+                else:
+                    log.info("Searcher %s answered after its timeout, ignoring its results", searcher_name)
+            except Queue.Empty:
+                pass
+
+            for (searcher_name, deadline) in deadline_dict.items():
+                if deadline < time.time():
+                    log.info("Searcher %s did not answer in time, ignoring it", searcher_name)
+                    del deadline_dict[searcher_name]
+
+            if settings.TORRENT_FEDERATED_ENOUGH_SEEDS > 0 and deadline_dict and \
+                    [torrent for torrent in torrent_dict.values() if torrent.seeds >= settings.TORRENT_FEDERATED_ENOUGH_SEEDS]:
+                log.info("Found a result with enough seeds, not waiting for searchers %s", deadline_dict.keys())
+                break
+
+        return sorted(torrent_dict.values(), key=lambda torrent: (torrent.seeds, torrent.peers), reverse=True)
+
+    def run_searcher(self, searcher, name, episode_search_string, result_queue):
+        '''Search with one of the searchers, from its own thread. Only the results which can 
+        be kept as candidates are retrieved, and the next pages of results aren't retrieved 
+        once one of them has TORRENT_FEDERATED_ENOUGH_SEEDS seeds.'''
+
+        from django.db import connection
+
+        try:
+            torrent_list = list()
+            result_iter = searcher.get_search_results(name, episode_search_string)
+            for torrent in itertools.islice(result_iter, settings.TORRENT_SEARCH_MAX_CANDIDATES):
+                torrent_list.append(torrent)
+                if settings.TORRENT_FEDERATED_ENOUGH_SEEDS > 0 and \
+                        get_int(torrent.seeds) >= settings.TORRENT_FEDERATED_ENOUGH_SEEDS:
+                    break
+            if hasattr(result_iter, 'close'):
+                result_iter.close() # Saves the results consumed to the search cache
+        except Exception, e:
+            log.warn("Search with searcher %s failed: %s", searcher.name, e)
+            torrent_list = list()
+        finally:
+            # Each thread has its own DB connection
+            connection.close()
+
+        result_queue.put((searcher.name, torrent_list))
+
+    def merge_results(self, torrent_dict, torrent_list):
+        '''Add the results of a searcher to torrent_dict ({hash: Torrent}). The engines see the
+        same swarms, so the largest number of seeds & peers reported for a torrent is kept.'''
+
+        for torrent in torrent_list:
+            if not torrent.hash:
+                continue
+
+            (torrent.seeds, torrent.peers) = (get_int(torrent.seeds), get_int(torrent.peers))
+            merged_torrent = torrent_dict.setdefault(torrent.hash.lower(), torrent)
+            if merged_torrent is not torrent:
+                merged_torrent.seeds = max(merged_torrent.seeds, torrent.seeds)
+                merged_torrent.peers = max(merged_torrent.peers, torrent.peers)
+                if not merged_torrent.tracker_url_list:
+                    merged_torrent.tracker_url_list = torrent.tracker_url_list
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+import threading
+import time
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Globals ###########################################################
+
+# Token bucket of each host - shared by all the threads of the process
+bucket_dict = dict()
+bucket_dict_lock = threading.Lock()
+
+
+# Functions #########################################################
+
+def get_host_delay(host):
+    '''Seconds between two requests to a host, on average'''
+
+    return settings.HTTP_HOST_REQUESTS_DELAY.get(host, settings.HTTP_REQUESTS_DELAY)
+
+def get_host_bucket(host):
+    '''Returns the token bucket limiting the requests to a host, None when they aren't limited'''
+
+    delay = get_host_delay(host)
+    if delay <= 0:
+        return None
+
+    with bucket_dict_lock:
+        bucket = bucket_dict.get(host)
+        if bucket is None or bucket.delay != delay:
+            bucket = TokenBucket(delay, settings.HTTP_REQUESTS_BURST)
+            bucket_dict[host] = bucket
+
+    return bucket
+
+def wait_for_host(url):
+    '''Pause until a request can be made to the host of url, without exceeding its rate limit'''
+
+    from urlparse import urlparse
+
+    host = urlparse(url).hostname
+    bucket = get_host_bucket(host)
+    if bucket is None:
+        return
+
+    wait_time = bucket.acquire()
+    if wait_time > 0:
+        log.debug("Waited %.1f seconds before requesting %s", wait_time, host)
+
+
+# Models ############################################################
+
+class TokenBucket:
+    '''Limits the rate of requests to a host to one every <delay> seconds on average,
+    allowing bursts of up to <capacity> requests. Safe to share between threads - 
+    each request takes its turn, in the order they arrive.'''
+
+    def __init__(self, delay, capacity=1):
+        self.delay = delay
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_update = None
+        self.lock = threading.Lock()
+
+    def reserve(self, now=None):
+        '''Take a token, and returns the number of seconds to wait before using it. The bucket
+        can go in debt - requests waiting for a token are queued after the previous ones.'''
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            if self.last_update is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) / self.delay)
+            self.last_update = now
+
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens * self.delay
+
+    def acquire(self):
+        '''Wait until a request can be made, and returns the time waited'''
+
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+        return wait_time
+
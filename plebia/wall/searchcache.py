@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+from collections import OrderedDict
+import threading
+import copy
+import time
+import re
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Models ############################################################
+
+class SearchResultCache:
+    '''Keeps the results of the recent searches in memory, by search engine & query, to 
+    avoid querying the engines again for retries, or for the season & episode searches of
+    a same series. Searches without results are kept for less time, and the least recently
+    used searches are dropped once there are more than TORRENT_SEARCH_CACHE_SIZE.
+    The results of a search can be partial, when its consumer didn't need all of them - the 
+    next page of results to retrieve is then kept with them.'''
+
+    def __init__(self):
+        self.entry_dict = OrderedDict() # {key: (expiration time, torrent_list, is_complete, next_page)}, least recently used first
+        self.lock = threading.Lock()
+
+    def get_key(self, engine, name, episode_search_string=None):
+        '''Key of a search - queries differing only by case or spacing are the same'''
+
+        query = u' '.join([name or u'', episode_search_string or u''])
+        return (engine, re.sub(r'\s+', u' ', query).strip().lower())
+
+    def get(self, key, now=None):
+        '''Returns a copy of the cached results of a search, None if it isn't cached, expired
+        or only partially cached'''
+
+        (torrent_list, is_complete, next_page) = self.get_partial(key, now=now)
+        if not is_complete:
+            return None
+
+        return torrent_list
+
+    def get_partial(self, key, now=None):
+        '''Returns a copy of the cached results of a search, if they are all the results of the
+        search, and the next page of results to retrieve otherwise, as a (torrent_list, is_complete,
+        next_page) tuple - (None, False, 0) if it isn't cached'''
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            entry = self.entry_dict.pop(key, None)
+            if entry is None:
+                return (None, False, 0)
+
+            (expiration_time, torrent_list, is_complete, next_page) = entry
+            if expiration_time <= now:
+                return (None, False, 0)
+
+            self.entry_dict[key] = entry # Most recently used
+            log.debug("Search results for %s found in cache", key)
+
+        # The results are modified & saved by the searches
+        return (copy.deepcopy(torrent_list), is_complete, next_page)
+
+    def set(self, key, torrent_list, now=None, is_complete=True, next_page=0):
+        '''Cache the results of a search - is_complete is False when only the first
+        pages of results of the search were retrieved, next_page is the next one then'''
+
+        if torrent_list:
+            ttl = settings.TORRENT_SEARCH_CACHE_TTL
+        elif is_complete:
+            ttl = settings.TORRENT_SEARCH_CACHE_NEGATIVE_TTL
+        else:
+            return
+        if ttl <= 0:
+            return
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self.entry_dict.pop(key, None)
+            self.entry_dict[key] = (now + ttl, copy.deepcopy(torrent_list), is_complete, next_page)
+            while len(self.entry_dict) > settings.TORRENT_SEARCH_CACHE_SIZE:
+                self.entry_dict.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entry_dict.clear()
+
+
+# Globals ###########################################################
+
+# Shared by all the search plugins & threads of the process
+search_cache = SearchResultCache()
+
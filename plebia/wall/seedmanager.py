@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+from wall.models import Torrent, Video
+
+import time
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Models ############################################################
+
+class SeedManager:
+    '''Decides when completed torrents stop seeding, and removes them from the bittorrent 
+    session. A torrent stops seeding once it reached BITTORRENT_SEED_RATIO or 
+    BITTORRENT_SEED_TIME, and at most BITTORRENT_MAX_SEEDS torrents are seeded at once - the 
+    ones which gave back the least are kept. The downloaded files can be deleted at the same
+    time, once all the episodes of the torrent are transcoded.'''
+
+    def __init__(self):
+        self.next_update = 0
+
+    def do(self, bt):
+        '''Remove the torrents which are done seeding, every BITTORRENT_STATS_INTERVAL seconds'''
+
+        if time.time() < self.next_update:
+            return
+        self.next_update = time.time() + settings.BITTORRENT_STATS_INTERVAL
+
+        seed_stats_dict = bt.get_seed_stats_dict()
+        if not seed_stats_dict:
+            return
+
+        torrent_dict = dict((torrent.hash, torrent) for torrent in \
+                Torrent.objects.filter(hash__in=seed_stats_dict.keys(), status='Completed'))
+        seed_stats_dict = dict((hash, stats) for (hash, stats) in seed_stats_dict.items() \
+                if hash in torrent_dict)
+
+        for hash in self.get_removal_list(seed_stats_dict):
+            self.remove(bt, torrent_dict[hash], seed_stats_dict[hash])
+
+    def get_removal_list(self, seed_stats_dict):
+        '''Returns the hashes of the torrents which should stop seeding, from their
+        {hash: {'ratio': upload ratio, 'seeding_time': seconds}} statistics'''
+
+        removal_list = list()
+        seed_list = list()
+        for (hash, stats) in seed_stats_dict.items():
+            if stats['ratio'] >= settings.BITTORRENT_SEED_RATIO \
+                    or stats['seeding_time'] >= settings.BITTORRENT_SEED_TIME:
+                removal_list.append(hash)
+            else:
+                seed_list.append(hash)
+
+        # Keep seeding the torrents which gave back the least
+        seed_list.sort(key=lambda hash: seed_stats_dict[hash]['ratio'])
+        removal_list += seed_list[settings.BITTORRENT_MAX_SEEDS:]
+
+        return removal_list
+
+    def remove(self, bt, torrent, stats):
+        '''Stop seeding a torrent, deleting its files if they are not needed anymore'''
+
+        delete_files = settings.BITTORRENT_DELETE_AFTER_TRANSCODING and torrent.is_transcoded()
+
+        log.info("Stopping to seed torrent %s (ratio %.2f, seeded %ds)%s", torrent, stats['ratio'], \
+                stats['seeding_time'], delete_files and ', deleting its files' or '')
+        bt.remove_hash(torrent.hash, delete_files=delete_files)
+
+        if delete_files:
+            bt.forget_hash(torrent.hash)
+            Video.objects.filter(episode__torrent=torrent).update(original_evicted=True)
+
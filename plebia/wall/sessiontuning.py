@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+import os
+import time
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Globals ###########################################################
+
+# libtorrent session settings of each profile - cache_size is in blocks of 16 KiB
+SESSION_PROFILE_DICT = {
+    'low-memory': {
+        'cache_size': 256,
+        'connections_limit': 100,
+        'half_open_limit': 20,
+        'unchoke_slots_limit': 4,
+        'send_buffer_watermark': 128*1024,
+        'max_queued_disk_bytes': 1024*1024,
+        'max_peerlist_size': 1000,
+        'aio_threads': 1,
+    },
+    'balanced': {
+        'cache_size': 2048,
+        'connections_limit': 400,
+        'half_open_limit': 50,
+        'unchoke_slots_limit': 8,
+        'send_buffer_watermark': 512*1024,
+        'max_queued_disk_bytes': 4*1024*1024,
+        'max_peerlist_size': 3000,
+        'aio_threads': 2,
+    },
+    'high-throughput': {
+        'cache_size': 8192,
+        'connections_limit': 1000,
+        'half_open_limit': 100,
+        'unchoke_slots_limit': 20,
+        'send_buffer_watermark': 3*1024*1024,
+        'max_queued_disk_bytes': 16*1024*1024,
+        'max_peerlist_size': 4000,
+        'aio_threads': 4,
+    },
+}
+
+# Profiles by increasing resources usage
+SESSION_PROFILE_LIST = ['low-memory', 'balanced', 'high-throughput']
+
+# Transfer rate (download + upload, bytes/s) from which a profile limits the throughput
+SESSION_PROFILE_MAX_RATE = {
+    'low-memory': 1024*1024,
+    'balanced': 8*1024*1024,
+    'high-throughput': None,
+}
+
+
+# Functions #########################################################
+
+def apply_session_profile(session_settings, profile):
+    '''Set the values of a profile on a libtorrent session_settings object - the settings 
+    which don't exist in the installed libtorrent version are skipped'''
+
+    for (name, value) in SESSION_PROFILE_DICT[profile].items():
+        if hasattr(session_settings, name):
+            setattr(session_settings, name, value)
+
+    return session_settings
+
+def get_memory_usage():
+    '''Resident memory of the current process, in bytes'''
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # Peak usage, on systems without /proc
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Models ############################################################
+
+class SessionTuner:
+    '''Switches between the session profiles from the measured throughput & memory use, every 
+    BITTORRENT_AUTO_TUNING_INTERVAL seconds: a profile which limits the throughput is 
+    replaced by the next one, and memory use above BITTORRENT_AUTO_TUNING_MAX_MEMORY or a 
+    throughput which doesn't need the current profile go back to the previous one.'''
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.next_update = time.time() + settings.BITTORRENT_AUTO_TUNING_INTERVAL
+        self.rate_sum = 0.0
+        self.nb_samples = 0
+
+    def add_sample(self, download_rate, upload_rate):
+        '''Add the current transfer rates of the session, in bytes/s'''
+
+        self.rate_sum += download_rate + upload_rate
+        self.nb_samples += 1
+
+    def get_profile(self, memory_usage=None, now=None):
+        '''Returns the profile to use, updated once per interval from the samples received'''
+
+        if now is None:
+            now = time.time()
+        if now < self.next_update or self.nb_samples == 0:
+            return self.profile
+        self.next_update = now + settings.BITTORRENT_AUTO_TUNING_INTERVAL
+
+        if memory_usage is None:
+            memory_usage = get_memory_usage()
+        average_rate = self.rate_sum / self.nb_samples
+        self.rate_sum = 0.0
+        self.nb_samples = 0
+
+        profile = self.choose_profile(average_rate, memory_usage)
+        if profile != self.profile:
+            log.info("Switching session profile from %s to %s (%.3f MB/s, %d MB of memory used)", \
+                    self.profile, profile, average_rate/(1024*1024), memory_usage/(1024*1024))
+            self.profile = profile
+
+        return self.profile
+
+    def choose_profile(self, average_rate, memory_usage):
+        '''Profile adapted to the measured average transfer rate and memory use'''
+
+        index = SESSION_PROFILE_LIST.index(self.profile)
+        max_memory = settings.BITTORRENT_AUTO_TUNING_MAX_MEMORY
+        max_rate = SESSION_PROFILE_MAX_RATE[self.profile]
+
+        if memory_usage > max_memory and index > 0:
+            return SESSION_PROFILE_LIST[index-1]
+        elif max_rate is not None and average_rate >= 0.9 * max_rate and memory_usage < max_memory / 2:
+            return SESSION_PROFILE_LIST[index+1]
+        elif index > 0 and average_rate < SESSION_PROFILE_MAX_RATE[SESSION_PROFILE_LIST[index-1]] / 2:
+            return SESSION_PROFILE_LIST[index-1]
+        else:
+            return self.profile
+
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+import time
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Models ############################################################
+
+class StallDetector:
+    '''Projects the completion time of downloads from their progress over the last 
+    BITTORRENT_STALL_WINDOW seconds, to find the ones which would hold a download slot for 
+    too long. A torrent is only judged once it has been observed for a whole window.'''
+
+    def __init__(self):
+        # {hash: [(time, progress), ...]}, oldest first
+        self.sample_dict = dict()
+
+    def update(self, progress_dict, now=None):
+        '''Add the current progress (0 to 1) of the downloading torrents, as a {hash: progress}
+        dict. The torrents which are not downloading anymore are forgotten.'''
+
+        if now is None:
+            now = time.time()
+        window_start = now - settings.BITTORRENT_STALL_WINDOW
+
+        for hash in self.sample_dict.keys():
+            if hash not in progress_dict:
+                del self.sample_dict[hash]
+
+        for (hash, progress) in progress_dict.items():
+            sample_list = self.sample_dict.setdefault(hash, list())
+            sample_list.append((now, progress))
+
+            # Keep a single sample older than the window, as its start
+            while len(sample_list) > 1 and sample_list[1][0] <= window_start:
+                sample_list.pop(0)
+
+    def get_projected_eta(self, hash, now=None):
+        '''Returns the projected number of seconds before the end of a download, from its 
+        progress rate over the window - None when it hasn't been observed long enough'''
+
+        if now is None:
+            now = time.time()
+
+        sample_list = self.sample_dict.get(hash)
+        if not sample_list or sample_list[0][0] > now - settings.BITTORRENT_STALL_WINDOW:
+            return None
+
+        (start_time, start_progress) = sample_list[0]
+        (end_time, end_progress) = sample_list[-1]
+        progress_rate = (end_progress - start_progress) / (end_time - start_time)
+        if progress_rate <= 0:
+            return float('inf')
+
+        return (1.0 - end_progress) / progress_rate
+
+    def get_stalled_list(self, now=None):
+        '''Returns the hashes of the downloads projected to end after BITTORRENT_STALL_MAX_ETA'''
+
+        stalled_list = list()
+        for hash in self.sample_dict:
+            eta = self.get_projected_eta(hash, now=now)
+            if eta is not None and eta > settings.BITTORRENT_STALL_MAX_ETA:
+                stalled_list.append(hash)
+
+        return stalled_list
+
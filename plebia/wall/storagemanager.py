@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+from wall.models import Torrent, Episode, Video
+
+import os
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Models ############################################################
+
+class StorageManager:
+    '''Keeps enough free space for the downloads, which share the volume with the extracted 
+    and transcoded videos unless they are downloaded to SCRATCH_DIR. Space is reserved for
+    the data left to download before starting a torrent, and data is evicted when space runs
+    low: first the originals of transcoded videos whose torrent is completed, then the 
+    transcoded videos, least recently watched first.'''
+
+    def __init__(self, bt=None):
+        self.bt = bt
+
+    def get_free_space(self, path=None):
+        '''Bytes available on the volume of path - the download directory by default'''
+
+        stat = os.statvfs(path or self.get_download_dir())
+        return stat.f_bavail * stat.f_frsize
+
+    def get_download_dir(self):
+        '''Directory the torrents are downloaded to'''
+
+        return settings.SCRATCH_DIR or settings.DOWNLOAD_DIR
+
+    def is_library_volume(self):
+        '''Check if the downloads are on the same volume as the library - evicting data from the
+        library only frees space for the downloads then'''
+
+        return os.stat(self.get_download_dir()).st_dev == os.stat(settings.DOWNLOAD_DIR).st_dev
+
+    def get_reserved_space(self):
+        '''Bytes still to download for the torrents being downloaded'''
+
+        return sum(torrent.get_remaining_size() for torrent in Torrent.objects.filter(status='Downloading'))
+
+    def get_headroom(self):
+        '''Bytes which can still be allocated to new downloads'''
+
+        return self.get_free_space() - self.get_reserved_space() - settings.STORAGE_MIN_FREE_SPACE
+
+    def get_storage_stats(self):
+        '''Current usage of the download volume, in bytes, as a dict'''
+
+        free_space = self.get_free_space()
+        reserved_space = self.get_reserved_space()
+        return {
+            'free': free_space,
+            'reserved': reserved_space,
+            'headroom': free_space - reserved_space - settings.STORAGE_MIN_FREE_SPACE,
+        }
+
+    def reserve(self, torrent_list):
+        '''Returns the torrents of torrent_list which can be downloaded in the remaining space,
+        in order, evicting data if needed'''
+
+        if not torrent_list:
+            return list()
+
+        headroom = self.get_headroom()
+
+        admitted_list = list()
+        for torrent in torrent_list:
+            size = torrent.get_remaining_size()
+            if size == 0:
+                # Size unknown or nothing left to download
+                admitted_list.append(torrent)
+                continue
+
+            if size > headroom and self.is_library_volume():
+                headroom += self.evict(size - headroom)
+
+            if size <= headroom:
+                headroom -= size
+                admitted_list.append(torrent)
+            else:
+                log.warn("Not enough space to download torrent %s (%d bytes, %d available)", torrent, size, headroom)
+
+        return admitted_list
+
+    def can_reserve(self, torrent, nb_freed_bytes=0):
+        '''Check if a torrent could be downloaded in the remaining space, once nb_freed_bytes
+        are not reserved anymore, evicting data if needed'''
+
+        size = torrent.get_remaining_size()
+        if size == 0:
+            return True
+
+        headroom = self.get_headroom() + nb_freed_bytes
+        if size > headroom and self.is_library_volume():
+            headroom += self.evict(size - headroom)
+
+        return size <= headroom
+
+    def ensure_free_space(self):
+        '''Evict data when the free space falls under STORAGE_MIN_FREE_SPACE'''
+
+        missing_space = settings.STORAGE_MIN_FREE_SPACE - self.get_free_space(settings.DOWNLOAD_DIR)
+        if missing_space > 0:
+            log.warn("Low disk space, evicting %d bytes", missing_space)
+            return self.evict(missing_space)
+
+        return 0
+
+    def evict(self, nb_bytes):
+        '''Delete at least nb_bytes of data if possible, by order of eviction policy
+        Returns the number of bytes freed'''
+
+        nb_freed_bytes = 0
+
+        # Originals of the videos already transcoded, once their torrent is done seeding - the
+        # SeedManager removes it from the session once its ratio or seed time is reached
+        episode_list = Episode.objects.filter(video__status='Completed', video__original_evicted=False, \
+                torrent__status='Completed').select_related('video', 'torrent').order_by('video__date_added')
+        for episode in episode_list:
+            if nb_freed_bytes >= nb_bytes:
+                return nb_freed_bytes
+            if self.is_seeding(episode.torrent):
+                continue
+            nb_freed_bytes += self.evict_original(episode)
+
+        # Transcoded videos, least recently watched first
+        video_list = Video.objects.filter(status='Completed').exclude(last_watched=None).order_by('last_watched')
+        for video in video_list:
+            if nb_freed_bytes >= nb_bytes:
+                return nb_freed_bytes
+            nb_freed_bytes += self.evict_transcodes(video)
+
+        if nb_freed_bytes < nb_bytes:
+            log.warn("Could only evict %d bytes out of %d", nb_freed_bytes, nb_bytes)
+
+        return nb_freed_bytes
+
+    def is_seeding(self, torrent):
+        '''Check if a torrent is still in the bittorrent session'''
+
+        return self.bt is not None and self.bt.get_handle_for_hash(torrent.hash) is not None
+
+    def evict_original(self, episode):
+        '''Delete the original file of a transcoded video, whose torrent is done seeding'''
+
+        video = episode.video
+        log.info("Evicting original of video %s", video)
+
+        nb_freed_bytes = self.delete_file(video.full_path(video.original_path))
+        video.original_evicted = True
+        video.save()
+
+        return nb_freed_bytes
+
+    def evict_transcodes(self, video):
+        '''Delete the transcoded files of a video (the thumbnail is kept)'''
+
+        log.info("Evicting transcoded files of video %s", video)
+
+        nb_freed_bytes = 0
+        for path in [video.webm_path, video.mp4_path, video.ogv_path]:
+            if path:
+                nb_freed_bytes += self.delete_file(video.full_path(path))
+        video.status = 'Evicted'
+        video.save()
+
+        return nb_freed_bytes
+
+    def delete_file(self, path):
+        '''Delete a file, returns its size'''
+
+        if not os.path.isfile(path):
+            return 0
+
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+
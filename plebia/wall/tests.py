@@ -41,6 +41,12 @@ import json, os, shutil, time
 class PlebiaTest(TestCase):
     #fixtures = ['video.json']
 
+    def setUp(self):
+        from wall.searchcache import search_cache
+
+        # Each test mocks its own search results
+        search_cache.clear()
+
     def test_raise_exception_upon_error_critical_log(self):
         '''Make sure exceptions are raised upon ERROR or CRITICAL log messages'''
 
@@ -516,11 +522,16 @@ class PlebiaTest(TestCase):
         default_update_queued_torrents = None
         default_get_url = None
         default_get_torrent_info = None
+        default_get_torrent_info_dict = None
         default_add_magnet = None
 
         # FIXME: Tests should cover all plugins
         self.select_plugin(TorrentSearcher, 'torrentz-searcher')
 
+        # Torrents served from the cache below never post libtorrent alerts
+        default_use_alerts = settings.BITTORRENT_USE_ALERTS
+        settings.BITTORRENT_USE_ALERTS = False
+
         # Don't let the other tests continue without reverting to the default methods/objects
         # we override in this test
         try:
@@ -630,8 +641,16 @@ class PlebiaTest(TestCase):
                         set_cache(torrent_timeout_id, True)
                     return torrent_bt
             
+            def get_torrent_info_dict(self, torrent_list):
+                torrent_bt_dict = dict()
+                for torrent in torrent_list:
+                    torrent_bt_dict[torrent.hash] = get_torrent_info(self, torrent)
+                return torrent_bt_dict
+
             default_get_torrent_info = wall.torrentdownloader.Bittorrent.get_torrent_info
+            default_get_torrent_info_dict = wall.torrentdownloader.Bittorrent.get_torrent_info_dict
             wall.torrentdownloader.Bittorrent.get_torrent_info = get_torrent_info
+            wall.torrentdownloader.Bittorrent.get_torrent_info_dict = get_torrent_info_dict
 
             def add_magnet(self, magnet_uri):
                 hash = magnet_uri[20:60]
@@ -682,6 +701,7 @@ class PlebiaTest(TestCase):
         except:
             raise
         finally:
+            settings.BITTORRENT_USE_ALERTS = default_use_alerts
             if default_open_url is not None:
                 wall.helpers.open_url = default_open_url
             if default_get_url is not None:
@@ -690,9 +710,1311 @@ class PlebiaTest(TestCase):
                 wall.torrentdownloader.TorrentDownloadManager.update_queued_torrents = default_update_queued_torrents
             if default_get_torrent_info is not None:
                 wall.torrentdownloader.Bittorrent.get_torrent_info = default_get_torrent_info
+            if default_get_torrent_info_dict is not None:
+                wall.torrentdownloader.Bittorrent.get_torrent_info_dict = default_get_torrent_info_dict
             if default_add_magnet is not None:
                 wall.torrentdownloader.Bittorrent.add_magnet = default_add_magnet
 
+    def test_torrent_bulk_update(self):
+        '''Only the torrents which changed should be written'''
+
+        torrent_changed = self.create_fake_torrent(name='Test bulk changed')
+        torrent_unchanged = self.create_fake_torrent(name='Test bulk unchanged')
+
+        torrent_bt_dict = {
+            torrent_changed.hash: Torrent(name='Test bulk changed', has_metadata=True, progress=0.5, seeds=10, peers=10),
+            torrent_unchanged.hash: Torrent(name='Test bulk unchanged', seeds=10, peers=10),
+        }
+
+        nb_changed = Torrent.objects.bulk_update_from_torrents([torrent_changed, torrent_unchanged], torrent_bt_dict)
+
+        self.assertEqual(nb_changed, 1)
+        self.api_check('torrent', torrent_changed.id, {'progress': 0.5, 'has_metadata': True, 'status': 'Downloading'})
+        self.api_check('torrent', torrent_unchanged.id, {'progress': 0.0, 'has_metadata': False})
+
+    def test_slot_scheduler(self):
+        '''New torrents should only be admitted within the limit of free slots'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        torrent_downloading = self.create_fake_torrent(name='Test slot downloading', status='Downloading metadata')
+        for i in xrange(3):
+            self.create_fake_torrent(name='Test slot %d' % i, status='New')
+
+        default_max_metadata_downloads = settings.BITTORRENT_MAX_METADATA_DOWNLOADS
+        settings.BITTORRENT_MAX_METADATA_DOWNLOADS = 3
+        try:
+            manager = TorrentDownloadManager()
+        finally:
+            settings.BITTORRENT_MAX_METADATA_DOWNLOADS = default_max_metadata_downloads
+        manager.bt = Mock()
+        manager.scheduler.reconcile()
+
+        manager.start_metadata_downloads()
+        self.assertEqual(manager.bt.add_magnet.call_count, 2)
+        self.assertEqual(Torrent.objects.filter(status='Downloading metadata').count(), 3)
+        self.assertEqual(manager.has_free_metadata_slot(), False)
+
+        # Releasing a slot allows to admit the remaining torrent
+        manager.set_status(torrent_downloading, 'Queued')
+        manager.start_metadata_downloads()
+        self.assertEqual(manager.bt.add_magnet.call_count, 3)
+        self.assertEqual(Torrent.objects.filter(status='New').count(), 0)
+
+    def test_torrent_priority(self):
+        '''Torrents of series users posted about should be downloaded first'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        torrent_old = self.create_fake_torrent(name='Test priority old', status='Queued')
+        torrent_posted = self.create_fake_torrent(name='Test priority posted', status='Queued')
+
+        episode = Episode(number=1, tvdb_id=1)
+        episode.season = self.create_fake_season(name='Test priority posted')
+        episode.torrent = torrent_posted
+        episode.save()
+        Post(series=episode.season.series).save()
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.scheduler.limit_dict['Downloading'] = 1
+
+        manager.update_priorities()
+        manager.update_queued_torrents()
+
+        self.assertTrue(Torrent.objects.get(id=torrent_posted.id).priority > Torrent.objects.get(id=torrent_old.id).priority)
+        self.assertEqual(Torrent.objects.get(id=torrent_posted.id).status, 'Downloading')
+        self.assertEqual(Torrent.objects.get(id=torrent_old.id).status, 'Queued')
+
+    def test_resume_downloads(self):
+        '''Torrents with saved metadata should restart in their previous state'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        torrent_saved = self.create_fake_torrent(name='Test resume saved', status='Downloading')
+        torrent_metadata = self.create_fake_torrent(name='Test resume metadata', status='Downloading metadata')
+        torrent_unsaved = self.create_fake_torrent(name='Test resume unsaved', status='Downloading')
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.bt.has_saved_metadata.side_effect = lambda hash: hash != torrent_unsaved.hash
+        manager.bt.get_nb_checking.return_value = 0
+
+        manager.resume_downloads()
+        manager.scheduler.reconcile()
+
+        self.assertEqual(Torrent.objects.get(id=torrent_saved.id).status, 'Downloading')
+        self.assertEqual(Torrent.objects.get(id=torrent_metadata.id).status, 'Queued')
+        self.assertEqual(Torrent.objects.get(id=torrent_unsaved.id).status, 'New')
+        self.assertEqual(manager.scheduler.get_nb_free_slots('Downloading'), settings.BITTORRENT_MAX_DOWNLOADS - 1)
+
+        manager.resume_pending_downloads()
+        manager.bt.add_magnet.assert_called_with(torrent_saved.get_magnet())
+        self.assertEqual(manager.resume_list, list())
+
+    def test_season_torrent_file_selection(self):
+        '''Only the files of the episodes still needed should be downloaded from season packs, in order'''
+
+        from wall.torrentmagic import TorrentFileMagic
+
+        torrent = self.create_fake_torrent(name='Test file selection', type='season')
+        torrent.file_list = json.dumps([{'path': path, 'size': 1000} for path in [
+                u'Test S02/Test.S02E01.avi',
+                u'Test S02/Test.S02E02.avi',
+                u'Test S02/Test.S02E03.avi',
+                u'Test S02/Sample/Test.S02E01.sample.avi',
+                u'Test S03/Test.S03E01.avi',
+                u'Test S02/Extras/Bonus 01 - Making of.avi']])
+
+        season = self.create_fake_season(name='Test file selection')
+        episode_list = list()
+        for number in [2, 1]:
+            episode = Episode(number=number, tvdb_id=number, season=season, torrent=torrent)
+            episode.save()
+            episode_list.append(episode)
+
+        file_magic = TorrentFileMagic(torrent)
+        self.assertEqual(file_magic.get_file_priority_list(episode_list), [7, 4, 0, 0, 0, 0])
+
+        # Download everything when no file can be matched
+        episode = Episode(number=9, tvdb_id=9, season=season, torrent=torrent)
+        self.assertEqual(file_magic.get_file_priority_list([episode]), None)
+
+    def test_pending_file_selections(self):
+        '''The files of all the season packs waiting for their metadata should be selected
+        from a single status pass over the session'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        file_list = json.dumps([{'path': u'Test S02/Test.S02E0%d.avi' % number, 'size': 1000} for number in [1, 2]])
+        season = self.create_fake_season(name='Test pending selection')
+        torrent_list = list()
+        for name in ['metadata', 'no metadata', 'episode']:
+            torrent = self.create_fake_torrent(name='Test pending selection %s' % name, status='Downloading', \
+                    type=(name == 'episode' and 'episode' or 'season'))
+            Episode(number=2, tvdb_id=len(torrent_list)+1, season=season, torrent=torrent).save()
+            torrent_list.append(torrent)
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.bt.get_torrent_info_dict.return_value = {
+                torrent_list[0].hash: Mock(has_metadata=True, file_list=file_list),
+                torrent_list[1].hash: Mock(has_metadata=False)}
+        manager.pending_file_selection.update([torrent.hash for torrent in torrent_list])
+
+        manager.update_file_selections()
+        self.assertEqual(manager.bt.get_torrent_info_dict.call_count, 1)
+        self.assertEqual(set(torrent.hash for torrent in manager.bt.get_torrent_info_dict.call_args[0][0]), \
+                set([torrent_list[0].hash, torrent_list[1].hash]))
+        self.assertEqual(manager.bt.set_file_priorities.call_args[0], (torrent_list[0].hash, [0, 7]))
+        self.assertEqual(manager.pending_file_selection, set([torrent_list[1].hash]))
+
+    def test_episode_completed_in_downloading_torrent(self):
+        '''Episodes should be packaged as soon as their files are downloaded, before the whole season'''
+
+        from wall.packagemanager import PackageManager
+
+        self.clear_test_directory()
+        name = u'Test per-file completion'
+        torrent = self.create_fake_torrent(name=name, type='season', status='Downloading')
+        torrent.file_list = json.dumps([{'path': os.path.join(name, u's02e%02d.avi' % number), 'size': 1000} \
+                for number in [1, 2]])
+        torrent.completed_files = json.dumps([0])
+        torrent.save()
+        self.create_fake_video(name, u's02e01.avi')
+        self.create_fake_video(name, u's02e02.avi') # Still downloading
+
+        season = self.create_fake_season(name=name)
+        for number in [1, 2]:
+            Episode(number=number, tvdb_id=number, season=season, torrent=torrent).save()
+
+        # Nothing to package before the first file is completed
+        Torrent.objects.filter(id=torrent.id).update(completed_files=json.dumps([]))
+        with patch.object(Episode, 'get_or_create_video') as mock_get_or_create_video:
+            PackageManager().do()
+            self.assertEqual(mock_get_or_create_video.call_count, 0)
+        Torrent.objects.filter(id=torrent.id).update(completed_files=json.dumps([0]))
+
+        PackageManager().do()
+
+        self.assertNotEqual(Episode.objects.get(season=season, number=1).video, None)
+        self.assertEqual(Episode.objects.get(season=season, number=2).video, None)
+        self.api_check('video', 1, { 'status': 'New', 'original_path': os.path.join(name, u's02e01.avi') })
+
+    def test_torrent_streaming(self):
+        '''The start of a streamed file should become readable while it downloads from a local seeder'''
+
+        import libtorrent as lt
+        from wall.torrentdownloader import Bittorrent
+
+        self.clear_test_directory()
+        name = u'Test streaming'
+        seed_dir = os.path.join(settings.TEST_DOWNLOAD_DIR, 'seed')
+        mkdir_p(os.path.join(seed_dir, name))
+        shutil.copy2(settings.TEST_VIDEO_PATH, os.path.join(seed_dir, name, u's02e01.avi'))
+
+        # Local seeder
+        file_storage = lt.file_storage()
+        lt.add_files(file_storage, os.path.join(seed_dir, name).encode('utf-8'))
+        torrent_file = lt.create_torrent(file_storage, 16*1024)
+        lt.set_piece_hashes(torrent_file, seed_dir.encode('utf-8'))
+        torrent_info = lt.torrent_info(lt.bdecode(lt.bencode(torrent_file.generate())))
+
+        # Resume data & DHT state of the test session kept out of the real cache
+        default_dir_dict = dict((key, getattr(settings, key)) for key in ['DOWNLOAD_DIR', 'RESUME_DATA_DIR', 'CACHE_DIR'])
+        settings.DOWNLOAD_DIR = os.path.join(settings.TEST_DOWNLOAD_DIR, 'download')
+        settings.CACHE_DIR = os.path.join(settings.TEST_DOWNLOAD_DIR, 'cache')
+        settings.RESUME_DATA_DIR = os.path.join(settings.CACHE_DIR, 'resume')
+        mkdir_p(settings.DOWNLOAD_DIR)
+        (seeder, bt) = (None, None)
+        try:
+            seeder = lt.session()
+            seeder.listen_on(6900, 6910)
+            seeder.add_torrent({'ti': torrent_info, 'save_path': seed_dir.encode('utf-8'), 'seed_mode': True})
+
+            bt = Bittorrent()
+            hash = str(torrent_info.info_hash())
+            bt.add_magnet('magnet:?xt=urn:btih:%s' % hash)
+            bt.get_handle_for_hash(hash).connect_peer(('127.0.0.1', seeder.listen_port()), 0)
+
+            readable_bytes = None
+            timeout = time.time() + 60
+            while not readable_bytes and time.time() < timeout:
+                time.sleep(0.5)
+                readable_bytes = bt.get_streaming_bytes(hash, 0)
+            time.sleep(1) # Cache flush
+            self.assertTrue(readable_bytes > 0)
+
+            with open(settings.TEST_VIDEO_PATH, 'rb') as f:
+                expected_content = f.read(readable_bytes)
+            with open(os.path.join(settings.DOWNLOAD_DIR, name, u's02e01.avi'), 'rb') as f:
+                self.assertEqual(f.read(readable_bytes), expected_content)
+        finally:
+            # Stop both sessions, to free their ports & threads for the next tests
+            for session in [seeder, bt and bt.session]:
+                if session is not None:
+                    session.pause()
+            del seeder, bt, session
+
+            for (key, value) in default_dir_dict.items():
+                setattr(settings, key, value)
+
+    def test_torrent_streaming_request(self):
+        '''Videos should only be streamed when asked with a POST, until the torrent completes or
+        the streaming is abandoned'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+        from datetime import datetime, timedelta
+
+        torrent = self.create_fake_torrent(name='Test streaming request')
+        torrent.file_list = json.dumps([{'path': u's02e01.avi', 'size': 1000}])
+        torrent.save()
+        episode = Episode(number=1, tvdb_id=1, torrent=torrent)
+        episode.season = self.create_fake_season(name='Test streaming request')
+        episode.save()
+
+        # Reading the stream doesn't start it
+        self.assertEqual(self.client.get('/ajax/stream/%d/' % episode.id).status_code, 405)
+        self.assertEqual(self.client.get('/stream/%d/' % episode.id).status_code, 404)
+        self.assertEqual(Torrent.objects.get(id=torrent.id).streaming_file, None)
+
+        response = self.client.post('/ajax/stream/%d/' % episode.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['url'], '/stream/%d/' % episode.id)
+        self.assertEqual(Torrent.objects.get(id=torrent.id).streaming_file, 0)
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.bt.get_streaming_bytes.return_value = 100
+        Torrent.objects.filter(id=torrent.id).update(lease_owner=manager.worker_id)
+        manager.update_streaming()
+        self.assertEqual(Torrent.objects.get(id=torrent.id).streaming_bytes, 100)
+
+        # Abandoned
+        abandon_time = datetime.now() - timedelta(seconds=settings.BITTORRENT_STREAMING_TIMEOUT + 1)
+        Torrent.objects.filter(id=torrent.id).update(streaming_requested=abandon_time)
+        manager.update_streaming()
+        torrent = Torrent.objects.get(id=torrent.id)
+        self.assertEqual(torrent.streaming_file, None)
+        self.assertEqual(torrent.streaming_bytes, 0)
+
+        # Completed
+        self.client.post('/ajax/stream/%d/' % episode.id)
+        default_scratch_dir = settings.SCRATCH_DIR
+        settings.SCRATCH_DIR = ''
+        try:
+            manager.complete_torrent(Torrent.objects.get(id=torrent.id))
+        finally:
+            settings.SCRATCH_DIR = default_scratch_dir
+        torrent = Torrent.objects.get(id=torrent.id)
+        self.assertEqual(torrent.status, 'Completed')
+        self.assertEqual(torrent.streaming_file, None)
+
+    def test_session_checkpoint(self):
+        '''The session state should be saved on interval or significant change, keeping older generations'''
+
+        from wall.checkpoint import SessionCheckpointer
+
+        self.clear_test_directory()
+        default_checkpoint_dir = settings.CHECKPOINT_DIR
+        settings.CHECKPOINT_DIR = os.path.join(settings.TEST_DOWNLOAD_DIR, 'checkpoint')
+        try:
+            checkpointer = SessionCheckpointer()
+            bt = Mock()
+            bt.get_dht_state.return_value = {'nodes': 1}
+            bt.get_session_stats.return_value = {'nb_torrents': 1, 'dht_nodes': 100}
+
+            # Changes are coalesced until the end of the interval
+            self.assertTrue(checkpointer.do(bt))
+            bt.get_dht_state.return_value = {'nodes': 2}
+            self.assertFalse(checkpointer.do(bt))
+            self.assertEqual(checkpointer.load('dht'), {'nodes': 1})
+            self.assertEqual(bt.save_resume_data.call_count, 1)
+
+            # Significant change
+            checkpointer.last_checkpoint -= settings.BITTORRENT_CHECKPOINT_MIN_INTERVAL
+            bt.get_session_stats.return_value = {'nb_torrents': 2, 'dht_nodes': 100}
+            self.assertTrue(checkpointer.do(bt))
+            self.assertEqual(checkpointer.load('dht'), {'nodes': 2})
+
+            # Fall back on the previous generation when the last one is corrupted
+            with open(checkpointer.get_file_path('dht', 0), 'wb') as f:
+                f.write('corrupted')
+            self.assertEqual(checkpointer.load('dht'), {'nodes': 1})
+        finally:
+            settings.CHECKPOINT_DIR = default_checkpoint_dir
+
+    def test_transfer_metrics(self):
+        '''Transfer rates should be averaged per minute, then per hour'''
+
+        from wall.metrics import TransferMetrics
+        from datetime import datetime, timedelta
+
+        torrent = self.create_fake_torrent(name='Test metrics')
+        metrics = TransferMetrics()
+        start = datetime(2012, 1, 1, 10, 58)
+        for second in xrange(0, 180, 3):
+            metrics.add_sample((2000, 200), {torrent.hash: (1000 + second, 100), 'unknown hash': (10, 10)}, \
+                    now=start + timedelta(seconds=second))
+
+        minute_sample_list = TransferSample.objects.filter(resolution='minute', torrent=torrent).order_by('date')
+        self.assertEqual(len(minute_sample_list), 2) # Current minute not stored yet
+        self.assertEqual(minute_sample_list[0].download_rate, 1000 + 28.5)
+        self.assertEqual(minute_sample_list[0].max_download_rate, 1000 + 57)
+        self.assertEqual(minute_sample_list[0].nb_samples, 20)
+
+        hour_sample = TransferSample.objects.get(resolution='hour', torrent=torrent)
+        self.assertEqual(hour_sample.date, datetime(2012, 1, 1, 10, 0))
+        self.assertEqual(hour_sample.download_rate, 1000 + 58.5)
+        self.assertEqual(hour_sample.nb_samples, 40)
+
+        session_stats = TransferSample.objects.get_session_stats('hour', start - timedelta(hours=1))
+        self.assertEqual(session_stats['avg_download_rate'], 2000)
+        self.assertEqual(TransferSample.objects.filter(torrent=None).count(), 3)
+
+        # Rates of several workers added up - the hour is downsampled again by each of them
+        other_metrics = TransferMetrics()
+        for second in xrange(0, 180, 3):
+            other_metrics.add_sample((1000, 100), {}, now=start + timedelta(seconds=second))
+        self.assertEqual(TransferSample.objects.get(resolution='hour', torrent=None).download_rate, 3000)
+        session_stats = TransferSample.objects.get_session_stats('minute', start - timedelta(hours=1))
+        self.assertEqual(session_stats['avg_download_rate'], 3000)
+        self.assertEqual(session_stats['max_download_rate'], 3000)
+
+        # Hour left over by a worker which stopped, downsampled at the next start
+        restart = datetime(2012, 1, 1, 13, 30)
+        for minute in xrange(57, 60):
+            TransferSample(date=datetime(2012, 1, 1, 12, minute), resolution='minute', \
+                    download_rate=500, upload_rate=50, nb_samples=20).save()
+
+        restarted_metrics = TransferMetrics()
+        restarted_metrics.add_sample((500, 50), {}, now=restart)
+        self.assertEqual(TransferSample.objects.filter(resolution='hour', date=datetime(2012, 1, 1, 12, 0)).count(), 0)
+        restarted_metrics.add_sample((500, 50), {}, now=restart + timedelta(minutes=1))
+        self.assertEqual(TransferSample.objects.get(resolution='hour', date=datetime(2012, 1, 1, 12, 0)).download_rate, 500)
+
+    def test_download_worker_leases(self):
+        '''Download workers should only process the torrents they hold a lease on, and take over
+        the torrents of the workers which stopped'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+        from datetime import datetime, timedelta
+
+        torrent = self.create_fake_torrent(name='Test lease', status='Queued')
+        self.create_fake_torrent(name='Test lease other', status='Queued')
+
+        default_max_downloads_per_worker = settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER
+        settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER = 1
+        try:
+            manager_1 = TorrentDownloadManager(worker_name='1')
+            manager_2 = TorrentDownloadManager(worker_name='2')
+        finally:
+            settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER = default_max_downloads_per_worker
+        for manager in [manager_1, manager_2]:
+            manager.bt = Mock()
+            manager.scheduler.reconcile()
+
+        # Each worker gets one torrent (per-worker limit)
+        manager_1.update_queued_torrents()
+        self.assertEqual(manager_1.bt.add_magnet.call_count, 1)
+        self.assertEqual(Torrent.objects.get(id=torrent.id).lease_owner, manager_1.worker_id)
+        self.assertEqual(Torrent.objects.claim(torrent, manager_2.worker_id, 'Queued'), False)
+        manager_2.update_queued_torrents()
+        self.assertEqual(manager_2.bt.add_magnet.call_count, 1)
+        self.assertEqual(Torrent.objects.filter(status='Downloading', lease_owner=manager_2.worker_id).count(), 1)
+
+        # Worker 1 stops renewing its leases, worker 2 puts its torrent back in the queue
+        Torrent.objects.filter(lease_owner=manager_1.worker_id).update(lease_expires=datetime.now() - timedelta(seconds=1))
+        manager_2.update_leases()
+        self.assertEqual(Torrent.objects.get(id=torrent.id).status, 'Queued')
+        self.assertEqual(Torrent.objects.get(id=torrent.id).lease_owner, '')
+
+        # Worker 1 stops the torrent when it comes back
+        manager_1.update_leases()
+        manager_1.bt.remove_hash.assert_called_with(torrent.hash)
+        self.assertEqual(manager_1.scheduler.get_hash_list(), list())
+
+        # Preempted torrents keep their lease until they leave the session
+        torrent_paused = Torrent.objects.get(status='Downloading', lease_owner=manager_2.worker_id)
+        manager_2.bt.is_pausing.return_value = True
+        manager_2.paused_hash_set.add(torrent_paused.hash)
+        manager_2.set_status(torrent_paused, 'Queued')
+        manager_2.release_paused_torrents()
+        self.assertEqual(Torrent.objects.get(id=torrent_paused.id).lease_owner, manager_2.worker_id)
+        self.assertEqual(Torrent.objects.claim(torrent_paused, manager_1.worker_id, 'Queued'), False)
+
+        manager_2.bt.is_pausing.return_value = False
+        manager_2.release_paused_torrents()
+        self.assertEqual(Torrent.objects.get(id=torrent_paused.id).lease_owner, '')
+        self.assertEqual(manager_2.paused_hash_set, set())
+
+    def test_storage_eviction(self):
+        '''Downloads should only start when they fit on the disk, evicting transcoded videos 
+        originals then the least recently watched videos to make room'''
+
+        from wall.storagemanager import StorageManager
+        from datetime import datetime, timedelta
+        import json
+
+        # A completed episode, transcoded, with its original still on disk
+        torrent_done = self.create_fake_torrent(name='Test storage done', status='Completed')
+        self.create_fake_video(torrent_done.name, 'video.avi')
+        original_size = os.path.getsize(os.path.join(settings.TEST_DOWNLOAD_DIR, torrent_done.name, 'video.avi'))
+        video = Video(original_path=os.path.join(torrent_done.name, 'video.avi'), status='Completed')
+        video.save()
+        episode = Episode(number=1, tvdb_id=1, torrent=torrent_done, video=video)
+        episode.season = self.create_fake_season(name='Test storage')
+        episode.save()
+
+        # A queued torrent, which needs more space than available
+        torrent = self.create_fake_torrent(name='Test storage queued', status='Queued')
+        torrent.file_list = json.dumps([{'path': 'video.avi', 'size': original_size}])
+        torrent.save()
+
+        storage = StorageManager(bt=Mock())
+        storage.get_free_space = lambda path=None: settings.STORAGE_MIN_FREE_SPACE + original_size/2
+        self.assertEqual(storage.get_headroom(), original_size/2)
+
+        # Not while the torrent is seeding
+        self.assertEqual(storage.reserve([torrent]), [])
+        self.assertFalse(Video.objects.get(id=video.id).original_evicted)
+
+        storage.bt.get_handle_for_hash.return_value = None
+        self.assertEqual(storage.reserve([torrent]), [torrent])
+        self.assertTrue(Video.objects.get(id=video.id).original_evicted)
+        self.assertFalse(os.path.exists(video.full_path(video.original_path)))
+        self.assertEqual(storage.bt.remove_hash.call_count, 0)
+
+        # Nothing left to evict
+        torrent.progress = 0.25
+        self.assertEqual(storage.reserve([torrent]), [])
+
+        # Transcoded videos are evicted once watched, least recent first
+        self.create_fake_video(torrent_done.name, 'video.webm')
+        Video.objects.filter(id=video.id).update(webm_path=os.path.join(torrent_done.name, 'video.webm'), \
+                last_watched=datetime.now() - timedelta(days=1))
+        self.assertEqual(storage.reserve([torrent]), [torrent])
+        self.assertEqual(Video.objects.get(id=video.id).status, 'Evicted')
+        self.assertEqual(Episode.evicted_objects.get().id, episode.id)
+        self.assertEqual(self.client.get('/status/episode/evicted/').status_code, 200)
+
+        # Downloaded again when requested
+        self.assertEqual(Episode.evicted_objects.requeue_series(episode.season.series), 1)
+        self.assertEqual(Episode.objects.get(id=episode.id).video, None)
+        self.assertEqual(Torrent.objects.get(id=torrent_done.id).status, 'New')
+        self.assertEqual(Episode.evicted_objects.count(), 0)
+
+    def test_storage_queue(self):
+        '''Queued torrents which don't fit on the disk shouldn't prevent the next ones from starting'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+        import json
+
+        torrent_big = self.create_fake_torrent(name='Test storage big', status='Queued')
+        torrent_big.file_list = json.dumps([{'path': 'video.avi', 'size': 2000}])
+        torrent_big.priority = 10
+        torrent_big.save()
+        torrent_small = self.create_fake_torrent(name='Test storage small', status='Queued')
+        torrent_small.file_list = json.dumps([{'path': 'video.avi', 'size': 500}])
+        torrent_small.priority = 1
+        torrent_small.save()
+
+        default_max_downloads = settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER
+        settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER = 1
+        try:
+            manager = TorrentDownloadManager()
+            manager.bt = Mock()
+            manager.storage.get_free_space = lambda path=None: settings.STORAGE_MIN_FREE_SPACE + 1000
+            manager.storage.is_library_volume = lambda: False
+            manager.scheduler.reconcile()
+            self.assertEqual(manager.storage.reserve([]), [])
+
+            manager.update_queued_torrents()
+            self.assertEqual(Torrent.objects.get(id=torrent_big.id).status, 'Queued')
+            self.assertEqual(Torrent.objects.get(id=torrent_big.id).lease_owner, '')
+            self.assertEqual(Torrent.objects.get(id=torrent_small.id).status, 'Downloading')
+            manager.bt.add_magnet.assert_called_with(torrent_small.get_magnet())
+
+            # The download isn't paused for a torrent which wouldn't fit either
+            manager.update_queued_torrents()
+            self.assertEqual(manager.bt.pause_hash.call_count, 0)
+            self.assertEqual(Torrent.objects.get(id=torrent_small.id).status, 'Downloading')
+        finally:
+            settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER = default_max_downloads
+
+    def test_watch_video(self):
+        '''Videos should only be marked as watched when they are played, with a POST'''
+
+        video = Video(status='Completed')
+        video.save()
+        episode = Episode(number=1, tvdb_id=1, video=video)
+        episode.season = self.create_fake_season(name='Test watch')
+        episode.save()
+
+        self.assertEqual(self.client.get('/ajax/watch/%d/' % episode.id).status_code, 405)
+        self.assertEqual(Video.objects.get(id=video.id).last_watched, None)
+
+        self.assertEqual(self.client.post('/ajax/watch/%d/' % episode.id).status_code, 200)
+        self.assertNotEqual(Video.objects.get(id=video.id).last_watched, None)
+
+    def test_seeding_lifecycle(self):
+        '''Completed torrents should stop seeding after their ratio or seed time limit, with at
+        most BITTORRENT_MAX_SEEDS at once, deleting their files once transcoded if configured'''
+
+        from wall.seedmanager import SeedManager
+
+        torrent_ratio = self.create_fake_torrent(name='Test seed ratio', status='Completed')
+        torrent_time = self.create_fake_torrent(name='Test seed time', status='Completed')
+        torrent_low = self.create_fake_torrent(name='Test seed low', status='Completed')
+        torrent_high = self.create_fake_torrent(name='Test seed high', status='Completed')
+        torrent_downloading = self.create_fake_torrent(name='Test seed downloading', status='Downloading')
+
+        # The videos of the torrent which reached its ratio are all transcoded
+        video = Video(original_path=os.path.join(torrent_ratio.name, 'video.avi'), status='Completed')
+        video.save()
+        episode = Episode(number=1, tvdb_id=1, torrent=torrent_ratio, video=video)
+        episode.season = self.create_fake_season(name='Test seed')
+        episode.save()
+        self.assertTrue(torrent_ratio.is_transcoded())
+        self.assertFalse(torrent_time.is_transcoded())
+
+        bt = Mock()
+        bt.get_seed_stats_dict.return_value = {
+            torrent_ratio.hash: {'ratio': settings.BITTORRENT_SEED_RATIO, 'seeding_time': 0},
+            torrent_time.hash: {'ratio': 0.0, 'seeding_time': settings.BITTORRENT_SEED_TIME},
+            torrent_low.hash: {'ratio': 0.1, 'seeding_time': 0},
+            torrent_high.hash: {'ratio': 0.5, 'seeding_time': 0},
+            torrent_downloading.hash: {'ratio': 2.0, 'seeding_time': 0},
+        }
+
+        default_max_seeds = settings.BITTORRENT_MAX_SEEDS
+        default_delete_after_transcoding = settings.BITTORRENT_DELETE_AFTER_TRANSCODING
+        settings.BITTORRENT_MAX_SEEDS = 1
+        settings.BITTORRENT_DELETE_AFTER_TRANSCODING = True
+        try:
+            SeedManager().do(bt)
+        finally:
+            settings.BITTORRENT_MAX_SEEDS = default_max_seeds
+            settings.BITTORRENT_DELETE_AFTER_TRANSCODING = default_delete_after_transcoding
+
+        removed_dict = dict((call[0][0], call[1]['delete_files']) for call in bt.remove_hash.call_args_list)
+        self.assertEqual(removed_dict, {
+            torrent_ratio.hash: True,
+            torrent_time.hash: False,
+            torrent_high.hash: False,
+        })
+        bt.forget_hash.assert_called_with(torrent_ratio.hash)
+        self.assertTrue(Video.objects.get(id=video.id).original_evicted)
+
+    def test_stalled_download_abort(self):
+        '''Downloads projected to end too late should be cancelled, and their episodes searched
+        again without the failed torrent'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+        import time
+
+        torrent_slow = self.create_fake_torrent(name='Test stall slow', status='Downloading')
+        torrent_fast = self.create_fake_torrent(name='Test stall fast', status='Downloading')
+        torrent_new = self.create_fake_torrent(name='Test stall new', status='Downloading')
+
+        episode = Episode(number=1, tvdb_id=1, torrent=torrent_slow)
+        episode.season = self.create_fake_season(name='Test stall')
+        episode.save()
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        Torrent.objects.filter(status='Downloading').update(lease_owner=manager.worker_id)
+        manager.scheduler.reconcile()
+
+        # Progress one window ago - the new torrent has just been started
+        window_start = time.time() - settings.BITTORRENT_STALL_WINDOW - 1
+        manager.stall_detector.sample_dict[torrent_slow.hash] = [(window_start, 0.05)]
+        manager.stall_detector.sample_dict[torrent_fast.hash] = [(window_start, 0.05)]
+
+        # The slow torrent would need about 4 days more to complete, the fast one less than a day
+        torrent_bt_dict = dict()
+        for (torrent, progress) in [(torrent_slow, 0.06), (torrent_fast, 0.2), (torrent_new, 0.0)]:
+            torrent_bt_dict[torrent.hash] = Torrent(hash=torrent.hash, status='Downloading', progress=progress, seeds=1)
+        manager.bt.get_torrent_info_dict.return_value = torrent_bt_dict
+        manager.update_torrent_stats()
+
+        self.assertEqual(Torrent.objects.get(id=torrent_slow.id).status, 'Error')
+        self.assertEqual(Torrent.objects.get(id=torrent_fast.id).status, 'Downloading')
+        self.assertEqual(Torrent.objects.get(id=torrent_new.id).status, 'Downloading')
+        manager.bt.remove_hash.assert_called_with(torrent_slow.hash)
+        self.assertEqual(Episode.objects.get(id=episode.id).torrent, None)
+
+        # The failed torrent isn't used again
+        self.assertTrue(TorrentSearcher().is_failed_torrent(Torrent(hash=torrent_slow.hash)))
+        self.assertFalse(TorrentSearcher().is_failed_torrent(Torrent(hash=torrent_fast.hash)))
+
+    @patch.object(TorrentSearcher, 'get_tracker_list_for_torrent')
+    @patch.object(TorrentSearcher, 'search_torrent_by_string')
+    def test_torrent_candidate_fallback(self, mock_search_torrent_by_string, mock_get_tracker_list_for_torrent):
+        '''When a torrent fails, its episodes should fall back on the next search results
+        without searching again'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        episode = Episode(number=1, tvdb_id=1)
+        episode.season = self.create_fake_season(name='Test candidate')
+        episode.save()
+
+        result_list = list()
+        for (name, seeds) in [('first', 10), ('no seeds', 0), ('second', 5), ('third', 1)]:
+            result_list.append(Torrent(hash=self.generate_new_hash(), name='Test candidate %s' % name, seeds=seeds, peers=1))
+        mock_search_torrent_by_string.return_value = result_list
+        mock_get_tracker_list_for_torrent.return_value = None
+
+        torrent = TorrentSearcher().search_episode_torrent(episode)
+        episode.torrent = torrent
+        episode.save()
+        self.assertEqual(torrent.hash, result_list[0].hash)
+        self.assertEqual([candidate.hash for candidate in TorrentCandidate.objects.filter(episode=episode).order_by('rank')], \
+                [result_list[0].hash, result_list[2].hash, result_list[3].hash])
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+
+        manager.fail_torrent(torrent)
+        self.assertEqual(Episode.objects.get(id=episode.id).torrent.hash, result_list[2].hash)
+        self.assertEqual(Episode.objects.get(id=episode.id).torrent.status, 'New')
+
+        manager.fail_torrent(Episode.objects.get(id=episode.id).torrent)
+        manager.fail_torrent(Episode.objects.get(id=episode.id).torrent)
+        self.assertEqual(Episode.objects.get(id=episode.id).torrent.hash, result_list[3].hash)
+        self.assertEqual(Episode.objects.get(id=episode.id).torrent.status, 'Error')
+        self.assertEqual(mock_search_torrent_by_string.call_count, 1)
+
+        # Out of results - searched again right away, without the candidates left behind
+        self.assertEqual(TorrentCandidate.objects.filter(episode=episode).count(), 0)
+        self.assertEqual(Episode.objects.get(id=episode.id).next_search, None)
+
+        # Season candidates are pruned once none of the season episodes need them
+        other_episode = Episode(number=2, tvdb_id=2, season=episode.season)
+        other_episode.save()
+        TorrentCandidate.objects.save_candidates(result_list[:1], season=episode.season)
+        TorrentCandidate.objects.prune_candidates(Episode.objects.get(id=episode.id))
+        self.assertEqual(TorrentCandidate.objects.filter(season=episode.season).count(), 1)
+
+        for video_episode in Episode.objects.filter(season=episode.season):
+            video_episode.video = Video(status='Completed')
+            video_episode.video.save()
+            video_episode.save()
+        TorrentCandidate.objects.prune_candidates(Episode.objects.get(id=episode.id))
+        self.assertEqual(TorrentCandidate.objects.filter(season=episode.season).count(), 0)
+
+    @patch.object(TorrentSearcher, 'get_tracker_list_for_torrent')
+    @patch.object(TorrentzSearcher, 'get_result_page')
+    def test_episode_search_pages(self, mock_get_result_page, mock_get_tracker_list_for_torrent):
+        '''The search for an episode should stop at the first page of results with a usable 
+        torrent, and only retrieve the next pages once all of its results failed'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        episode = Episode(number=1, tvdb_id=1)
+        episode.season = self.create_fake_season(name='Test pages')
+        episode.save()
+
+        page_list = [[Torrent(hash=self.generate_new_hash(), name='Test pages %d-%d' % (page, i), seeds=page*i) \
+                for i in xrange(3)] for page in xrange(3)] + [list()]
+        mock_get_result_page.side_effect = lambda search_string, page: iter(page_list[page])
+        mock_get_tracker_list_for_torrent.return_value = None
+        searcher = TorrentzSearcher()
+
+        # The first page has no usable result
+        torrent = searcher.search_episode_torrent(episode)
+        self.assertEqual(torrent.hash, page_list[1][2].hash)
+        self.assertEqual(mock_get_result_page.call_count, 2)
+        self.assertEqual([candidate.hash for candidate in TorrentCandidate.objects.filter(episode=episode).order_by('rank')], \
+                [page_list[1][2].hash, page_list[1][1].hash])
+
+        # The next page is retrieved once the candidates all failed
+        episode.torrent = torrent
+        episode.save()
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.fail_torrent(torrent)
+        manager.fail_torrent(Episode.objects.get(id=episode.id).torrent)
+        self.assertEqual(mock_get_result_page.call_count, 2)
+
+        episode = Episode.objects.get(id=episode.id)
+        torrent = searcher.search_episode_torrent(episode)
+        self.assertEqual(torrent.hash, page_list[2][2].hash)
+        self.assertEqual([call[0][1] for call in mock_get_result_page.call_args_list], [0, 1, 2])
+
+    def test_scratch_storage(self):
+        '''With a scratch directory, completed torrents should be moved to the library 
+        before their episodes are packaged'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+        from wall.packagemanager import PackageManager
+        import json
+
+        torrent = self.create_fake_torrent(name='Test scratch', status='Downloading')
+        torrent.completed_files = json.dumps([0])
+        torrent.file_list = json.dumps([{'path': 'Test scratch/Test.scratch.s02e01.avi', 'size': 1}])
+        torrent.save()
+        episode = Episode(number=1, tvdb_id=1, torrent=torrent)
+        episode.season = self.create_fake_season(name='Test scratch')
+        episode.save()
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.bt.get_torrent_info.return_value = Torrent(name='Test scratch', has_metadata=True, seeds=10, peers=10)
+        manager.bt.is_storage_moved.return_value = False
+        Torrent.objects.filter(id=torrent.id).update(lease_owner=manager.worker_id)
+
+        default_scratch_dir = settings.SCRATCH_DIR
+        settings.SCRATCH_DIR = os.path.join(settings.TEST_DOWNLOAD_DIR, 'scratch')
+        try:
+            # No per-file packaging from the scratch directory, even for the completed files
+            self.assertEqual(torrent.get_storage_dir(), settings.SCRATCH_DIR)
+            self.assertFalse(torrent.is_episode_completed(episode))
+            PackageManager().do()
+            self.assertEqual(Episode.objects.get(id=episode.id).video, None)
+
+            # The files are moved in the background, the torrent keeps its lease meanwhile
+            manager.on_torrent_finished(torrent, Mock())
+            manager.bt.move_storage.assert_called_with(torrent.hash, settings.DOWNLOAD_DIR)
+            self.assertEqual(Torrent.objects.get(id=torrent.id).status, 'Moving')
+            self.assertEqual(Torrent.objects.get(id=torrent.id).lease_owner, manager.worker_id)
+            self.assertEqual(Episode.processing_objects.filter(id=episode.id).count(), 1)
+
+            manager.update_moving_torrents()
+            self.assertEqual(Torrent.objects.get(id=torrent.id).status, 'Moving')
+
+            manager.bt.is_storage_moved.return_value = True
+            manager.update_moving_torrents()
+            torrent = Torrent.objects.get(id=torrent.id)
+            self.assertEqual(torrent.status, 'Completed')
+            self.assertEqual(torrent.get_storage_dir(), settings.DOWNLOAD_DIR)
+            self.assertTrue(torrent.is_episode_completed(episode))
+
+            # Move interrupted by a worker which stopped - finished by another one
+            from datetime import datetime, timedelta
+
+            torrent_moving = self.create_fake_torrent(name='Test scratch moving', status='Moving')
+            mkdir_p(os.path.join(settings.SCRATCH_DIR, torrent_moving.name, 'Subs'))
+            for path in ['Test.scratch.s02e02.avi', 'Subs/Test.scratch.s02e02.srt']:
+                open(os.path.join(settings.SCRATCH_DIR, torrent_moving.name, path), 'w').close()
+            torrent_moved = self.create_fake_torrent(name='Test scratch moved', status='Moving')
+            Torrent.objects.filter(id__in=[torrent_moving.id, torrent_moved.id])\
+                    .update(lease_owner='stopped worker', lease_expires=datetime.now() - timedelta(seconds=1))
+
+            self.assertEqual(Torrent.objects.reclaim_expired_leases(), 2)
+            self.assertEqual(Torrent.objects.get(id=torrent_moving.id).status, 'Moving')
+            self.assertEqual(Torrent.objects.get(id=torrent_moving.id).lease_owner, '')
+            self.assertEqual(Torrent.objects.get(id=torrent_moved.id).status, 'Completed')
+
+            manager.update_moving_torrents()
+            self.assertEqual(Torrent.objects.get(id=torrent_moving.id).status, 'Completed')
+            self.assertFalse(os.path.exists(os.path.join(settings.SCRATCH_DIR, torrent_moving.name)))
+            self.assertTrue(os.path.exists(os.path.join(settings.DOWNLOAD_DIR, torrent_moving.name, \
+                    'Subs/Test.scratch.s02e02.srt')))
+        finally:
+            settings.SCRATCH_DIR = default_scratch_dir
+
+    def test_session_tuning(self):
+        '''The session profile should follow the measured throughput & memory use, and be 
+        recorded with the transfer rates'''
+
+        from wall.sessiontuning import SessionTuner, SESSION_PROFILE_DICT, SESSION_PROFILE_MAX_RATE, apply_session_profile
+        from wall.metrics import TransferMetrics
+        from datetime import datetime, timedelta
+
+        class FakeSessionSettings:
+            cache_size = 0
+            connections_limit = 0
+
+        session_settings = apply_session_profile(FakeSessionSettings(), 'low-memory')
+        self.assertEqual(session_settings.cache_size, SESSION_PROFILE_DICT['low-memory']['cache_size'])
+        self.assertFalse(hasattr(session_settings, 'aio_threads'))
+
+        tuner = SessionTuner('balanced')
+        now = time.time() + settings.BITTORRENT_AUTO_TUNING_INTERVAL
+
+        # Throughput limited by the profile
+        tuner.add_sample(SESSION_PROFILE_MAX_RATE['balanced'], 0)
+        self.assertEqual(tuner.get_profile(memory_usage=0, now=now-1), 'balanced') # Still measuring
+        self.assertEqual(tuner.get_profile(memory_usage=0, now=now), 'high-throughput')
+
+        # Too much memory used
+        tuner.add_sample(SESSION_PROFILE_MAX_RATE['balanced'], 0)
+        now += settings.BITTORRENT_AUTO_TUNING_INTERVAL
+        self.assertEqual(tuner.get_profile(memory_usage=settings.BITTORRENT_AUTO_TUNING_MAX_MEMORY+1, now=now), 'balanced')
+
+        # Low throughput
+        tuner.add_sample(0, 0)
+        now += settings.BITTORRENT_AUTO_TUNING_INTERVAL
+        self.assertEqual(tuner.get_profile(memory_usage=0, now=now), 'low-memory')
+
+        # Profile recorded in the metrics, for each hour
+        metrics = TransferMetrics()
+        start = datetime(2012, 1, 1, 10, 59)
+        metrics.add_sample((1000, 100), {}, now=start, profile='balanced')
+        metrics.add_sample((2000, 100), {}, now=start + timedelta(minutes=1), profile='low-memory')
+        metrics.add_sample((2000, 100), {}, now=start + timedelta(minutes=2), profile='low-memory')
+        self.assertEqual(TransferSample.objects.get(resolution='minute', date=start).profile, 'balanced')
+        self.assertEqual(TransferSample.objects.get(resolution='hour', date=datetime(2012, 1, 1, 10, 0)).profile, 'balanced')
+
+    def test_tracker_scrape_ranking(self):
+        '''Search results should be re-ranked from the swarm health reported by their trackers,
+        with a single scrape request per tracker'''
+
+        from wall.trackerscraper import TrackerScraper, bdecode, get_scrape_url
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        import threading, binascii, urlparse
+
+        self.assertEqual(bdecode('d5:filesd3:abcd8:completei3e10:incompletei-1eee4:listl1:ai0eee'), \
+                {'files': {'abc': {'complete': 3, 'incomplete': -1}}, 'list': ['a', 0]})
+        self.assertEqual(get_scrape_url('http://tracker/announce.php?passkey=1'), 'http://tracker/scrape.php?passkey=1')
+        self.assertEqual(get_scrape_url('http://tracker/tracker.php'), None)
+
+        torrent_dead = Torrent(hash=self.generate_new_hash(), name='Test scrape dead', seeds=100, peers=1)
+        torrent_alive = Torrent(hash=self.generate_new_hash(), name='Test scrape alive', seeds=10, peers=1)
+        torrent_unknown = Torrent(hash=self.generate_new_hash(), name='Test scrape unknown', seeds=5, peers=1)
+        torrent_other = Torrent(hash=self.generate_new_hash(), name='Test scrape other', seeds=1, peers=1)
+        swarm_dict = {torrent_dead.hash: (0, 3), torrent_alive.hash: (50, 20)}
+
+        # Local tracker stand-in
+        request_list = list()
+        class ScrapeHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                request_list.append(url)
+                files = ''
+                for binary_hash in sorted(urlparse.parse_qs(url.query)['info_hash']):
+                    hash = binascii.hexlify(binary_hash)
+                    if hash in swarm_dict:
+                        files += '20:%sd8:completei%de10:incompletei%dee' % ((binary_hash,) + swarm_dict[hash])
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write('d5:filesd%see' % files)
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), ScrapeHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+
+        tracker_url_list = json.dumps(['http://127.0.0.1:%d/announce' % server.server_port])
+        for torrent in [torrent_dead, torrent_alive, torrent_unknown, torrent_other]:
+            torrent.tracker_url_list = tracker_url_list
+
+        default_http_requests_delay = settings.HTTP_REQUESTS_DELAY
+        default_scrape_candidates = settings.TORRENT_SCRAPE_CANDIDATES
+        settings.HTTP_REQUESTS_DELAY = 0
+        settings.TORRENT_SCRAPE_CANDIDATES = 3
+        try:
+            ranked_list = list(TorrentSearcher().rank_by_swarm_health([torrent_dead, torrent_unknown, torrent_alive, torrent_other]))
+            thread.join()
+
+            self.assertEqual(len(request_list), 1)
+            self.assertEqual(request_list[0].path, '/scrape')
+            self.assertEqual(len(urlparse.parse_qs(request_list[0].query)['info_hash']), 3)
+            self.assertEqual([torrent.name for torrent in ranked_list], \
+                    ['Test scrape alive', 'Test scrape unknown', 'Test scrape other'])
+            self.assertEqual((ranked_list[0].seeds, ranked_list[0].peers), (50, 20))
+
+            # The trackers of the results are only looked up until one has more live seeds than the others
+            torrent_alive.seeds = 10
+            for torrent in [torrent_alive, torrent_unknown, torrent_other]:
+                torrent.tracker_url_list = ''
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            searcher = TorrentSearcher()
+            searcher.get_tracker_list_for_torrent = Mock(return_value=json.loads(tracker_url_list))
+            ranked_list = list(searcher.rank_by_swarm_health([torrent_unknown, torrent_alive, torrent_other]))
+            thread.join()
+
+            self.assertEqual(searcher.get_tracker_list_for_torrent.call_count, 1)
+            self.assertEqual(len(request_list), 2)
+            self.assertEqual([torrent.name for torrent in ranked_list], \
+                    ['Test scrape alive', 'Test scrape unknown', 'Test scrape other'])
+
+            # Malformed hashes are skipped, without preventing the others from being scraped
+            scrape_url = 'http://127.0.0.1:%d/scrape' % server.server_port
+            self.assertEqual(TrackerScraper().scrape(scrape_url, ['abc', 'z'*40]), dict())
+            self.assertEqual(len(request_list), 2)
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            health_dict = TrackerScraper().scrape(scrape_url, ['abc', torrent_alive.hash.lower()])
+            thread.join()
+            self.assertEqual(health_dict, {torrent_alive.hash.lower(): (50, 20)})
+        finally:
+            settings.HTTP_REQUESTS_DELAY = default_http_requests_delay
+            settings.TORRENT_SCRAPE_CANDIDATES = default_scrape_candidates
+            server.server_close()
+
+    def test_candidate_prefetch(self):
+        '''With prefetching, the metadata of the other best search results should be retrieved
+        alongside the torrent, and the episodes downloaded from the one with the best files'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        torrent = self.create_fake_torrent(name='Test prefetch', status='Downloading metadata', type='season')
+        season = self.create_fake_season(name='Test prefetch')
+        episode_list = list()
+        for number in (1, 2):
+            episode = Episode(number=number, tvdb_id=number, torrent=torrent, season=season)
+            episode.save()
+            episode_list.append(episode)
+
+        candidate_hash = self.generate_new_hash()
+        TorrentCandidate.objects.create(season=season, rank=0, hash=torrent.hash, name=torrent.name, type='season')
+        TorrentCandidate.objects.create(season=season, rank=1, hash=candidate_hash, name='Test prefetch 2', type='season')
+        TorrentCandidate.objects.create(season=season, rank=2, hash=self.generate_new_hash(), name='Test prefetch 3', type='season')
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.bt.get_torrent_info.return_value = Torrent(name='Test prefetch', has_metadata=True, \
+                file_list=json.dumps([{'path': 'Test prefetch/Season 2.iso', 'size': 4000}]))
+        manager.bt.get_torrent_info_dict.return_value = {candidate_hash: Torrent(name='Test prefetch 2', has_metadata=True, \
+                file_list=json.dumps([{'path': 'Test prefetch 2/Test.S02E01.avi', 'size': 300}, \
+                                      {'path': 'Test prefetch 2/Test.S02E02.avi', 'size': 300}]))}
+        Torrent.objects.filter(id=torrent.id).update(lease_owner=manager.worker_id)
+
+        default_prefetch_candidates = settings.TORRENT_PREFETCH_CANDIDATES
+        settings.TORRENT_PREFETCH_CANDIDATES = 2
+        try:
+            manager.prefetch_candidates()
+            self.assertEqual(manager.prefetch_dict.keys(), [candidate_hash])
+            self.assertTrue(candidate_hash in manager.bt.add_magnet.call_args[0][0])
+            self.assertEqual(manager.scheduler.get_hash_list(), [candidate_hash])
+
+            # The torrent waits for the search results being prefetched
+            manager.on_metadata_received(Torrent.objects.get(id=torrent.id), Mock())
+            self.assertEqual(Torrent.objects.get(id=torrent.id).status, 'Downloading metadata')
+            self.assertEqual(manager.metadata_wait_set, set([torrent.hash]))
+
+            # Its disc image contains none of the episodes, unlike the second result
+            manager.update_prefetched_candidates()
+            self.assertEqual(manager.prefetch_dict, dict())
+            self.assertEqual(manager.metadata_wait_set, set())
+            self.assertEqual(manager.scheduler.get_hash_list(), list())
+            self.assertNotEqual(TorrentCandidate.objects.get(hash=candidate_hash).file_list, '')
+            self.assertEqual(Torrent.objects.get(id=torrent.id).status, 'Error')
+            for episode in episode_list:
+                self.assertEqual(Episode.objects.get(id=episode.id).torrent.hash, candidate_hash)
+                self.assertEqual(Episode.objects.get(id=episode.id).torrent.status, 'New')
+        finally:
+            settings.TORRENT_PREFETCH_CANDIDATES = default_prefetch_candidates
+
+    def test_host_rate_limiting(self):
+        '''Requests should be limited per host by a token bucket, and torrent searches
+        should run concurrently'''
+
+        from wall.ratelimit import TokenBucket, get_host_bucket
+        from wall.torrentsearcher import TorrentSearchManager
+        import threading
+
+        bucket = TokenBucket(2, capacity=2)
+        self.assertEqual(bucket.reserve(now=100), 0)
+        self.assertEqual(bucket.reserve(now=100), 0)
+
+        # Requests arriving at once wait for their turn
+        self.assertEqual(bucket.reserve(now=100), 2)
+        self.assertEqual(bucket.reserve(now=100), 4)
+
+        # Tokens come back over time, up to the capacity of the bucket
+        self.assertEqual(bucket.reserve(now=106), 0)
+        self.assertEqual(bucket.reserve(now=1000), 0)
+        self.assertEqual(bucket.reserve(now=1000), 0)
+        self.assertEqual(bucket.reserve(now=1000), 2)
+
+        default_http_requests_delay = settings.HTTP_REQUESTS_DELAY
+        default_http_host_requests_delay = settings.HTTP_HOST_REQUESTS_DELAY
+        default_torrent_search_workers = settings.TORRENT_SEARCH_WORKERS
+        settings.HTTP_REQUESTS_DELAY = 0
+        settings.HTTP_HOST_REQUESTS_DELAY = {'slow.example.com': 10}
+        settings.TORRENT_SEARCH_WORKERS = 4
+        try:
+            self.assertEqual(get_host_bucket('fast.example.com'), None)
+            self.assertEqual(get_host_bucket('slow.example.com').delay, 10)
+            self.assertTrue(get_host_bucket('slow.example.com') is get_host_bucket('slow.example.com'))
+
+            searched_dict = dict()
+            def search(number):
+                time.sleep(0.05)
+                searched_dict[number] = threading.current_thread().name
+
+            TorrentSearchManager().run_workers(search, range(20))
+            self.assertEqual(sorted(searched_dict.keys()), range(20))
+            self.assertTrue(len(set(searched_dict.values())) > 1)
+        finally:
+            settings.HTTP_REQUESTS_DELAY = default_http_requests_delay
+            settings.HTTP_HOST_REQUESTS_DELAY = default_http_host_requests_delay
+            settings.TORRENT_SEARCH_WORKERS = default_torrent_search_workers
+
+    @patch.object(TorrentSearcher, 'search_torrent_by_string')
+    def test_search_result_cache(self, mock_search_torrent_by_string):
+        '''Searches should be reused until they expire, without sharing the returned objects,
+        and the least recently used ones should be dropped'''
+
+        from wall.searchcache import SearchResultCache
+
+        torrent = Torrent(hash=self.generate_new_hash(), name='Test cache', seeds=10, peers=10)
+        mock_search_torrent_by_string.return_value = [torrent]
+        searcher = TorrentSearcher()
+
+        torrent_list = list(searcher.get_search_results('Test cache', 's02e01'))
+        torrent_list[0].type = 'season'
+        torrent_list = list(searcher.get_search_results('test  CACHE', 's02e01'))
+        self.assertEqual(mock_search_torrent_by_string.call_count, 1)
+        self.assertEqual(torrent_list[0].hash, torrent.hash)
+        self.assertEqual(torrent_list[0].type, '')
+        self.assertFalse(torrent_list[0] is torrent)
+
+        list(searcher.get_search_results('Test cache'))
+        self.assertEqual(mock_search_torrent_by_string.call_count, 2)
+        mock_search_torrent_by_string.assert_called_with('Test cache')
+
+        cache = SearchResultCache()
+        default_cache_size = settings.TORRENT_SEARCH_CACHE_SIZE
+        settings.TORRENT_SEARCH_CACHE_SIZE = 2
+        try:
+            cache.set('full', [torrent], now=100)
+            cache.set('empty', list(), now=100)
+            self.assertEqual(cache.get('empty', now=100 + settings.TORRENT_SEARCH_CACHE_NEGATIVE_TTL - 1), list())
+            self.assertEqual(cache.get('empty', now=100 + settings.TORRENT_SEARCH_CACHE_NEGATIVE_TTL), None)
+            self.assertEqual(len(cache.get('full', now=100 + settings.TORRENT_SEARCH_CACHE_TTL - 1)), 1)
+            self.assertEqual(cache.get('full', now=100 + settings.TORRENT_SEARCH_CACHE_TTL), None)
+
+            cache.set('first', [torrent], now=100)
+            cache.set('second', [torrent], now=100)
+            cache.get('first', now=100)
+            cache.set('third', [torrent], now=100)
+            self.assertEqual(cache.get('second', now=100), None)
+            self.assertNotEqual(cache.get('first', now=100), None)
+            self.assertNotEqual(cache.get('third', now=100), None)
+        finally:
+            settings.TORRENT_SEARCH_CACHE_SIZE = default_cache_size
+
+    @patch('wall.torrentsearcher.TorrentSearchManager.run_workers')
+    def test_failed_episode_research(self, mock_run_workers):
+        '''Episodes without torrent should be searched again after an exponential backoff,
+        within the hourly budget of searches'''
+
+        from wall.torrentsearcher import TorrentSearchManager
+        from datetime import datetime, timedelta
+
+        now = datetime.now()
+        season = self.create_fake_season(name='Test research')
+
+        episode = Episode(number=1, tvdb_id=1, season=season)
+        default_research_jitter = settings.TORRENT_RESEARCH_JITTER
+        settings.TORRENT_RESEARCH_JITTER = 0
+        try:
+            episode.schedule_search(now=now)
+            self.assertEqual(episode.next_search, now + timedelta(seconds=settings.TORRENT_RESEARCH_DELAY))
+            episode.schedule_search(now=now)
+            self.assertEqual(episode.next_search, now + timedelta(seconds=2*settings.TORRENT_RESEARCH_DELAY))
+            episode.search_attempts = 100
+            episode.schedule_search(now=now)
+            self.assertEqual(episode.next_search, now + timedelta(seconds=settings.TORRENT_RESEARCH_MAX_DELAY))
+        finally:
+            settings.TORRENT_RESEARCH_JITTER = default_research_jitter
+
+        # Random jitter
+        episode.search_attempts = 0
+        episode.schedule_search(now=now)
+        self.assertTrue(abs(episode.next_search - now - timedelta(seconds=settings.TORRENT_RESEARCH_DELAY)) \
+                <= timedelta(seconds=settings.TORRENT_RESEARCH_DELAY * settings.TORRENT_RESEARCH_JITTER))
+
+        failed_episode_dict = dict()
+        for (number, search_attempts, next_search) in [(2, 0, None), (3, 2, now - timedelta(hours=1)), (4, 1, now + timedelta(hours=1))]:
+            torrent = Torrent(hash=self.generate_new_hash(), status='Error')
+            torrent.save()
+            failed_episode_dict[number] = Episode(number=number, tvdb_id=number, season=season, torrent=torrent, \
+                    search_attempts=search_attempts, next_search=next_search)
+            failed_episode_dict[number].save()
+        Episode(number=5, tvdb_id=5, season=season, last_retry=now - timedelta(minutes=10)).save()
+
+        default_research_per_hour = settings.TORRENT_RESEARCH_PER_HOUR
+        settings.TORRENT_RESEARCH_PER_HOUR = 3
+        try:
+            TorrentSearchManager().search_failed_episodes()
+            self.assertEqual([episode.id for episode in mock_run_workers.call_args[0][1]], \
+                    [failed_episode_dict[2].id, failed_episode_dict[3].id])
+
+            # Over budget
+            settings.TORRENT_RESEARCH_PER_HOUR = 2
+            TorrentSearchManager().search_failed_episodes()
+            self.assertEqual([episode.id for episode in mock_run_workers.call_args[0][1]], [failed_episode_dict[2].id])
+
+            settings.TORRENT_RESEARCH_PER_HOUR = 1
+            TorrentSearchManager().search_failed_episodes()
+            self.assertEqual(mock_run_workers.call_count, 2)
+        finally:
+            settings.TORRENT_RESEARCH_PER_HOUR = default_research_per_hour
+
+    @patch.object(FederatedSearcher, 'get_searcher_list')
+    def test_federated_search(self, mock_get_searcher_list):
+        '''The federated searcher should merge the results of all the searchers, without
+        waiting for the ones which are too slow'''
+
+        class FakeSearcher:
+            def __init__(self, name, torrent_list, delay=0):
+                self.name = name
+                self.torrent_list = torrent_list
+                self.delay = delay
+
+            def get_search_results(self, name, episode_search_string=None):
+                time.sleep(self.delay)
+                return self.torrent_list
+
+        (hash1, hash2) = (self.generate_new_hash(), self.generate_new_hash())
+        fast_searcher = FakeSearcher('fast', [Torrent(hash=hash1.upper(), name='Test federated 1', seeds='5', peers='20')])
+        other_searcher = FakeSearcher('other', [Torrent(hash=hash1, name='Test federated 1', seeds='8', peers='2'), \
+                Torrent(hash=hash2, name='Test federated 2', seeds='3', peers=None)])
+        slow_searcher = FakeSearcher('slow', [Torrent(hash=self.generate_new_hash(), name='Test federated 3', seeds='50')], delay=5)
+
+        default_federated_timeouts = settings.TORRENT_FEDERATED_TIMEOUTS
+        default_federated_enough_seeds = settings.TORRENT_FEDERATED_ENOUGH_SEEDS
+        settings.TORRENT_FEDERATED_TIMEOUTS = {'slow': 0.2}
+        settings.TORRENT_FEDERATED_ENOUGH_SEEDS = 0
+        try:
+            # Duplicates are merged, slow searchers are ignored
+            mock_get_searcher_list.return_value = [fast_searcher, other_searcher, slow_searcher]
+            start_time = time.time()
+            torrent_list = FederatedSearcher().search_torrent_by_string('Test federated', 's02e01')
+            self.assertTrue(time.time() - start_time < 2)
+            self.assertEqual([(torrent.hash.lower(), torrent.seeds, torrent.peers) for torrent in torrent_list], \
+                    [(hash1, 8, 20), (hash2, 3, 0)])
+
+            # No need to wait when a good enough result was found
+            settings.TORRENT_FEDERATED_TIMEOUTS = dict()
+            settings.TORRENT_FEDERATED_ENOUGH_SEEDS = 5
+            mock_get_searcher_list.return_value = [fast_searcher, slow_searcher]
+            start_time = time.time()
+            torrent_list = FederatedSearcher().search_torrent_by_string('Test federated')
+            self.assertTrue(time.time() - start_time < 2)
+            self.assertEqual(len(torrent_list), 1)
+
+            # Only the results needed are retrieved from the searchers
+            consumed_list = list()
+            def iter_results(name, episode_search_string=None):
+                for i in xrange(100):
+                    consumed_list.append(i)
+                    yield Torrent(hash=self.generate_new_hash(), name='Test federated %d' % i, seeds=(i == 3 and 10 or 1))
+            lazy_searcher = FakeSearcher('lazy', None)
+            lazy_searcher.get_search_results = iter_results
+            mock_get_searcher_list.return_value = [lazy_searcher]
+
+            torrent_list = FederatedSearcher().search_torrent_by_string('Test federated')
+            self.assertEqual(len(torrent_list), 4)
+            self.assertEqual(len(consumed_list), 4)
+
+            del consumed_list[:]
+            settings.TORRENT_FEDERATED_ENOUGH_SEEDS = 0
+            torrent_list = FederatedSearcher().search_torrent_by_string('Test federated')
+            self.assertEqual(len(torrent_list), settings.TORRENT_SEARCH_MAX_CANDIDATES)
+            self.assertEqual(len(consumed_list), settings.TORRENT_SEARCH_MAX_CANDIDATES)
+        finally:
+            settings.TORRENT_FEDERATED_TIMEOUTS = default_federated_timeouts
+            settings.TORRENT_FEDERATED_ENOUGH_SEEDS = default_federated_enough_seeds
+
+    @patch.object(TorrentSearcher, 'get_plugins_qs')
+    def test_plugin_registry(self, mock_get_plugins_qs):
+        '''Active plugins should be loaded once, until the plugins tables change'''
+
+        from wall.plugins import get_active_plugin, clear_plugin_registry
+        from djangoplugins.models import Plugin
+        from django.db.models.signals import post_save
+
+        active_plugin = Mock()
+        active_plugin.get_plugin.return_value = TorrentzSearcher()
+        mock_get_plugins_qs.return_value = [active_plugin]
+
+        clear_plugin_registry()
+        default_plugin_registry_ttl = settings.PLUGIN_REGISTRY_TTL
+        try:
+            plugin = get_active_plugin(TorrentSearcher)
+            self.assertTrue(isinstance(plugin, TorrentzSearcher))
+            self.assertTrue(get_active_plugin(TorrentSearcher) is plugin)
+            self.assertEqual(mock_get_plugins_qs.call_count, 1)
+            self.assertEqual(active_plugin.get_plugin.call_count, 1)
+
+            # Plugins changed
+            post_save.send(sender=Plugin, instance=Mock(), created=False)
+            self.assertEqual(get_active_plugin(TorrentSearcher), plugin)
+            self.assertEqual(mock_get_plugins_qs.call_count, 2)
+
+            # Changes from other processes
+            settings.PLUGIN_REGISTRY_TTL = 0
+            get_active_plugin(TorrentSearcher)
+            get_active_plugin(TorrentSearcher)
+            self.assertEqual(mock_get_plugins_qs.call_count, 4)
+
+            mock_get_plugins_qs.return_value = list()
+            self.assertRaises(NoActivePlugin, get_active_plugin, TorrentSearcher)
+        finally:
+            settings.PLUGIN_REGISTRY_TTL = default_plugin_registry_ttl
+            clear_plugin_registry()
+
+    @patch.object(TorrentzSearcher, 'get_result_page')
+    def test_paged_search(self, mock_get_result_page):
+        '''Result pages should only be retrieved when their results are consumed, and
+        cached as far as they were retrieved'''
+
+        import itertools
+
+        page_list = [[Torrent(hash=self.generate_new_hash(), name='Test paged %d-%d' % (page, i), seeds=1) \
+                for i in xrange(3)] for page in xrange(2)] + [list()]
+        mock_get_result_page.side_effect = lambda search_string, page: iter(page_list[page])
+        searcher = TorrentzSearcher()
+
+        # Early termination - the next pages are never retrieved
+        result_iter = searcher.get_search_results('Test paged')
+        self.assertEqual([torrent.name for torrent in itertools.islice(result_iter, 2)], ['Test paged 0-0', 'Test paged 0-1'])
+        result_iter.close()
+        self.assertEqual(mock_get_result_page.call_count, 1)
+
+        # Further pages on demand - the search resumes after the pages in the cache
+        torrent_list = list(itertools.islice(searcher.get_search_results('Test paged'), 4))
+        self.assertEqual([torrent.name for torrent in torrent_list], \
+                ['Test paged 0-0', 'Test paged 0-1', 'Test paged 0-2', 'Test paged 1-0'])
+        self.assertEqual([call[0][1] for call in mock_get_result_page.call_args_list], [0, 1])
+
+        # Until the last page
+        self.assertEqual(len(list(searcher.get_search_results('Test paged'))), 6)
+        self.assertEqual(len(list(searcher.get_search_results('Test paged'))), 6)
+        self.assertEqual([call[0][1] for call in mock_get_result_page.call_args_list], [0, 1, 2])
+
+        # Plugins only returning lists keep working, with the first page of results
+        self.assertEqual(len(searcher.search_torrent_by_string('Test paged', 's02e01')), 3)
+        self.assertEqual(len(list(TorrentSearcher.iter_torrent_by_string(searcher, 'Test paged', 's02e01'))), 3)
+
+    def test_torrent_download_alerts(self):
+        '''Torrents states should follow the alerts posted by libtorrent'''
+
+        from wall.torrentdownloader import TorrentDownloadManager
+
+        torrent_metadata = self.create_fake_torrent(name='Test alert metadata', status='Downloading metadata')
+        torrent_finished = self.create_fake_torrent(name='Test alert finished', status='Downloading')
+        torrent_error = self.create_fake_torrent(name='Test alert error', status='Downloading')
+        torrent_unchanged = self.create_fake_torrent(name='Test alert unchanged', status='Downloading')
+
+        manager = TorrentDownloadManager()
+        manager.bt = Mock()
+        manager.bt.pop_torrent_alerts.return_value = [
+                ('metadata_received_alert', torrent_metadata.hash, Mock()),
+                ('torrent_finished_alert', torrent_finished.hash, Mock()),
+                ('torrent_error_alert', torrent_error.hash, Mock()),
+                ('torrent_finished_alert', 'unknown hash', Mock())]
+        manager.bt.get_torrent_info.return_value = Torrent(name='Test alert', has_metadata=True, seeds=10, peers=10)
+        manager.next_stats_update = time.time() + 3600 # Only test alerts
+
+        manager.update_from_alerts()
+
+        self.assertEqual(Torrent.objects.get(id=torrent_metadata.id).status, 'Queued')
+        self.assertEqual(Torrent.objects.get(id=torrent_finished.id).status, 'Completed')
+        self.assertEqual(Torrent.objects.get(id=torrent_error.id).status, 'Error')
+        self.assertEqual(Torrent.objects.get(id=torrent_unchanged.id).status, 'Downloading')
+        self.assertIn(((torrent_metadata.hash,), {}), manager.bt.remove_hash.call_args_list)
+        self.assertIn(((torrent_error.hash,), {}), manager.bt.remove_hash.call_args_list)
+
     def dump_test_db(self):
         '''Writes the current DB state to a JSON file
         To be used with ./manage.py testserver <file> for later exploration'''
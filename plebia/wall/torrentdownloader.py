@@ -20,14 +20,25 @@
 
 # Includes ##########################################################
 
-from wall.models import Torrent
-from wall.cache import get_cache, set_cache
+from wall.models import Torrent, Episode, TorrentCandidate
+from wall.cache import get_cache
+from wall.checkpoint import SessionCheckpointer
+from wall.metrics import TransferMetrics
+from wall.storagemanager import StorageManager
+from wall.seedmanager import SeedManager
+from wall.stalldetector import StallDetector
+from wall.sessiontuning import SessionTuner, apply_session_profile
+from wall.torrentpriority import TorrentPrioritizer
+from wall.torrentmagic import TorrentFileMagic
+from wall.helpers import mkdir_p, write_file_atomic
 from django.db.models import Q
 from django.conf import settings
 
 import libtorrent as lt
+import socket
 import time
 import re
+import os
 import subprocess
 
 
@@ -37,20 +48,79 @@ from plebia.log import get_logger
 log = get_logger(__name__)
 
 
+# Functions #########################################################
+
+def get_worker_id(worker_name=None):
+    '''Identifier of the current download worker, unique among the workers of all the hosts'''
+
+    worker_id = settings.BITTORRENT_WORKER_ID or socket.gethostname()
+    if worker_name:
+        worker_id = '%s-%s' % (worker_id, worker_name)
+
+    return worker_id
+
+def move_payload(torrent, from_dir, to_dir):
+    '''Move the files of a torrent (its root file or directory) between two directories - the
+    files left behind by an interrupted move are added to the ones already moved'''
+
+    import shutil
+
+    from_path = os.path.join(from_dir, torrent.name)
+    to_path = os.path.join(to_dir, torrent.name)
+    if not os.path.exists(from_path):
+        return
+
+    if not os.path.isdir(from_path) or not os.path.isdir(to_path):
+        shutil.move(from_path, to_path)
+        return
+
+    for (dir_path, dir_name_list, file_name_list) in os.walk(from_path):
+        to_dir_path = os.path.join(to_path, os.path.relpath(dir_path, from_path))
+        mkdir_p(to_dir_path)
+        for file_name in file_name_list:
+            shutil.move(os.path.join(dir_path, file_name), os.path.join(to_dir_path, file_name))
+    shutil.rmtree(from_path)
+
+
 # Models ############################################################
 
 class TorrentDownloadManager:
-    '''Bittorrent client'''
-
-    def __init__(self):
+    '''Bittorrent client
+    Several download workers can run at once, each with its own bittorrent session, on one or
+    more hosts sharing DOWNLOAD_DIR. Each worker holds leases on the torrents it processes,
+    renewed every tick - the torrents of a worker which stops renewing them are put back 
+    in the queue for the other workers.'''
+
+    def __init__(self, worker_name=None):
+        self.worker_id = get_worker_id(worker_name)
         self.bt = None
+        self.scheduler = SlotScheduler(self.worker_id)
+        self.next_stats_update = 0
+        self.next_priority_update = 0
+        self.next_lease_renewal = 0
+        self.checkpointer = SessionCheckpointer(self.worker_id)
+        self.metrics = TransferMetrics()
+        self.storage = StorageManager()
+        self.seeds = SeedManager()
+        self.stall_detector = StallDetector()
+        if settings.BITTORRENT_AUTO_TUNING:
+            self.tuner = SessionTuner(settings.BITTORRENT_SESSION_PROFILE)
+        else:
+            self.tuner = None
+        self.resume_list = list()
+        self.pending_file_selection = set()
+        self.prefetch_dict = dict() # {hash: start time} of the search results being prefetched
+        self.metadata_wait_set = set() # Torrents with metadata waiting for the prefetched results
+        self.paused_hash_set = set() # Preempted torrents, leased until they leave the session
 
     def check_started(self):
         '''Check if the bittorrent client is already started, and start it if not'''
 
         if self.bt is None:
-            self.bt = Bittorrent()
+            self.bt = Bittorrent(dht_state=self.checkpointer.load('dht'))
+            self.storage.bt = self.bt
             self.resume_downloads()
+            self.scheduler.reconcile()
 
     def resume_downloads(self):
         '''Use model states to know which torrents were running the last time
@@ -58,12 +128,42 @@ class TorrentDownloadManager:
 
         torrent_list = Torrent.objects.filter(\
                 Q(status='Downloading metadata') | \
-                Q(status='Downloading'))\
+                Q(status='Downloading') | \
+                Q(status='Moving'))\
+                .filter(Q(lease_owner=self.worker_id) | Q(lease_owner=''))\
                 .order_by('-date_added')
 
         for torrent in torrent_list:
-            # Reset downloads (libtorrent will find the files and resume on his own)
-            torrent.set_status('New')
+            # Torrents of this worker, or without worker (started before workers had leases)
+            if not Torrent.objects.claim(torrent, self.worker_id, torrent.status):
+                continue
+
+            if not self.bt.has_saved_metadata(torrent.hash):
+                # Reset downloads (libtorrent will find the files and resume on his own)
+                self.set_status(torrent, 'New')
+            elif torrent.status == 'Downloading metadata':
+                # Metadata was retrieved, but the torrent wasn't queued yet
+                self.set_status(torrent, 'Queued')
+            else:
+                # Re-add in its previous state, from the saved metadata and resume data - 
+                # interrupted moves restart from the scratch disk, once the files are checked
+                self.resume_list.append(torrent)
+
+    def resume_pending_downloads(self):
+        '''Re-add the downloads interrupted by the last restart, without having 
+        more than BITTORRENT_MAX_CHECKING torrents checking their files at once'''
+
+        if not self.resume_list:
+            return
+
+        nb_resumable = settings.BITTORRENT_MAX_CHECKING - self.bt.get_nb_checking()
+        while nb_resumable > 0 and self.resume_list:
+            torrent = self.resume_list.pop(0)
+            log.info("Resuming download of torrent %s", torrent)
+            self.bt.add_magnet(torrent.get_magnet())
+            self.set_status(torrent, 'Downloading') # Restart the timeouts
+            self.pending_file_selection.add(torrent.hash)
+            nb_resumable -= 1
 
     def do(self):
         '''Do the periodic update'''
@@ -73,8 +173,29 @@ class TorrentDownloadManager:
         # and not for the other maintenance routines (each of them is started in his own process)
         self.check_started()
 
-        # Save current DHT state to allow to retreive it later if restarted
-        self.bt.save_dht_state()
+        # Keep the torrents of this worker, take over the ones of stopped workers
+        self.update_leases()
+
+        # Save the DHT state & the resume data of the torrents regularly, to be able to restart quickly
+        self.checkpointer.do(self.bt)
+
+        # Record the transfer rates
+        session_stats = self.bt.get_session_stats()
+        self.metrics.add_sample((session_stats['download_rate'], session_stats['upload_rate']), \
+                self.bt.get_rate_dict(), profile=self.bt.profile)
+
+        # Adapt the session settings to the measured throughput & memory use
+        if self.tuner is not None:
+            self.tuner.add_sample(session_stats['download_rate'], session_stats['upload_rate'])
+            profile = self.tuner.get_profile()
+            if profile != self.bt.profile:
+                self.bt.set_profile(profile)
+
+        # Keep some free space on the disk
+        self.storage.ensure_free_space()
+
+        # Restart downloads interrupted by the last restart
+        self.resume_pending_downloads()
 
         # Log
         log.info("Remaining torrents: %d, DHT: %d, DL: %d, DHT: %s, queue: %s", \
@@ -84,127 +205,724 @@ class TorrentDownloadManager:
                     self.bt.dht_stats(), \
                     self.bt.queue_stats())
 
-        # Update currently downloading torrents (& mark ones completed)
-        self.update_downloading_torrents()
+        if settings.BITTORRENT_USE_ALERTS:
+            # Only move torrents between states when libtorrent reports a change
+            self.update_from_alerts()
+        else:
+            # Fallback: poll the status of each torrent on every iteration
+            self.update_from_polling()
+
+        # Let the other workers start the preempted torrents, once they left the session
+        self.release_paused_torrents()
+
+        # Compare the files of the prefetched search results with the ones of their torrents
+        self.update_prefetched_candidates()
+
+        # Completed torrents moved from the scratch disk to the library
+        self.update_moving_torrents()
+
+        # Stop seeding the completed torrents which gave back enough
+        self.seeds.do(self.bt)
+
+        # Admit the most urgent torrents first
+        self.update_priorities()
 
         # Start queued downloads when there's room
         self.update_queued_torrents()
 
+        # Only download the files of the episodes we need from season packs
+        self.update_file_selections()
+
+        # Download the videos being watched in order, as fast as possible
+        self.update_streaming()
+
+        # Start downloading metadata for new torrents when there is room
+        self.start_metadata_downloads()
+
+        # Then for the other best search results of their episodes
+        self.prefetch_candidates()
+
+    def update_leases(self):
+        '''Renew the leases of the torrents processed by this worker, put back in the queue the
+        torrents of the workers whose leases expired, and stop the torrents whose lease 
+        was lost (if this worker was stalled for longer than the lease duration)'''
+
+        if time.time() < self.next_lease_renewal:
+            return
+        self.next_lease_renewal = time.time() + settings.BITTORRENT_LEASE_DURATION / 3
+
+        Torrent.objects.renew_leases(self.worker_id)
+
+        nb_reclaimed = Torrent.objects.reclaim_expired_leases()
+        if nb_reclaimed > 0:
+            log.warn("Took over %d torrents from download workers which stopped", nb_reclaimed)
+
+        leased_hash_set = set(self.get_leased_objects().values_list('hash', flat=True))
+        for hash in self.scheduler.get_hash_list():
+            if hash not in leased_hash_set and hash not in self.prefetch_dict:
+                log.warn("Lost the lease of torrent hash %s, stopping it", hash)
+                self.bt.remove_hash(hash)
+                self.scheduler.release(hash)
+
+    def get_leased_objects(self):
+        '''Torrents processed by this worker'''
+
+        return Torrent.objects.filter(lease_owner=self.worker_id)
+
+    def update_from_polling(self):
+        '''Update the torrents states by querying libtorrent for each of them'''
+
+        # Alerts are not used to change states, but still need to be processed
+        self.bt.pop_torrent_alerts()
+
+        # Update currently downloading torrents (& mark ones completed)
+        self.update_downloading_torrents()
+
         # Queue torrents for which metadata has been received,
         # Cancel torrents for which metadata retrieval takes too long
         self.update_downloading_metadata_torrents()
 
-        # Start downloading metadata for new torrents when there is room
-        self.start_metadata_downloads()
+    def update_from_alerts(self):
+        '''Update the torrents states from the alerts posted by libtorrent since the last
+        iteration. Timeouts are checked against the DB, and the statistics of each torrent
+        (progress, speed, seeds...) are only refreshed every BITTORRENT_STATS_INTERVAL seconds'''
+
+        for (alert_type, hash, alert) in self.bt.pop_torrent_alerts():
+            self.handle_alert(alert_type, hash, alert)
+
+        # Cancel torrents for which metadata retrieval takes too long
+        self.cancel_metadata_timeouts()
+
+        if time.time() >= self.next_stats_update:
+            self.next_stats_update = time.time() + settings.BITTORRENT_STATS_INTERVAL
+            self.update_torrent_stats()
+
+    def handle_alert(self, alert_type, hash, alert):
+        '''Apply the state change corresponding to a single libtorrent alert'''
+
+        handler_dict = {
+                'metadata_received_alert': self.on_metadata_received,
+                'torrent_finished_alert': self.on_torrent_finished,
+                'torrent_error_alert': self.on_torrent_error,
+                'state_changed_alert': self.on_state_changed,
+                }
+
+        if alert_type not in handler_dict:
+            return
+
+        try:
+            torrent = Torrent.objects.get(hash=hash)
+        except Torrent.DoesNotExist:
+            log.info("Received %s for unknown torrent hash %s, ignoring", alert_type, hash)
+            return
+
+        log.debug("Received %s for torrent %s", alert_type, torrent)
+        handler_dict[alert_type](torrent, alert)
+
+    def on_metadata_received(self, torrent, alert):
+        '''Queue torrents for which metadata has been received'''
+
+        self.bt.save_metadata(torrent.hash)
+
+        if torrent.status != 'Downloading metadata':
+            return
+
+        log.info("Retrieved metadata for torrent %s", torrent)
+        torrent.update_from_torrent(self.bt.get_torrent_info(torrent))
+        self.queue_torrent(torrent)
+
+    def on_torrent_finished(self, torrent, alert):
+        '''Mark torrents which are completed'''
+
+        if torrent.status != 'Downloading':
+            return
+
+        log.info("Completed downloading torrent %s", torrent)
+        torrent.update_from_torrent(self.bt.get_torrent_info(torrent))
+        self.complete_torrent(torrent)
+
+    def on_torrent_error(self, torrent, alert):
+        '''Cancel downloads which libtorrent reports in error'''
+
+        if torrent.status != 'Downloading metadata' and torrent.status != 'Downloading':
+            return
+
+        log.warn("Error downloading torrent %s: %s", torrent, alert.message())
+        self.fail_torrent(torrent)
+
+    def on_state_changed(self, torrent, alert):
+        '''Catch completions which were not reported by a torrent_finished alert'''
+
+        if 'seeding' in str(alert.state) or 'finished' in str(alert.state):
+            self.on_torrent_finished(torrent, alert)
+
+    def cancel_metadata_timeouts(self):
+        '''Cancel torrents for which metadata retrieval takes too long'''
+
+        from datetime import datetime, timedelta
+
+        timeout_time = datetime.now() - timedelta(seconds=settings.BITTORRENT_METADATA_TIMEOUT)
+        torrent_list = self.get_leased_objects().filter(\
+                Q(status='Downloading metadata'), \
+                Q(last_status_change__lt=timeout_time))\
+                .exclude(hash__in=list(self.metadata_wait_set))
+
+        for torrent in torrent_list:
+            log.warn("Did not retreive metadata in time for torrent %s, cancelling.", torrent)
+            self.fail_torrent(torrent)
+            torrent.seeds = -1 # Differentiate from those with metadata but without seeds
+            torrent.save()
+
+    def update_torrent_stats(self):
+        '''Refresh the statistics of active torrents, and cancel downloads which
+        are still without seeds after some time'''
+
+        torrent_list = list(self.get_leased_objects().filter(\
+                Q(status='Downloading metadata') | \
+                Q(status='Downloading'))\
+                .order_by('last_status_change'))
+
+        # Update misc info of torrents
+        torrent_bt_dict = self.bt.get_torrent_info_dict(torrent_list)
+        Torrent.objects.bulk_update_from_torrents(torrent_list, torrent_bt_dict)
+
+        for torrent_db in torrent_list:
+            torrent_bt = torrent_bt_dict.get(torrent_db.hash)
+
+            # Cancel downloads still without seeds after some time
+            if torrent_bt is not None and torrent_db.status == 'Downloading' and torrent_bt.seeds == 0 and \
+                    torrent_db.is_timeout(settings.BITTORRENT_DOWNLOAD_NOSEED_TIMEOUT):
+                log.warn("No seeds found for torrent %s", torrent_db)
+                self.fail_torrent(torrent_db)
+
+        # Cancel downloads too slow to finish in time
+        self.abort_stalled_downloads(torrent_list, torrent_bt_dict)
 
     def start_metadata_downloads(self):
         '''Start downloading metadata for new torrents when there is room'''
         
-        torrent_list = Torrent.objects.filter(\
-                Q(status='New'))\
-                .order_by('last_status_change')
+        torrent_list = self.scheduler.admit('New', 'Downloading metadata')
 
         for torrent in torrent_list:
-            if self.has_free_metadata_slot():
-                log.info("Starting to retrieve metadata for torrent %s", torrent)
-                self.bt.add_magnet(torrent.get_magnet())
-                torrent.set_status('Downloading metadata')
+            log.info("Starting to retrieve metadata for torrent %s", torrent)
+            self.bt.add_magnet(torrent.get_magnet())
+
+        self.set_status_batch(torrent_list, 'Downloading metadata')
 
     def has_free_metadata_slot(self):
         '''Check if there is room for adding a new metadata download'''
         
-        return Torrent.objects.filter(status='Downloading metadata').count() < settings.BITTORRENT_MAX_METADATA_DOWNLOADS
+        return self.scheduler.get_nb_free_slots('Downloading metadata') > 0
 
     def update_downloading_metadata_torrents(self):
         '''See if torrents currently downloading metadata need update'''
 
-        torrent_list = Torrent.objects.filter(\
+        torrent_list = list(self.get_leased_objects().filter(\
                 Q(status='Downloading metadata'))\
-                .order_by('last_status_change')
+                .order_by('last_status_change'))
+
+        # Update misc info of torrents
+        torrent_bt_dict = self.bt.get_torrent_info_dict(torrent_list)
+        Torrent.objects.bulk_update_from_torrents(torrent_list, torrent_bt_dict)
 
         for torrent in torrent_list:
-            # Update misc info of torrent
-            torrent_bt = self.bt.get_torrent_info(torrent)
-            torrent.update_from_torrent(torrent_bt)
+            torrent_bt = torrent_bt_dict.get(torrent.hash)
+
+            # Already retrieved, waiting for the metadata of other search results
+            if torrent.hash in self.metadata_wait_set:
+                continue
 
             # Cancel torrents for which metadata retrieval takes too long 
             if torrent.is_timeout(settings.BITTORRENT_METADATA_TIMEOUT):
                 log.warn("Did not retreive metadata in time for torrent %s, cancelling.", torrent)
-                self.bt.remove_hash(torrent.hash)
-
-                torrent.set_status('Error')
+                self.fail_torrent(torrent)
                 torrent.seeds = -1 # Differentiate from those with metadata but without seeds
                 torrent.save()
 
             # Queue torrents for which metadata has been received
-            if torrent_bt.has_metadata:
+            elif torrent_bt is not None and torrent_bt.has_metadata:
                 log.info("Retrieved metadata for torrent %s", torrent)
-                self.bt.remove_hash(torrent.hash)
-                torrent.set_status('Queued')
+                self.bt.save_metadata(torrent.hash)
+                self.queue_torrent(torrent)
 
-    def update_queued_torrents(self):
-        '''Start queued downloads when there's room'''
+    def queue_torrent(self, torrent):
+        '''Queue a torrent whose metadata has been received - or the prefetched search result
+        with the best files for its episodes. Waits for the search results still being prefetched.'''
 
-        torrent_list = Torrent.objects.filter(\
-                Q(status='Queued')) \
-                .order_by('last_status_change')
+        self.bt.remove_hash(torrent.hash)
+
+        if [hash for hash in TorrentCandidate.objects.get_prefetch_hash_list(torrent) if hash in self.prefetch_dict]:
+            log.info("Waiting for the metadata of other search results before queuing torrent %s", torrent)
+            self.metadata_wait_set.add(torrent.hash)
+            return
+
+        self.metadata_wait_set.discard(torrent.hash)
+        if not self.switch_to_best_candidate(torrent):
+            self.set_status(torrent, 'Queued')
+
+    def switch_to_best_candidate(self, torrent):
+        '''Move the episodes of a torrent to the prefetched search result with the best files for
+        them, when it has video files for more of the episodes than the torrent. The torrent is 
+        then abandoned. Returns True if the episodes were moved.'''
+
+        if not settings.TORRENT_PREFETCH_CANDIDATES:
+            return False
+
+        episode_list = list(torrent.episode_set.filter(video=None))
+        if not episode_list:
+            return False
+
+        (candidate, score) = TorrentCandidate.objects.get_best_prefetched(torrent, episode_list)
+        torrent_score = TorrentFileMagic(torrent).get_score(episode_list)
+        if candidate is None or score[0] <= torrent_score[0]:
+            return False
+
+        log.info("Search result %s has files for %d episodes, against %d for torrent %s - downloading it instead", \
+                candidate, score[0], torrent_score[0], torrent)
+        Episode.objects.filter(id__in=[episode.id for episode in episode_list])\
+                .update(torrent=candidate.get_torrent())
+        self.set_status(torrent, 'Error')
+        return True
+
+    def prefetch_candidates(self):
+        '''Retrieve the metadata of the best search results for the episodes of the torrents
+        retrieving their metadata, in the free metadata slots, to download the one with the best
+        files. The torrents themselves are started first, by start_metadata_downloads().'''
+
+        if not settings.TORRENT_PREFETCH_CANDIDATES:
+            return
+
+        nb_free_slots = self.scheduler.get_nb_free_slots('Downloading metadata')
+        if nb_free_slots == 0:
+            return
+
+        torrent_list = self.get_leased_objects().filter(status='Downloading metadata')\
+                .exclude(hash__in=list(self.metadata_wait_set))\
+                .order_by('-priority', 'last_status_change')
 
         for torrent in torrent_list:
-            if self.has_free_download_slot():
+            for hash in TorrentCandidate.objects.get_prefetch_hash_list(torrent):
+                if hash in self.prefetch_dict:
+                    continue
+                if nb_free_slots == 0:
+                    return
+
+                log.info("Prefetching metadata of search result %s for torrent %s", hash, torrent)
+                self.bt.add_magnet(Torrent(hash=hash).get_magnet())
+                self.scheduler.take(hash, 'Downloading metadata')
+                self.prefetch_dict[hash] = time.time()
+                nb_free_slots -= 1
+
+    def update_prefetched_candidates(self):
+        '''Store the files of the prefetched search results once their metadata is received, 
+        then queue the torrents which were waiting for them. Search results whose metadata
+        can't be found in time are dropped.'''
+
+        if self.prefetch_dict:
+            torrent_bt_dict = self.bt.get_torrent_info_dict([Torrent(hash=hash) for hash in self.prefetch_dict])
+        else:
+            torrent_bt_dict = dict()
+
+        for (hash, start_time) in self.prefetch_dict.items():
+            torrent_bt = torrent_bt_dict.get(hash)
+            if torrent_bt is not None and torrent_bt.has_metadata:
+                log.info("Prefetched metadata of search result %s", hash)
+                self.bt.save_metadata(hash)
+                TorrentCandidate.objects.filter(hash=hash).update(file_list=torrent_bt.file_list)
+            elif torrent_bt is not None and time.time() - start_time < settings.BITTORRENT_METADATA_TIMEOUT:
+                continue
+            else:
+                log.info("Could not prefetch metadata of search result %s, dropping it", hash)
+                TorrentCandidate.objects.filter(hash=hash).delete()
+
+            self.bt.remove_hash(hash)
+            self.scheduler.release(hash)
+            del self.prefetch_dict[hash]
+
+        if not self.metadata_wait_set:
+            return
+
+        torrent_list = list(self.get_leased_objects().filter(status='Downloading metadata', \
+                hash__in=list(self.metadata_wait_set)))
+        self.metadata_wait_set.intersection_update([torrent.hash for torrent in torrent_list])
+        for torrent in torrent_list:
+            self.queue_torrent(torrent)
+
+    def update_priorities(self):
+        '''Update the priority of the torrents waiting or being downloaded, 
+        every BITTORRENT_PRIORITY_INTERVAL seconds'''
+
+        if time.time() < self.next_priority_update:
+            return
+        self.next_priority_update = time.time() + settings.BITTORRENT_PRIORITY_INTERVAL
+
+        torrent_list = list(Torrent.processing_objects.all())
+        priority_dict = TorrentPrioritizer().get_priority_dict(torrent_list)
+        Torrent.objects.bulk_set_priority(torrent_list, priority_dict)
+
+    def update_queued_torrents(self):
+        '''Start queued downloads when there's room'''
+
+        # Make room for urgent torrents
+        self.preempt_download()
+
+        # Torrents which don't fit on the disk stay queued, without blocking the next ones
+        rejected_hash_list = list()
+        while True:
+            torrent_list = self.scheduler.admit('Queued', 'Downloading', exclude_hash_list=rejected_hash_list)
+            if not torrent_list:
+                return
+
+            # Only start the downloads which fit on the disk
+            admitted_list = self.storage.reserve(torrent_list)
+            for torrent in torrent_list:
+                if torrent not in admitted_list:
+                    if torrent.hash not in self.paused_hash_set:
+                        Torrent.objects.release(torrent)
+                    rejected_hash_list.append(torrent.hash)
+
+            for torrent in admitted_list:
                 log.info("Starting to download torrent %s", torrent)
                 self.bt.add_magnet(torrent.get_magnet())
-                torrent.set_status('Downloading')
+                self.pending_file_selection.add(torrent.hash)
+
+            self.set_status_batch(admitted_list, 'Downloading')
+
+            if len(admitted_list) == len(torrent_list):
+                return
+
+    def update_file_selections(self):
+        '''Select the files to download in the torrents which were just started - for season
+        packs, only the files of the episodes which don't have a video yet, in the order 
+        of the episodes. The files are selected once the torrent metadata is available.'''
+
+        if not self.pending_file_selection:
+            return
+
+        torrent_list = list(Torrent.objects.filter(hash__in=list(self.pending_file_selection), \
+                status='Downloading', type='season'))
+        self.pending_file_selection.intersection_update([torrent.hash for torrent in torrent_list])
+
+        # Status of the torrents whose metadata wasn't known yet, gathered at once
+        metadata_list = [torrent for torrent in torrent_list if not torrent.file_list]
+        torrent_bt_dict = metadata_list and self.bt.get_torrent_info_dict(metadata_list) or dict()
+
+        for torrent in torrent_list:
+            hash = torrent.hash
+            if not torrent.file_list:
+                torrent_bt = torrent_bt_dict.get(hash)
+                if torrent_bt is None or not torrent_bt.has_metadata:
+                    continue # Retry on next iteration
+                torrent.file_list = torrent_bt.file_list
+
+            self.pending_file_selection.discard(hash)
+
+            episode_list = list(Episode.objects.filter(torrent=torrent, video=None))
+            priority_list = TorrentFileMagic(torrent).get_file_priority_list(episode_list)
+            if priority_list is None:
+                log.info("Could not match files to episodes for torrent %s, downloading all files", torrent)
+                continue
+
+            log.info("Downloading %d/%d files of torrent %s", \
+                    len([p for p in priority_list if p > 0]), len(priority_list), torrent)
+            self.bt.set_file_priorities(hash, priority_list)
+
+    def update_streaming(self):
+        '''Set deadlines on the next pieces of the files being streamed, and publish 
+        how much of each of them can be read'''
+
+        from datetime import datetime, timedelta
+
+        torrent_list = self.get_leased_objects().filter(status='Downloading').exclude(streaming_file=None)
+
+        abandon_time = datetime.now() - timedelta(seconds=settings.BITTORRENT_STREAMING_TIMEOUT)
+        for torrent in torrent_list:
+            if torrent.streaming_requested is None or torrent.streaming_requested < abandon_time:
+                log.info("Stopping to stream torrent %s, not requested anymore", torrent)
+                self.stop_streaming(torrent)
+                # Back to the file priorities of its episodes
+                self.pending_file_selection.add(torrent.hash)
+                continue
+
+            readable_bytes = self.bt.get_streaming_bytes(torrent.hash, torrent.streaming_file)
+            if readable_bytes is not None and readable_bytes != torrent.streaming_bytes:
+                log.debug("Streaming torrent %s: %d bytes readable", torrent, readable_bytes)
+                Torrent.objects.filter(id=torrent.id).update(streaming_bytes=readable_bytes)
+
+    def stop_streaming(self, torrent):
+        '''Forget the file of a torrent being streamed'''
+
+        Torrent.objects.filter(id=torrent.id).update(streaming_file=None, streaming_bytes=0, streaming_requested=None)
+        torrent.streaming_file = None
+        torrent.streaming_bytes = 0
+        torrent.streaming_requested = None
+
+    def preempt_download(self):
+        '''When all download slots are used, pause the lowest priority download if a queued
+        torrent has a much higher priority. The paused torrent goes back to the queue, and 
+        its resume data is saved before it is removed from libtorrent, so it doesn't need
+        to be checked again once it gets a slot again.'''
+
+        if not settings.BITTORRENT_PREEMPTION or self.has_free_download_slot():
+            return
+
+        try:
+            downloading_torrent = self.get_leased_objects().filter(status='Downloading')\
+                    .order_by('priority', '-last_status_change')[0]
+        except IndexError:
+            return
+
+        # Only for a torrent which can be admitted once the download is paused - the ones
+        # too large for the disk would otherwise pause a download on every iteration
+        queued_list = Torrent.objects.filter(status='Queued', \
+                priority__gte=downloading_torrent.priority + settings.BITTORRENT_PREEMPTION_MARGIN)\
+                .order_by('-priority', 'last_status_change')
+        for queued_torrent in queued_list:
+            if self.storage.can_reserve(queued_torrent, nb_freed_bytes=downloading_torrent.get_remaining_size()):
+                log.info("Pausing download of torrent %s (priority %s) for torrent %s (priority %s)", \
+                        downloading_torrent, downloading_torrent.priority, queued_torrent, queued_torrent.priority)
+                self.bt.pause_hash(downloading_torrent.hash)
+                self.paused_hash_set.add(downloading_torrent.hash)
+                self.set_status(downloading_torrent, 'Queued')
+                return
+
+    def release_paused_torrents(self):
+        '''Release the leases of the torrents paused by preempt_download() once they have been
+        removed from the session - another worker could otherwise add them while this one still 
+        holds their handle'''
+
+        for hash in list(self.paused_hash_set):
+            if self.bt.is_pausing(hash):
+                continue
+
+            Torrent.objects.filter(hash=hash, status='Queued', lease_owner=self.worker_id)\
+                    .update(lease_owner='', lease_expires=None)
+            self.paused_hash_set.discard(hash)
 
     def has_free_download_slot(self):
         '''Check if there is room for adding a new download (does not include metadata downloads)'''
         
-        return Torrent.objects.filter(status='Downloading').count() < settings.BITTORRENT_MAX_DOWNLOADS
+        return self.scheduler.get_nb_free_slots('Downloading') > 0
+
+    def complete_torrent(self, torrent):
+        '''Mark a downloaded torrent as completed. When downloading to SCRATCH_DIR, its files are
+        moved to the library (DOWNLOAD_DIR) first, in the background - it keeps seeding meanwhile.'''
+
+        if torrent.streaming_file is not None:
+            self.stop_streaming(torrent)
+
+        if not settings.SCRATCH_DIR:
+            self.set_status(torrent, 'Completed')
+        elif self.bt.move_storage(torrent.hash, settings.DOWNLOAD_DIR):
+            log.info("Moving torrent %s to the library", torrent)
+            self.set_status(torrent, 'Moving')
+        else:
+            log.warn("Torrent %s is not in the session, moving its files directly", torrent)
+            move_payload(torrent, settings.SCRATCH_DIR, settings.DOWNLOAD_DIR)
+            self.set_status(torrent, 'Completed')
+
+    def update_moving_torrents(self):
+        '''Mark the torrents whose files have been moved to the library as completed'''
+
+        for torrent in self.get_leased_objects().filter(status='Moving'):
+            if self.bt.is_storage_moved(torrent.hash, settings.DOWNLOAD_DIR):
+                log.info("Moved torrent %s to the library", torrent)
+                self.set_status(torrent, 'Completed')
+
+        # Moves interrupted by a worker which stopped (see TorrentManager.reclaim_expired_leases())
+        for torrent in Torrent.objects.filter(status='Moving', lease_owner=''):
+            if Torrent.objects.claim(torrent, self.worker_id, 'Moving'):
+                log.info("Finishing to move torrent %s to the library", torrent)
+                if settings.SCRATCH_DIR:
+                    move_payload(torrent, settings.SCRATCH_DIR, settings.DOWNLOAD_DIR)
+                self.set_status(torrent, 'Completed')
+
+    def fail_torrent(self, torrent):
+        '''Stop a torrent which can't be downloaded, and mark it in error. Its episodes
+        fall back on the next results of their search, when there are some.'''
+
+        self.bt.remove_hash(torrent.hash)
+        self.bt.forget_hash(torrent.hash)
+        self.set_status(torrent, 'Error')
+        torrent.promote_candidates()
+
+    def set_status(self, torrent, new_status):
+        '''Change the status of a torrent, keeping track of the slot it uses. The lease of 
+        the torrent is released when it leaves the download states.'''
+
+        if new_status not in self.scheduler.limit_dict and new_status != 'Moving' and \
+                not (new_status == 'Queued' and torrent.hash in self.paused_hash_set):
+            torrent.lease_owner = ''
+            torrent.lease_expires = None
+
+        torrent.set_status(new_status)
+        self.scheduler.update(torrent)
+
+    def set_status_batch(self, torrent_list, new_status):
+        '''Change the status of a list of torrents at once'''
+
+        Torrent.objects.bulk_set_status(torrent_list, new_status)
+        for torrent in torrent_list:
+            self.scheduler.update(torrent)
 
     def update_downloading_torrents(self):
         '''Update currently downloading torrents'''
 
-        torrent_list = Torrent.objects.filter(\
+        torrent_list = list(self.get_leased_objects().filter(\
                 Q(status='Downloading'))\
-                .order_by('last_status_change')
+                .order_by('last_status_change'))
+
+        # Update misc info of torrents
+        torrent_bt_dict = self.bt.get_torrent_info_dict(torrent_list)
+        Torrent.objects.bulk_update_from_torrents(torrent_list, torrent_bt_dict)
         
         for torrent_db in torrent_list:
-            torrent_bt = self.bt.get_torrent_info(torrent_db)
+            torrent_bt = torrent_bt_dict.get(torrent_db.hash)
+            if torrent_bt is None:
+                log.info("Torrent %s is not in the download queue", torrent_db)
+                continue
 
-            # Mark torrents which are completed
+            # Mark torrents which are completed (or whose selected files are all downloaded)
             if torrent_bt.status == 'Completed':
                 log.info("Completed downloading torrent %s", torrent_db)
-                torrent_db.set_status('Completed')
+                self.complete_torrent(torrent_db)
 
             # Cancel downloads which don't find seeds/error, etc.
             elif torrent_bt.status == 'Error':
                 log.warn("Error downloading torrent %s", torrent_db)
-                self.bt.remove_hash(torrent_db.hash)
-                torrent_db.set_status('Error')
+                self.fail_torrent(torrent_db)
 
             # Cancel downloads still without seeds after some time
             elif torrent_db.is_timeout(settings.BITTORRENT_DOWNLOAD_NOSEED_TIMEOUT) and torrent_bt.seeds == 0:
                 log.warn("No seeds found for torrent %s", torrent_db)
-                self.bt.remove_hash(torrent_db.hash)
-                torrent_db.set_status('Error')
+                self.fail_torrent(torrent_db)
+
+        # Cancel downloads too slow to finish in time
+        self.abort_stalled_downloads(torrent_list, torrent_bt_dict)
+
+    def abort_stalled_downloads(self, torrent_list, torrent_bt_dict):
+        '''Cancel the downloads projected to end after BITTORRENT_STALL_MAX_ETA, to free their
+        slot - their episodes are searched again, without this torrent'''
+
+        torrent_dict = dict((torrent.hash, torrent) for torrent in torrent_list \
+                if torrent.status == 'Downloading' and torrent.hash in torrent_bt_dict)
+        self.stall_detector.update(dict((hash, torrent_bt_dict[hash].progress) for hash in torrent_dict))
+
+        for hash in self.stall_detector.get_stalled_list():
+            torrent = torrent_dict[hash]
+            log.warn("Download of torrent %s is too slow (%.1f%% done, projected to end in %.0f seconds), cancelling", \
+                    torrent, torrent_bt_dict[hash].progress*100, self.stall_detector.get_projected_eta(hash))
+            self.fail_torrent(torrent)
+            nb_episodes = torrent.release_episodes()
+            if nb_episodes > 0:
+                log.info("Searching again for %d episodes of torrent %s", nb_episodes, torrent)
+
+
+class SlotScheduler:
+    '''Keeps track in memory of the metadata and download slots in use by a download worker,
+    to admit new torrents without querying the DB for each of them. The slots are limited
+    per worker, and globally for all the workers.'''
+
+    def __init__(self, worker_id=''):
+        self.worker_id = worker_id
+        self.limit_dict = {
+                'Downloading metadata': settings.BITTORRENT_MAX_METADATA_DOWNLOADS_PER_WORKER,
+                'Downloading': settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER,
+                }
+        self.global_limit_dict = {
+                'Downloading metadata': settings.BITTORRENT_MAX_METADATA_DOWNLOADS,
+                'Downloading': settings.BITTORRENT_MAX_DOWNLOADS,
+                }
+        self.slot_dict = dict((status, set()) for status in self.limit_dict)
+
+    def reconcile(self):
+        '''Rebuild the list of slots in use from the torrents states in the DB'''
+
+        for (status, hash_set) in self.slot_dict.items():
+            hash_set.clear()
+            hash_set.update(Torrent.objects.filter(status=status, lease_owner=self.worker_id)\
+                    .values_list('hash', flat=True))
+
+        log.info("Slots in use: %s", dict((status, len(hash_set)) for (status, hash_set) in self.slot_dict.items()))
 
-            # Update misc info of torrent
-            torrent_db.update_from_torrent(torrent_bt)
+    def update(self, torrent):
+        '''Take or release the slot of a torrent, according to its current status'''
+
+        for (status, hash_set) in self.slot_dict.items():
+            if torrent.status == status:
+                hash_set.add(torrent.hash)
+            else:
+                hash_set.discard(torrent.hash)
+
+    def take(self, hash, status):
+        '''Take a slot for a hash which isn't a torrent of the DB, like a prefetched search result'''
+
+        self.slot_dict[status].add(hash)
+
+    def release(self, hash):
+        '''Release the slot of a torrent which isn't processed by this worker anymore'''
+
+        for hash_set in self.slot_dict.values():
+            hash_set.discard(hash)
+
+    def get_hash_list(self):
+        '''Hashes of the torrents using a slot'''
+
+        hash_list = list()
+        for hash_set in self.slot_dict.values():
+            hash_list.extend(hash_set)
+        return hash_list
+
+    def get_nb_free_slots(self, status):
+        '''Number of torrents which can still be admitted in the given status, 
+        by this worker and by all the workers'''
+
+        nb_free_slots = self.limit_dict[status] - len(self.slot_dict[status])
+        if nb_free_slots > 0:
+            nb_global_free_slots = self.global_limit_dict[status] - Torrent.objects.filter(status=status).count()
+            nb_free_slots = min(nb_free_slots, nb_global_free_slots)
+
+        return max(0, nb_free_slots)
+
+    def admit(self, from_status, to_status, exclude_hash_list=None):
+        '''Returns the batch of torrents waiting in from_status which can be admitted 
+        in to_status (highest priority first, then oldest), within the limit of the free slots.
+        The worker takes the lease of the admitted torrents - torrents admitted concurrently 
+        by another worker are skipped, as well as the ones of exclude_hash_list.'''
+
+        nb_free_slots = self.get_nb_free_slots(to_status)
+        if nb_free_slots == 0:
+            return list()
+
+        torrent_list = Torrent.objects.filter(status=from_status)
+        if exclude_hash_list:
+            torrent_list = torrent_list.exclude(hash__in=exclude_hash_list)
+        torrent_list = torrent_list.order_by('-priority', 'last_status_change')[:nb_free_slots]
+
+        return [torrent for torrent in torrent_list \
+                if Torrent.objects.claim(torrent, self.worker_id, from_status)]
 
 
 class Bittorrent:
 
-    def __init__(self):
-        '''Starts a bittorrent client'''
+    def __init__(self, dht_state=None, profile=None):
+        '''Starts a bittorrent client, with the session settings of the given profile
+        (BITTORRENT_SESSION_PROFILE by default)'''
 
         log.info('Starting bittorrent client')
+        self.profile = profile or settings.BITTORRENT_SESSION_PROFILE
 
         # Settings
         self.session = lt.session()
         session_settings = lt.session_settings()
         session_settings.user_agent = '%s libtorrent/%d.%d' % (settings.SOFTWARE_USER_AGENT, lt.version_major, lt.version_minor)
-        session_settings.active_downloads = settings.BITTORRENT_MAX_DOWNLOADS + settings.BITTORRENT_MAX_METADATA_DOWNLOADS
+        max_downloads = settings.BITTORRENT_MAX_DOWNLOADS_PER_WORKER + settings.BITTORRENT_MAX_METADATA_DOWNLOADS_PER_WORKER
+        session_settings.active_downloads = max_downloads
         session_settings.active_seeds = settings.BITTORRENT_MAX_SEEDS
-        session_settings.active_limit = settings.BITTORRENT_MAX_DOWNLOADS + settings.BITTORRENT_MAX_SEEDS + settings.BITTORRENT_MAX_METADATA_DOWNLOADS
+        session_settings.active_limit = max_downloads + settings.BITTORRENT_MAX_SEEDS
+        if hasattr(session_settings, 'active_checking'):
+            session_settings.active_checking = settings.BITTORRENT_MAX_CHECKING
+        apply_session_profile(session_settings, self.profile)
         self.session.set_settings(session_settings)
 
         # Start BT server
@@ -212,40 +930,270 @@ class Bittorrent:
         self.session.listen_on(ports[0], ports[1])
 
         # Start DHT server
-        dht_data = get_cache('bt_dht_data')
-        self.session.start_dht(dht_data)
+        if dht_state is None:
+            dht_state = get_cache('bt_dht_data') # Saved by previous versions
+        self.session.start_dht(dht_state)
 
         self.params = {
-            'save_path': settings.DOWNLOAD_DIR.encode('ascii'), # FIXME: support non-ascii characters
+            'save_path': (settings.SCRATCH_DIR or settings.DOWNLOAD_DIR).encode('ascii'), # FIXME: support non-ascii characters
             'storage_mode': lt.storage_mode_t(2),
             'paused': False,
             'auto_managed': True,
             'duplicate_is_error': True}
 
         self.handle_dict = {}
+        self.info_hash_dict = {} # {lowercase info hash: hash}, to find the torrent of an alert
+        self.file_list_cache = {}
+        self.streaming_dict = {}
+        self.pausing_set = set() # Hashes to remove once their resume data has been saved
+        self.resume_store = ResumeDataStore()
+
+        # Get notified of state changes & errors rather than polling each torrent
+        if settings.BITTORRENT_USE_ALERTS:
+            self.session.set_alert_mask(lt.alert.category_t.status_notification | \
+                                        lt.alert.category_t.error_notification | \
+                                        lt.alert.category_t.storage_notification)
 
-    def save_dht_state(self):
-        '''Save a copy of the current DHT state to the cache'''
+    def set_profile(self, profile):
+        '''Change the session settings to the ones of another profile'''
 
-        log.debug('Saving current DHT session')
-        set_cache('bt_dht_data', self.session.dht_state())
+        log.info('Using session profile %s', profile)
+        self.session.set_settings(apply_session_profile(self.session.settings(), profile))
+        self.profile = profile
+
+    def get_dht_state(self):
+        '''Returns the current DHT state, to restart from it later'''
+
+        return self.session.dht_state()
+
+    def get_session_stats(self):
+        '''Returns the main statistics of the session, as a dict'''
+
+        status = self.session.status()
+        return {
+            'date': time.time(),
+            'nb_torrents': len(self.handle_dict),
+            'dht_nodes': status.dht_nodes,
+            'total_download': status.total_download,
+            'total_upload': status.total_upload,
+            'download_rate': status.download_rate,
+            'upload_rate': status.upload_rate,
+        }
+
+    def get_rate_dict(self):
+        '''Returns the current transfer rates of the torrents of the session, in bytes/s,
+        as a {hash: (download_rate, upload_rate)} dict'''
+
+        hash_dict = dict()
+        for (hash, handle) in self.handle_dict.items():
+            if handle.is_valid():
+                hash_dict[str(handle.info_hash())] = hash
+
+        rate_dict = dict()
+        for (handle, status) in self.get_status_list():
+            hash = hash_dict.get(str(handle.info_hash()))
+            if hash is not None:
+                rate_dict[hash] = (status.download_rate, status.upload_rate)
+
+        return rate_dict
+
+    def get_seed_stats_dict(self):
+        '''Returns the statistics of the torrents of the session which are seeding, as a
+        {hash: {'ratio': uploaded/size, 'seeding_time': seconds}} dict'''
+
+        hash_dict = dict()
+        for (hash, handle) in self.handle_dict.items():
+            if handle.is_valid():
+                hash_dict[str(handle.info_hash())] = hash
+
+        seed_stats_dict = dict()
+        for (handle, status) in self.get_status_list():
+            hash = hash_dict.get(str(handle.info_hash()))
+            if hash is None or not ('seeding' in str(status.state) or 'finished' in str(status.state)):
+                continue
+
+            seed_stats_dict[hash] = {
+                'ratio': float(status.all_time_upload) / max(status.total_wanted, 1),
+                'seeding_time': status.seeding_time,
+            }
+
+        return seed_stats_dict
 
     def add_magnet(self, magnet_uri):
-        '''Schedule a magnet link for download'''
+        '''Schedule a magnet link for download. When the metadata of the torrent has
+        been saved previously, the torrent is added directly from it, with its resume data'''
 
         # Convert to str which libtorrent expects
         magnet_uri = magnet_uri.encode('ascii')
         hash = magnet_uri[20:60]
 
         if hash not in self.handle_dict: # Check we aren't already processing this torrent
-            log.info('Adding to the download queue: %s', magnet_uri)
-            handle = lt.add_magnet_uri(self.session, magnet_uri, self.params)
+            metadata = self.resume_store.get_metadata(hash)
+            if metadata is None:
+                log.info('Adding to the download queue: %s', magnet_uri)
+                handle = lt.add_magnet_uri(self.session, magnet_uri, self.params)
+            else:
+                log.info('Adding to the download queue from saved metadata: %s', magnet_uri)
+                params = dict(self.params)
+                params['ti'] = lt.torrent_info(lt.bdecode(metadata))
+                resume_data = self.resume_store.get_resume_data(hash)
+                if resume_data is not None:
+                    params['resume_data'] = resume_data
+                handle = self.session.add_torrent(params)
             self.handle_dict[hash] = handle
+            self.info_hash_dict[hash.lower()] = hash
+        elif hash in self.pausing_set:
+            # Not removed yet, as its resume data hasn't been received
+            log.info('Resuming paused torrent: %s', magnet_uri)
+            self.pausing_set.discard(hash)
+            handle = self.handle_dict[hash]
+            handle.auto_managed(True)
+            handle.resume()
         else:
             log.error('Already in the download queue: %s', magnet_uri)
 
         return True
 
+    def set_file_priorities(self, hash, priority_list):
+        '''Set the download priority of each file of a torrent (0 to skip a file, 
+        7 for the most urgent ones). Requires the torrent metadata.'''
+
+        handle = self.get_handle_for_hash(hash)
+        if handle is None or not handle.is_valid() or not handle.has_metadata():
+            log.info('Could not set file priorities for hash %s', hash)
+            return False
+
+        handle.prioritize_files(priority_list)
+        self.streaming_dict.pop(hash, None) # Overrides the streaming file priority
+        return True
+
+    def get_streaming_bytes(self, hash, file_index):
+        '''Download a file of a torrent in order, for streaming: the file gets the highest priority,
+        and the pieces following its readable part get deadlines.
+        Returns the number of bytes which can be read from the start of the file, 
+        None if the torrent metadata isn't available.'''
+
+        handle = self.get_handle_for_hash(hash)
+        if handle is None or not handle.is_valid() or not handle.has_metadata():
+            return None
+
+        if self.streaming_dict.get(hash) != file_index:
+            log.info('Starting to stream file %d of hash %s', file_index, hash)
+            handle.file_priority(file_index, 7)
+            self.streaming_dict[hash] = file_index
+
+        info = handle.get_torrent_info()
+        file_entry = info.file_at(file_index)
+        piece_length = info.piece_length()
+        first_piece = file_entry.offset / piece_length
+        last_piece = (file_entry.offset + max(file_entry.size, 1) - 1) / piece_length
+
+        # Readable part of the file: the pieces downloaded without interruption from its start
+        piece = first_piece
+        while piece <= last_piece and handle.have_piece(piece):
+            piece += 1
+        readable_bytes = min(piece * piece_length, file_entry.offset + file_entry.size) - file_entry.offset
+
+        # The web server reads them from the disk, not from the libtorrent cache
+        if readable_bytes > 0 and hasattr(handle, 'flush_cache'):
+            handle.flush_cache()
+
+        # Next pieces to read
+        window_end = min(piece + settings.BITTORRENT_STREAMING_WINDOW, last_piece + 1)
+        for (i, next_piece) in enumerate(xrange(piece, window_end)):
+            handle.set_piece_deadline(next_piece, (i+1) * settings.BITTORRENT_STREAMING_DEADLINE, 0)
+
+        return max(0, readable_bytes)
+
+    def has_saved_metadata(self, hash):
+        '''Check if the metadata of a torrent has been saved, to add it without 
+        downloading the metadata again'''
+
+        return self.resume_store.get_metadata(hash) is not None
+
+    def save_metadata(self, hash):
+        '''Save the metadata (info-dict) of a torrent, once it has been retreived'''
+
+        handle = self.get_handle_for_hash(hash)
+        if handle is None or not handle.has_metadata() or self.has_saved_metadata(hash):
+            return
+
+        torrent_file = lt.create_torrent(handle.get_torrent_info()).generate()
+        self.resume_store.set_metadata(hash, lt.bencode(torrent_file))
+
+    def save_resume_data(self):
+        '''Ask libtorrent to generate the resume data of the torrents, which is saved
+        when the corresponding alert is received'''
+
+        for handle in self.handle_dict.values():
+            if not handle.is_valid() or not handle.has_metadata():
+                continue
+            if hasattr(handle, 'need_save_resume_data') and not handle.need_save_resume_data():
+                continue
+            handle.save_resume_data()
+
+    def forget_hash(self, hash):
+        '''Delete the saved metadata and resume data of a torrent'''
+
+        self.resume_store.remove(hash)
+
+    def get_nb_checking(self):
+        '''Number of torrents currently checking their files'''
+
+        nb_checking = 0
+        for (handle, status) in self.get_status_list():
+            if 'checking' in str(status.state):
+                nb_checking += 1
+
+        return nb_checking
+
+    def pop_alerts(self):
+        '''Returns the list of alerts posted by libtorrent since the last call'''
+
+        if hasattr(self.session, 'pop_alerts'):
+            return self.session.pop_alerts()
+
+        # Older libtorrent versions only allow to retreive alerts one by one
+        alert_list = list()
+        alert = self.session.pop_alert()
+        while alert is not None:
+            alert_list.append(alert)
+            alert = self.session.pop_alert()
+
+        return alert_list
+
+    def pop_torrent_alerts(self):
+        '''Returns the alerts concerning the torrents in the queue, as a list of
+        (alert_type, hash, alert) tuples. Other alerts are only logged.'''
+
+        torrent_alert_list = list()
+        for alert in self.pop_alerts():
+            alert_type = type(alert).__name__
+            hash = self.get_hash_for_alert(alert)
+
+            if alert_type == 'save_resume_data_alert' and hash is not None:
+                self.resume_store.set_resume_data(hash, lt.bencode(alert.resume_data))
+                self.remove_paused_hash(hash)
+            elif alert_type == 'save_resume_data_failed_alert':
+                log.debug('Could not save resume data for hash %s: %s', hash, alert.message())
+                self.remove_paused_hash(hash)
+            elif hash is None:
+                log.debug('libtorrent alert %s: %s', alert_type, alert.message())
+            else:
+                torrent_alert_list.append((alert_type, hash, alert))
+
+        return torrent_alert_list
+
+    def get_hash_for_alert(self, alert):
+        '''Return the hash of the queued torrent an alert is about, None if the alert
+        isn't about a torrent or the torrent has been removed from the queue since'''
+
+        handle = getattr(alert, 'handle', None)
+        if handle is None or not handle.is_valid():
+            return None
+
+        return self.info_hash_dict.get(str(handle.info_hash()))
+
     def get_handle_for_hash(self, hash):
         '''Return the handle for a given hash, if currently in the queue'''
 
@@ -254,8 +1202,60 @@ class Bittorrent:
         else:
             return None
 
-    def remove_hash(self, hash):
-        '''Stop a torrent from downloading and remove it from the queue'''
+    def move_storage(self, hash, path):
+        '''Move the files of a torrent to another directory, in the background
+        Returns False if the torrent isn't in the session'''
+
+        handle = self.get_handle_for_hash(hash)
+        if handle is None or not handle.is_valid():
+            return False
+
+        handle.move_storage(path.encode('ascii'))
+        return True
+
+    def is_storage_moved(self, hash, path):
+        '''Check if the files of a torrent are stored in the given directory'''
+
+        handle = self.get_handle_for_hash(hash)
+        if handle is None or not handle.is_valid():
+            return False
+
+        return os.path.normpath(handle.save_path()) == os.path.normpath(path.encode('ascii'))
+
+    def pause_hash(self, hash):
+        '''Stop a torrent from downloading, and remove it from the queue once its resume data 
+        has been saved - otherwise all its files would be checked again when it is added back'''
+
+        handle = self.get_handle_for_hash(hash)
+        if handle is None or not handle.is_valid():
+            log.info('Could not find torrent handle for hash %s', hash)
+            return False
+        elif not handle.has_metadata():
+            return self.remove_hash(hash)
+        else:
+            log.info('Pausing torrent for hash %s', hash)
+            handle.auto_managed(False)
+            handle.pause()
+            handle.save_resume_data()
+            self.pausing_set.add(hash)
+            return True
+
+    def is_pausing(self, hash):
+        '''Check if a torrent paused by pause_hash() is still waiting for its resume data, 
+        before being removed from the queue'''
+
+        return hash in self.pausing_set
+
+    def remove_paused_hash(self, hash):
+        '''Remove a torrent paused by pause_hash(), once its resume data has been saved'''
+
+        if hash in self.pausing_set:
+            self.pausing_set.discard(hash)
+            self.remove_hash(hash)
+
+    def remove_hash(self, hash, delete_files=False):
+        '''Stop a torrent from downloading and remove it from the queue, optionally
+        deleting its downloaded files'''
 
         handle = self.get_handle_for_hash(hash)
         if handle is None or not handle.is_valid():
@@ -263,24 +1263,62 @@ class Bittorrent:
             return False
         else:
             log.info('Removing torrent from queue for hash %s', hash)
-            self.session.remove_torrent(handle)
+            if delete_files:
+                self.session.remove_torrent(handle, lt.options_t.delete_files)
+            else:
+                self.session.remove_torrent(handle)
             del(self.handle_dict[hash])
+            self.info_hash_dict.pop(hash.lower(), None)
+            self.file_list_cache.pop(hash, None)
+            self.streaming_dict.pop(hash, None)
+            self.pausing_set.discard(hash)
             return True
 
     def get_torrent_info(self, torrent_db):
         '''Returns a Torrent() object containing miscanealous info about the torrent
         State is either: 'Downloading', 'Completed' or 'Error'.'''
 
-        import json
-        from datetime import timedelta
+        handle = self.get_handle_for_hash(torrent_db.hash)
+
+        return self.build_torrent_info(torrent_db.hash, handle, handle.status())
+
+    def get_torrent_info_dict(self, torrent_list):
+        '''Returns the info of all the torrents of torrent_list currently in the queue,
+        as a {hash: Torrent()} dict. The status of all handles is gathered in a single pass.'''
+
+        hash_dict = dict()
+        for torrent_db in torrent_list:
+            handle = self.get_handle_for_hash(torrent_db.hash)
+            if handle is not None and handle.is_valid():
+                hash_dict[str(handle.info_hash())] = torrent_db.hash
+
+        torrent_bt_dict = dict()
+        for (handle, status) in self.get_status_list():
+            hash = hash_dict.get(str(handle.info_hash()))
+            if hash is not None:
+                torrent_bt_dict[hash] = self.build_torrent_info(hash, handle, status)
+
+        return torrent_bt_dict
+
+    def get_status_list(self):
+        '''Returns the status of all the torrents of the session, as a list
+        of (handle, status) tuples'''
+
+        # Recent libtorrent versions can get them all at once
+        if hasattr(self.session, 'get_torrent_status'):
+            return [(status.handle, status) for status in self.session.get_torrent_status(lambda status: True, 0)]
+
+        return [(handle, handle.status()) for handle in self.session.get_torrents()]
+
+    def build_torrent_info(self, hash, handle, status):
+        '''Builds the Torrent() object returned by get_torrent_info() from a handle
+        and its status'''
 
         torrent_bt = Torrent()
-        handle = self.get_handle_for_hash(torrent_db.hash)
-        status = handle.status()
 
         # Status
-        log.debug('Built torrent info for BT hash %s (status = %s, error = %s)', torrent_db.hash, status.state, status.error)
-        if 'seeding' in str(status.state):
+        log.debug('Built torrent info for BT hash %s (status = %s, error = %s)', hash, status.state, status.error)
+        if 'seeding' in str(status.state) or 'finished' in str(status.state):
             torrent_bt.status = 'Completed'
         elif status.error:
             torrent_bt.status = 'Error'
@@ -297,25 +1335,51 @@ class Bittorrent:
         torrent_bt.progress = status.progress
         torrent_bt.download_speed = "%.3f MB/s" % (status.download_rate/(1024*1024))
         torrent_bt.upload_speed = "%.3f MB/s" % (status.upload_rate/(1024*1024))
+        torrent_bt.download_rate = status.download_rate
+        torrent_bt.upload_rate = status.upload_rate
         torrent_bt.active_time = status.active_time
         torrent_bt.seeds = status.list_seeds
         torrent_bt.peers = status.list_peers
 
-        # ETA
-        size_left = info.total_size() - status.total_done
+        # ETA - only the files selected for download count
+        size_left = status.total_wanted - status.total_wanted_done
         if status.download_rate > 0:
             torrent_bt.eta = size_left / status.download_rate
         else:
             torrent_bt.eta = None
 
         # Files
-        file_list = list()
-        for res_file in info.files():
-            file_list.append({'path': unicode(res_file.path, 'utf-8'), 'size': res_file.size})
-        torrent_bt.file_list = json.dumps(file_list)
+        torrent_bt.file_list = self.get_file_list(hash, info)
+        torrent_bt.completed_files = self.get_completed_files(handle, info)
 
         return torrent_bt
 
+    def get_file_list(self, hash, info):
+        '''Returns the JSON list of files of a torrent. The list doesn't change once
+        the metadata has been retreived, so it is only serialized once per torrent.'''
+
+        import json
+
+        if hash not in self.file_list_cache:
+            file_list = list()
+            for res_file in info.files():
+                file_list.append({'path': unicode(res_file.path, 'utf-8'), 'size': res_file.size})
+            self.file_list_cache[hash] = json.dumps(file_list)
+
+        return self.file_list_cache[hash]
+
+    def get_completed_files(self, handle, info):
+        '''Returns the JSON list of the indexes of the files of a torrent which are 
+        completely downloaded. Only verified pieces are counted by libtorrent.'''
+
+        import json
+
+        progress_list = handle.file_progress()
+        completed_list = [i for (i, res_file) in enumerate(info.files()) \
+                if progress_list[i] >= res_file.size]
+
+        return json.dumps(completed_list)
+
     def get_status(self):
         '''Returns the current server status, including DHT'''
 
@@ -355,3 +1419,48 @@ class Bittorrent:
                 }
 
 
+class ResumeDataStore:
+    '''Keeps a copy on disk of the metadata (info-dict) and of the libtorrent resume data
+    of each torrent, to restart them without downloading the metadata or rechecking the files'''
+
+    def __init__(self):
+        self.path = settings.RESUME_DATA_DIR
+        mkdir_p(self.path)
+
+    def get_file_path(self, hash, extension):
+        '''Path of one of the files saved for a torrent'''
+
+        return os.path.join(self.path, '%s.%s' % (hash.lower(), extension))
+
+    def read(self, hash, extension):
+        '''Returns the content of one of the files saved for a torrent, None if not found'''
+
+        file_path = self.get_file_path(hash, extension)
+        if not os.path.isfile(file_path):
+            return None
+
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def get_metadata(self, hash):
+        return self.read(hash, 'torrent')
+
+    def set_metadata(self, hash, metadata):
+        log.debug('Saving metadata for hash %s', hash)
+        write_file_atomic(self.get_file_path(hash, 'torrent'), metadata)
+
+    def get_resume_data(self, hash):
+        return self.read(hash, 'fastresume')
+
+    def set_resume_data(self, hash, resume_data):
+        log.debug('Saving resume data for hash %s', hash)
+        write_file_atomic(self.get_file_path(hash, 'fastresume'), resume_data)
+
+    def remove(self, hash):
+        '''Delete all the files saved for a torrent'''
+
+        for extension in ('torrent', 'fastresume'):
+            file_path = self.get_file_path(hash, extension)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
@@ -26,6 +26,7 @@ from wall.helpers import normalize_text
 from wall.models import Series
 
 import re
+import os
 
 # Logging ###########################################################
 
@@ -33,8 +34,44 @@ from plebia.log import get_logger
 log = get_logger(__name__)
 
 
+# Globals ###########################################################
+
+# Files & folders of a torrent which are never part of an episode
+UNWANTED_NAME_REGEX = r"\b(sample|samples|extras?|featurettes?|bonus|behind the scenes)\b"
+UNWANTED_EXTENSION_LIST = ('.iso', '.img', '.nrg', '.bin', '.cue', '.mdf', '.mds')
+
+
 # Functions #########################################################
 
+def clean_name(name):
+    '''Replace separators by a single space'''
+
+    return re.sub(r'[_\W]+', ' ', name).strip()
+
+def match_episode_number(season_number, episode_number, clean_filename):
+    '''Check if a file name (cleaned with clean_name()) contains the number of an episode'''
+
+    return re.search(r"\bs* *0*%d *[xe]* *0*%d\b" % (season_number, episode_number), clean_filename, re.IGNORECASE) \
+        or re.search(r"\bseason *0*%d *episode *0*%d\b" % (season_number, episode_number), clean_filename, re.IGNORECASE) \
+        or re.search(r"(^|[^0-9 ] +)0*%d +[^0-9 ]" % episode_number, clean_filename, re.IGNORECASE)
+
+def get_season_number(clean_filename, is_dir=False):
+    '''Returns the season number explicitly mentioned in a file or folder name, None if there is none'''
+
+    m = re.search(r"\bseason *0*([0-9]+)\b", clean_filename, re.IGNORECASE) \
+        or re.search(r"\bs *0*([0-9]+) *e *[0-9]+\b", clean_filename, re.IGNORECASE) \
+        or re.search(r"\b0*([0-9]+) *x *[0-9]+\b", clean_filename, re.IGNORECASE)
+    if m is None and is_dir:
+        m = re.search(r"\bs *0*([0-9]+)$", clean_filename, re.IGNORECASE)
+
+    if m is None:
+        return None
+    else:
+        return int(m.group(1))
+
+
+# Models ############################################################
+
 class TorrentMagic:
     '''Attempts to guess the contents of a torrent which hasn't been
     retreived yet'''
@@ -188,3 +225,111 @@ class TorrentMagic:
         return self.season_number_list
 
 
+class TorrentFileMagic:
+    '''Analyzes the list of files of a torrent, once its metadata has been retreived'''
+
+    def __init__(self, torrent):
+        import json
+
+        self.torrent = torrent
+        if torrent.file_list:
+            self.file_list = json.loads(torrent.file_list)
+        else:
+            self.file_list = list()
+
+    def is_unwanted_file(self, path):
+        '''Samples, extras and disc images are never part of an episode'''
+
+        if os.path.splitext(path)[1].lower() in UNWANTED_EXTENSION_LIST:
+            return True
+
+        for name in path.split('/'):
+            if re.search(UNWANTED_NAME_REGEX, clean_name(name), re.IGNORECASE):
+                return True
+
+        return False
+
+    def is_episode_file(self, episode, path):
+        '''Check if a file of the torrent belongs to the given episode - either by its name, 
+        or by the name of one of the folders containing it'''
+
+        season_number = episode.season.number
+        clean_episode_name = clean_name(episode.name)
+
+        name_list = path.split('/')
+        for (i, name) in enumerate(name_list):
+            clean_filename = clean_name(name)
+
+            # Files from other seasons - the name of the torrent root folder often lists 
+            # several seasons, so it isn't used for this
+            if i > 0 or len(name_list) == 1:
+                file_season_number = get_season_number(clean_filename, is_dir=(i < len(name_list)-1))
+                if file_season_number is not None and file_season_number != season_number:
+                    return False
+
+            if (clean_episode_name and re.search(clean_episode_name, clean_filename, re.IGNORECASE)) \
+                    or match_episode_number(season_number, episode.number, clean_filename):
+                return True
+
+        return False
+
+    def get_episode_file_index_list(self, episode):
+        '''Returns the indexes of the files of the torrent which belong to the given episode'''
+
+        return [i for (i, torrent_file) in enumerate(self.file_list) \
+                if not self.is_unwanted_file(torrent_file['path']) and self.is_episode_file(episode, torrent_file['path'])]
+
+    def get_episode_video_file_index(self, episode):
+        '''Returns the index of the video file of an episode in the torrent - the largest of its files,
+        None if it can't be found'''
+
+        file_index_list = self.get_episode_file_index_list(episode)
+
+        # Episode torrents don't always mention the episode in their file names
+        if not file_index_list and self.torrent.type == 'episode':
+            file_index_list = [i for (i, torrent_file) in enumerate(self.file_list) \
+                    if not self.is_unwanted_file(torrent_file['path'])]
+
+        if not file_index_list:
+            return None
+
+        return max(file_index_list, key=lambda i: self.file_list[i]['size'])
+
+    def get_score(self, episode_list):
+        '''Score of the actual files of the torrent for the episodes of episode_list, to compare
+        search results: a (nb_episodes, size) tuple, with the number of episodes which have a
+        video file in the torrent, and the total size of these files. Disc images, samples or
+        other seasons don't count.'''
+
+        nb_episodes = 0
+        size = 0
+        for episode in episode_list:
+            file_index = self.get_episode_video_file_index(episode)
+            if file_index is not None:
+                nb_episodes += 1
+                size += self.file_list[file_index]['size']
+
+        return (nb_episodes, size)
+
+    def get_file_priority_list(self, episode_list):
+        '''Returns the libtorrent priority of each file of the torrent, to only download the
+        files of the episodes of episode_list, in the order of the episodes numbers.
+        Returns None when none of the files can be matched to one of the episodes.'''
+
+        priority_list = [0] * len(self.file_list)
+
+        episode_list = sorted(episode_list, key=lambda episode: (episode.season.number, episode.number))
+        nb_episodes = len(episode_list)
+        nb_selected_files = 0
+        for (rank, episode) in enumerate(episode_list):
+            # Priorities go from 7 (first episodes) to 2 (last episodes)
+            priority = 7 - (rank * 6) / nb_episodes
+            for i in self.get_episode_file_index_list(episode):
+                priority_list[i] = max(priority_list[i], priority)
+                nb_selected_files += 1
+
+        if nb_selected_files == 0:
+            return None
+
+        return priority_list
+
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.db.models import Count
+from django.conf import settings
+
+from wall.models import Episode, Post
+
+from datetime import datetime, timedelta
+import math
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Globals ###########################################################
+
+# Posts younger than this are considered as current demand
+RECENT_POST_DAYS = 7
+
+# Episodes aired since less than this get a bonus, decreasing with time
+RECENT_AIRING_DAYS = 30
+
+
+# Models ############################################################
+
+class TorrentPrioritizer:
+    '''Computes the download priority of torrents, from the demand for their content:
+    posts about the series, air date of the episodes, watching progress of the series,
+    health of the swarm and streaming requests. Higher is more urgent.'''
+
+    def __init__(self):
+        self.weight_dict = settings.BITTORRENT_PRIORITY_WEIGHTS
+
+    def get_priority_dict(self, torrent_list):
+        '''Returns the priority of each torrent of torrent_list, as a {torrent_id: priority} dict'''
+
+        torrent_id_list = [torrent.id for torrent in torrent_list]
+
+        # Episodes each torrent is used for - a season torrent is as urgent as its most urgent episode
+        episode_dict = dict()
+        series_id_set = set()
+        for episode in Episode.objects.filter(torrent__in=torrent_id_list)\
+                .values('torrent', 'season__series', 'first_aired'):
+            episode_dict.setdefault(episode['torrent'], list()).append(episode)
+            series_id_set.add(episode['season__series'])
+
+        post_dict = self.get_post_dict(series_id_set)
+        watched_dict = self.get_watched_dict(series_id_set)
+
+        priority_dict = dict()
+        for torrent in torrent_list:
+            priority = self.get_swarm_score(torrent)
+
+            demand_score = 0.0
+            for episode in episode_dict.get(torrent.id, list()):
+                series_id = episode['season__series']
+                episode_score = self.weight_dict['posts'] * post_dict.get(series_id, 0.0) \
+                        + self.weight_dict['air_date'] * self.get_air_date_score(episode['first_aired']) \
+                        + self.weight_dict['watched'] * watched_dict.get(series_id, 0.0)
+                demand_score = max(demand_score, episode_score)
+
+            # Someone is waiting to watch it right now
+            if torrent.streaming_file is not None:
+                priority += self.weight_dict['streaming']
+
+            priority_dict[torrent.id] = round(priority + demand_score, 2)
+
+        return priority_dict
+
+    def get_post_dict(self, series_id_set):
+        '''Score of the posts about each series, recent posts counting more
+        Returns a {series_id: score} dict'''
+
+        recent_date = datetime.now() - timedelta(days=RECENT_POST_DAYS)
+
+        nb_post_dict = dict()
+        for post in Post.objects.filter(series__in=list(series_id_set))\
+                .values('series').annotate(nb_posts=Count('id')):
+            nb_post_dict[post['series']] = post['nb_posts']
+        for post in Post.objects.filter(series__in=list(series_id_set), date_added__gte=recent_date)\
+                .values('series').annotate(nb_posts=Count('id')):
+            nb_post_dict[post['series']] += 2*post['nb_posts']
+
+        return dict((series_id, math.log(1 + nb_posts)) \
+                for (series_id, nb_posts) in nb_post_dict.items())
+
+    def get_watched_dict(self, series_id_set):
+        '''Score of the watching progress of each series - the proportion of episodes
+        already watched, as users watching a series want the next episodes
+        Returns a {series_id: score} dict'''
+
+        nb_episode_dict = dict()
+        for episode in Episode.objects.filter(season__series__in=list(series_id_set))\
+                .values('season__series').annotate(nb_episodes=Count('id')):
+            nb_episode_dict[episode['season__series']] = episode['nb_episodes']
+
+        watched_dict = dict()
+        for episode in Episode.objects.filter(season__series__in=list(series_id_set), watched=True)\
+                .values('season__series').annotate(nb_episodes=Count('id')):
+            series_id = episode['season__series']
+            watched_dict[series_id] = float(episode['nb_episodes']) / nb_episode_dict[series_id]
+
+        return watched_dict
+
+    def get_air_date_score(self, first_aired):
+        '''Score of an episode air date, between 0 (old) and 1 (just aired)'''
+
+        if first_aired is None:
+            return 0.0
+
+        age = datetime.now() - first_aired
+        return max(0.0, min(1.0, 1.0 - float(age.days) / RECENT_AIRING_DAYS))
+
+    def get_swarm_score(self, torrent):
+        '''Score of the health of the torrent swarm - a healthy swarm will finish sooner'''
+
+        seeds = max(torrent.seeds or 0, 0)
+        peers = max(torrent.peers or 0, 0)
+
+        return self.weight_dict['swarm'] * math.log(1 + seeds + peers/4.0)
+
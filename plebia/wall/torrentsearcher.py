@@ -31,6 +31,14 @@ import re
 import mechanize
 import time
 import datetime
+import threading
+import Queue
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
 
 
 # mechanize #########################################################
@@ -58,6 +66,9 @@ class TorrentSearchManager:
         # Retreive new episodes (previously added series)
         self.search_new_episodes()
 
+        # Search again for the episodes whose torrent couldn't be found or downloaded
+        self.search_failed_episodes()
+
     def search_new_series(self):
         '''Get new series, for which to search bulk season(s) packages'''
 
@@ -67,8 +78,7 @@ class TorrentSearchManager:
                 .exclude(season__episode__torrent__isnull=False)\
                 .order_by('date_added')
 
-        for new_series in new_series_list:
-            new_series.find_torrent()
+        self.run_workers(lambda series: series.find_torrent(), new_series_list)
 
     def search_new_episodes(self):
         '''Get new episodes for which we must find a torrent file'''
@@ -79,8 +89,65 @@ class TorrentSearchManager:
                 first_aired__lte=yesterday)\
                 .order_by('date_added')
 
-        for new_episode in new_episode_list:
-            new_episode.find_torrent()
+        self.run_workers(lambda episode: episode.find_torrent(), new_episode_list)
+
+    def search_failed_episodes(self):
+        '''Get the episodes whose torrent couldn't be found or downloaded, to search again once
+        their backoff delay expired (see Episode.schedule_search()) - at most 
+        TORRENT_RESEARCH_PER_HOUR of them per hour, to not flood the search engines'''
+
+        now = datetime.datetime.now()
+        nb_searches = settings.TORRENT_RESEARCH_PER_HOUR - \
+                Episode.objects.filter(last_retry__gte=now - datetime.timedelta(hours=1)).count()
+        if nb_searches <= 0:
+            return
+
+        failed_episode_list = list(Episode.objects.filter(\
+                torrent__status='Error', \
+                video=None)\
+                .filter(Q(next_search=None) | Q(next_search__lte=now))\
+                .order_by('search_attempts', 'date_added')[:nb_searches])
+
+        self.run_workers(lambda episode: episode.search_again(), failed_episode_list)
+
+    def run_workers(self, function, object_list):
+        '''Call function for each object of object_list, from TORRENT_SEARCH_WORKERS threads
+        at once. The searches spend most of their time waiting for the search engines - the
+        rate of the requests to each of them is limited by wall.ratelimit.'''
+
+        from django.db import connection
+
+        if settings.TORRENT_SEARCH_WORKERS <= 1:
+            for obj in object_list:
+                function(obj)
+            return
+
+        queue = Queue.Queue()
+        for obj in object_list:
+            queue.put(obj)
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        obj = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+
+                    try:
+                        function(obj)
+                    except:
+                        log.exception("Error while searching torrents for %s", obj)
+            finally:
+                # Each thread has its own DB connection
+                connection.close()
+
+        thread_list = [threading.Thread(target=worker) \
+                for i in xrange(min(settings.TORRENT_SEARCH_WORKERS, queue.qsize()))]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
 
 
 
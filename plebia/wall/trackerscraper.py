@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Xavier Antoviaque <xavier@antoviaque.org>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Includes ##########################################################
+
+from django.conf import settings
+
+import wall.helpers
+
+import binascii
+import urllib
+
+
+# Logging ###########################################################
+
+from plebia.log import get_logger
+log = get_logger(__name__)
+
+
+# Exceptions ########################################################
+
+class BdecodeError(Exception):
+    pass
+
+
+# Functions #########################################################
+
+def bdecode(data):
+    '''Decodes a bencoded string (integers, strings, lists & dicts)'''
+
+    def decode(index):
+        char = data[index:index+1]
+        if char == 'i':
+            end = data.index('e', index)
+            return (int(data[index+1:end]), end+1)
+        elif char == 'l':
+            (item_list, index) = (list(), index+1)
+            while data[index:index+1] != 'e':
+                (item, index) = decode(index)
+                item_list.append(item)
+            return (item_list, index+1)
+        elif char == 'd':
+            (item_dict, index) = (dict(), index+1)
+            while data[index:index+1] != 'e':
+                (key, index) = decode(index)
+                (item_dict[key], index) = decode(index)
+            return (item_dict, index+1)
+        elif char.isdigit():
+            colon = data.index(':', index)
+            end = colon + 1 + int(data[index:colon])
+            if end > len(data):
+                raise BdecodeError('Truncated string at %d' % index)
+            return (data[colon+1:end], end)
+        else:
+            raise BdecodeError('Unexpected character %r at %d' % (char, index))
+
+    try:
+        (value, index) = decode(0)
+    except ValueError, e:
+        raise BdecodeError(str(e))
+
+    return value
+
+def get_scrape_url(announce_url):
+    '''Scrape URL of a tracker, from its announce URL - None when the tracker doesn't support it'''
+
+    (path, sep, query) = announce_url.partition('?')
+    (base, slash, name) = path.rpartition('/')
+    if not name.startswith('announce'):
+        return None
+
+    return base + slash + name.replace('announce', 'scrape', 1) + sep + query
+
+
+# Models ############################################################
+
+class TrackerScraper:
+    '''Retrieves the live number of seeds & peers of torrents from their trackers, with a single
+    scrape request per tracker for all the torrents it tracks'''
+
+    def scrape_torrent_list(self, torrent_list):
+        '''Returns the swarm health of the torrents of torrent_list, from the trackers of their 
+        tracker_url_list, as a {hash: (seeds, peers)} dict - the highest counts reported by the
+        trackers are kept. The torrents no tracker answered for are not included.'''
+
+        import json
+
+        hash_list_dict = dict()
+        for torrent in torrent_list:
+            if not torrent.hash or not torrent.tracker_url_list:
+                continue
+            for tracker_url in json.loads(torrent.tracker_url_list):
+                scrape_url = get_scrape_url(tracker_url)
+                if scrape_url is not None:
+                    hash_list_dict.setdefault(scrape_url, list()).append(torrent.hash.lower())
+
+        health_dict = dict()
+        for (scrape_url, hash_list) in hash_list_dict.items():
+            for (hash, (seeds, peers)) in self.scrape(scrape_url, hash_list).items():
+                (max_seeds, max_peers) = health_dict.get(hash, (0, 0))
+                health_dict[hash] = (max(seeds, max_seeds), max(peers, max_peers))
+
+        return health_dict
+
+    def scrape(self, scrape_url, hash_list):
+        '''Scrape several torrents from a tracker at once
+        Returns a {hash: (seeds, peers)} dict, empty if the tracker couldn't be scraped'''
+
+        # Hashes which aren't hexadecimal (malformed, base32...) can't be scraped
+        info_hash_list = list()
+        for hash in hash_list:
+            try:
+                info_hash_list.append(binascii.unhexlify(hash))
+            except TypeError, e:
+                log.info("Not scraping invalid hash %s: %s", hash, e)
+        if not info_hash_list:
+            return dict()
+
+        query = '&'.join('info_hash=%s' % urllib.quote(info_hash) for info_hash in info_hash_list)
+        if '?' in scrape_url:
+            url = scrape_url + '&' + query
+        else:
+            url = scrape_url + '?' + query
+
+        try:
+            content = wall.helpers.get_url(url, timeout=settings.TORRENT_SCRAPE_TIMEOUT)
+            if content is None:
+                return dict()
+            file_dict = bdecode(content)['files']
+        except Exception, e:
+            log.info("Could not scrape tracker %s: %s", scrape_url, e)
+            return dict()
+
+        health_dict = dict()
+        for (binary_hash, stats) in file_dict.items():
+            hash = binascii.hexlify(binary_hash)
+            if hash in hash_list:
+                health_dict[hash] = (stats.get('complete', 0), stats.get('incomplete', 0))
+
+        log.debug("Scraped %d torrents from tracker %s", len(health_dict), scrape_url)
+        return health_dict
+
@@ -31,6 +31,7 @@ from wall.models import Post
 v1_api = Api(api_name='v1')
 v1_api.register(VideoResource())
 v1_api.register(TorrentResource())
+v1_api.register(TransferSampleResource())
 v1_api.register(SeriesResource())
 v1_api.register(SeasonResource())
 v1_api.register(EpisodeResource())
@@ -43,6 +44,9 @@ urlpatterns = patterns('wall.views',
     (r'^$', 'index'),
     (r'^ajax/search/(?P<search_string>.+)$', 'ajax_search'),
     (r'^ajax/newpost/(?P<series_id>\d+)/$', 'ajax_new_post'),
+    (r'^ajax/stream/(?P<episode_id>\d+)/$', 'ajax_stream'),
+    (r'^ajax/watch/(?P<episode_id>\d+)/$', 'ajax_watch'),
+    (r'^stream/(?P<episode_id>\d+)/$', 'stream'),
     (r'^api/', include(v1_api.urls)),
     (r'^status/*$', 'status'),
     (r'^status/(?P<obj_type>\w+)/(?P<obj_status>\w+)/$', 'status_object_detail'),
@@ -21,7 +21,7 @@
 # Includes ##########################################################
 
 from django.conf import settings
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotAllowed, Http404
 from django.shortcuts import render_to_response
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
@@ -29,6 +29,7 @@ from django.core import serializers
 from django.utils import simplejson
 
 from wall.models import *
+from wall.helpers import parse_range_header
 
 
 # Logging ###########################################################
@@ -40,6 +41,11 @@ log = get_logger(__name__)
 # Views #############################################################
 
 def index(request):
+    from django.middleware.csrf import get_token
+
+    # Set the CSRF cookie, sent back with the AJAX POST requests
+    get_token(request)
+
     return render_to_response('wall/index.html', {
         'form': PostForm(),
     }, context_instance=RequestContext(request))
@@ -70,12 +76,121 @@ def ajax_new_post(request, series_id):
     series = Series.objects.get(id=series_id)
     # Make sure the series info and related seasons & episodes are up to date
     series.update_from_tvdb()
+    # The videos evicted to free space are downloaded again
+    Episode.evicted_objects.requeue_series(series)
 
     post = Post(series=series)
     post.save()
 
     return HttpResponse(simplejson.dumps(['/api/v1/post/%d/' % post.id,]))
 
+def get_streaming_file(episode):
+    '''Returns the (full path, size, readable bytes) of the video file of an episode which 
+    is being streamed, None if it isn't. The streaming is started by ajax_stream().'''
+
+    import os
+
+    file_index = episode.get_streaming_file_index()
+    if file_index is None:
+        return None
+
+    torrent = episode.torrent
+    torrent_file = simplejson.loads(torrent.file_list)[file_index]
+    if torrent.status == 'Completed':
+        readable_bytes = torrent_file['size']
+    elif torrent.streaming_file == file_index:
+        readable_bytes = torrent.streaming_bytes
+    else:
+        return None
+
+    return (os.path.join(torrent.get_storage_dir(), torrent_file['path']), torrent_file['size'], readable_bytes)
+
+def ajax_stream(request, episode_id):
+    '''Start streaming the video of an episode which is still downloading, and
+    return how much of it can be played'''
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        episode = Episode.objects.get(id=episode_id)
+    except Episode.DoesNotExist:
+        raise Http404
+
+    episode.request_streaming()
+    streaming_file = get_streaming_file(episode)
+    if streaming_file is None:
+        return HttpResponse(simplejson.dumps({}))
+
+    (path, size, readable_bytes) = streaming_file
+    return HttpResponse(simplejson.dumps({
+        'url': '/stream/%d/' % episode.id,
+        'size': size,
+        'readable_bytes': readable_bytes,
+    }))
+
+def ajax_watch(request, episode_id):
+    '''Record that the video of an episode is being watched - the least recently watched
+    videos are the first ones deleted when disk space runs low'''
+
+    from datetime import datetime
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        episode = Episode.objects.get(id=episode_id)
+    except Episode.DoesNotExist:
+        raise Http404
+
+    if episode.video is not None:
+        Video.objects.filter(id=episode.video.id).update(last_watched=datetime.now())
+
+    return HttpResponse(simplejson.dumps({}))
+
+def stream(request, episode_id):
+    '''Serve the part of the video of an episode which has already been downloaded, 
+    by byte ranges - the player requests the next ones as it plays'''
+
+    import os, mimetypes
+
+    try:
+        episode = Episode.objects.get(id=episode_id)
+    except Episode.DoesNotExist:
+        raise Http404
+
+    streaming_file = get_streaming_file(episode)
+    if streaming_file is None:
+        raise Http404
+    (path, size, readable_bytes) = streaming_file
+
+    byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+    if byte_range is None:
+        byte_range = (0, size - 1)
+    (start, end) = byte_range
+
+    if start >= size:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    elif start >= readable_bytes:
+        # Not downloaded yet
+        response = HttpResponse(status=503)
+        response['Retry-After'] = '5'
+        return response
+
+    end = min(end, readable_bytes - 1, start + settings.STREAMING_CHUNK_SIZE - 1)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        content = f.read(end - start + 1)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = HttpResponse(content, status=206, mimetype=mimetype)
+    response['Content-Range'] = 'bytes %d-%d/%d' % (start, start + len(content) - 1, size)
+    response['Content-Length'] = str(len(content))
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
 def status(request):
     '''Statistics about the operations of the server'''
 
@@ -87,6 +202,10 @@ def status(request):
         nb_processing = {'value': model_class.processing_objects.count(), 'url': url+'processing/'}
         nb_completed = {'value': model_class.completed_objects.count(), 'url': url+'completed/'}
         nb_error = {'value': model_class.error_objects.count(), 'url': url+'error/'}
+        if hasattr(model_class, 'evicted_objects'):
+            nb_evicted = {'value': model_class.evicted_objects.count(), 'url': url+'evicted/'}
+        else:
+            nb_evicted = {'value': 'n/a', 'url': None}
 
         if nb_completed['value'] == 0 and nb_error['value'] == 0:
             percent_success_value = 'n/a'
@@ -94,7 +213,22 @@ def status(request):
             percent_success_value = '%.0f' % (nb_completed['value']*100/(nb_completed['value']+nb_error['value'])) + '%'
         percent_success = {'value': percent_success_value, 'url': None}
 
-        object_stat.append([name, nb_processing, nb_completed, nb_error, percent_success])
+        object_stat.append([name, nb_processing, nb_completed, nb_error, nb_evicted, percent_success])
+
+    # Stats of the transfer rates of the bittorrent session
+    from datetime import datetime, timedelta
+    transfer_stat = list()
+    for (period_name, resolution, period) in [('Last hour', 'minute', timedelta(hours=1)), \
+                                              ('Last day', 'hour', timedelta(days=1)), \
+                                              ('Last 30 days', 'hour', timedelta(days=30))]:
+        stats = TransferSample.objects.get_session_stats(resolution, datetime.now() - period)
+        transfer_stat.append([period_name] + ["%.3f MB/s" % (stats[key]/(1024*1024)) \
+                for key in ['avg_download_rate', 'avg_upload_rate', 'max_download_rate']])
+
+    # Stats of the disk space available for downloads
+    from wall.storagemanager import StorageManager
+    stats = StorageManager().get_storage_stats()
+    storage_stat = [["%.2f GB" % (float(stats[key])/(1024*1024*1024)) for key in ['free', 'reserved', 'headroom']]]
 
     # Stats of log messages levels
     import re
@@ -109,6 +243,8 @@ def status(request):
 
     return render_to_response('wall/status.html', {
         'object_stat': object_stat,
+        'transfer_stat': transfer_stat,
+        'storage_stat': storage_stat,
         'log_stat': log_stat,
     }, context_instance=RequestContext(request))
 
@@ -85,6 +85,25 @@
         return eta;
     }
 
+    /**
+     * Sends a POST request to one of the AJAX views, with the CSRF token
+     * Django expects, and calls the callback with the decoded JSON response.
+     */
+    $.plebia.post = function(url, callback) {
+        var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+        var csrf_token = match ? decodeURIComponent(match[1]) : '';
+
+        return $.ajax({
+            type: 'POST',
+            url: url,
+            dataType: 'json',
+            beforeSend: function(xhr) {
+                xhr.setRequestHeader('X-CSRFToken', csrf_token);
+            },
+            success: callback
+        });
+    }
+
     // BaseObject (parent of all objects) ///////////////////////////////////////////////
 
     $.plebia.BaseObject = function() {
@@ -869,7 +888,7 @@
                 return 'searching';
             } else if(torrent.status == 'Queued') {
                 return 'queued';
-            } else if(torrent.status == 'Downloading' || torrent.status == 'Completed') {
+            } else if(torrent.status == 'Downloading' || torrent.status == 'Moving' || torrent.status == 'Completed') {
                 return 'downloading';
             } else {
                 return 'error';
@@ -1157,6 +1176,24 @@
 
             // Progress bar init
             $('.plebia_progress_bar', $this.dom).progressbar({value: 0});
+
+            // Streaming - only requested when the user wants to watch the video, 
+            // as the video is then downloaded in order, ahead of the rest of the torrent
+            $('.plebia_watch_now', $this.dom).click(function() {
+                $.plebia.post('/ajax/stream/'+episode.api_obj.id+'/', function(response) {
+                    if(response.url && response.readable_bytes > 0) {
+                        $this.location.href = response.url;
+                    } else {
+                        $('.plebia_info_msg', $this.dom).html('Buffering the start of the video, try again in a few seconds...');
+                    }
+                });
+                return false;
+            });
+        }
+
+        // The video can be streamed once the list of files of the torrent is known
+        if(torrent.file_list) {
+            $('.plebia_watch_now', $this.dom).css('display', 'inline');
         }
 
         // Info message
@@ -1240,6 +1277,11 @@
             // Download link
             var url = $this.get_download_url();
             $('.video_link', $this.dom).attr('href', url);
+
+            // Keep track of the videos being watched, to keep them on disk
+            video_dom.bind('play', function() {
+                $.plebia.post('/ajax/watch/'+episode.api_obj.id+'/');
+            });
         }
     };
 